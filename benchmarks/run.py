@@ -0,0 +1,285 @@
+"""
+Offline benchmarks for reagan, run against the local stand-ins.
+
+    python -m benchmarks.run --sizes 1000 10000 --output results.json
+    python -m benchmarks.run --compare baseline.json results.json
+
+Each benchmark is run at every size and records the best time of a few
+repeats, the throughput in rows per second and the peak memory allocated
+(measured in a separate, traced run). Results are saved as json so runs
+can be compared across changes.
+"""
+from datetime import datetime
+from time import perf_counter
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+import warnings
+import pandas as pd
+from benchmarks import stand_ins
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The function takes the size and returns a
+    callable that runs the benchmark once (setup is not measured).
+    """
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+@benchmark("subclass._json_to_df")
+def bench_json_to_df(size):
+    data = stand_ins.placements(size)
+    sc = stand_ins.Subclass()
+    return lambda: sc._json_to_df(data)
+
+
+@benchmark("subclass._json_to_df[columns]")
+def bench_json_to_df_columns(size):
+    data = stand_ins.placements(size)
+    sc = stand_ins.Subclass()
+    columns = ["id", "name", "campaignId", "tagSetting_keywordOption", "pricingSchedule_pricingPeriods_rateOrCostNanos"]
+    return lambda: sc._json_to_df(data, columns)
+
+
+@benchmark("dcm.list")
+def bench_dcm_list(size):
+    dcm = stand_ins.local_dcm(stand_ins.DCMService(placements=stand_ins.placements(size)))
+    return lambda: dcm.list("placements", arguments={}, all=True)
+
+
+@benchmark("dcm.to_df")
+def bench_dcm_to_df(size):
+    dcm = stand_ins.local_dcm(stand_ins.DCMService(placements=stand_ins.placements(size)))
+    return lambda: dcm.to_df("placements", arguments={}, all=True)
+
+
+@benchmark("dcm.report_to_df")
+def bench_dcm_report_to_df(size):
+    dcm = stand_ins.local_dcm(stand_ins.DCMService(report=stand_ins.report_csv(size)))
+    return lambda: dcm.report_to_df(reportId="1", fileId="1", params={})
+
+
+@benchmark("sa360.reports_to_df")
+def bench_sa360_reports_to_df(size):
+    report = stand_ins.report_csv(size).split(b"Report Fields\n")[1].rsplit(b"\n", 1)[0]
+    sa = stand_ins.local_sa360(stand_ins.SA360Service(fragments=[report]))
+    return lambda: list(sa.reports_to_df(agency_id=1, report_type="campaign", columns=["campaignId"]))
+
+
+@benchmark("drive.retrieve_all_files")
+def bench_drive_retrieve_all_files(size):
+    files = [{"id": str(i), "name": f"file_{i}.csv", "mimeType": "text/csv"} for i in range(size)]
+    dr = stand_ins.local_drive(stand_ins.DriveService(files=files))
+    return lambda: dr.retrieve_all_files()
+
+
+@benchmark("smartsheets.sheet_to_df")
+def bench_sheet_to_df(size):
+    ss = stand_ins.local_smartsheet({1: stand_ins.sheet(max(size // 10, 1))})
+    return lambda: ss.sheet_to_df(1)
+
+
+@benchmark("ihub.get_message_data")
+def bench_ihub(size):
+    ih = stand_ins.local_ihub()
+    return lambda: [ih.get_message_data(message_id) for message_id in range(max(size // 100, 1))]
+
+
+def _frame(size):
+    return pd.DataFrame(
+        {
+            "id": range(size),
+            "name": [f"Placement {i}" for i in range(size)],
+            "date": pd.Timestamp("2020-01-01"),
+            "cost": [i * 0.01 for i in range(size)],
+        }
+    )
+
+
+@benchmark("sqlserver.to_sql")
+def bench_sqlserver_to_sql(size):
+    ss = stand_ins.local_sqlserver()
+    df = _frame(size)
+    return lambda: ss.to_sql(df, name="bench", schema="main", if_exists="replace")
+
+
+@benchmark("psql.to_sql")
+def bench_psql_to_sql(size):
+    # Set REAGAN_BENCH_POSTGRES to a json connection dict to use a local Postgres instead of SQLite
+    connection = json.loads(os.environ.get("REAGAN_BENCH_POSTGRES", "null"))
+    ps = stand_ins.local_psql(connection)
+    df = _frame(size)
+    schema = "public" if connection else "main"
+    return lambda: ps.to_sql(df, schema=schema, table="bench", if_exists="replace")
+
+
+@benchmark("psql.to_dict")
+def bench_psql_to_dict(size):
+    ps = stand_ins.local_psql()
+    _frame(size).to_sql("bench", ps.conn, index=False)
+    return lambda: ps.to_dict(schema="main", table="bench", key="id", value="name")
+
+
+@benchmark("psql.to_dict_native")
+def bench_psql_to_dict_native(size):
+    ps = stand_ins.local_psql()
+    _frame(size).to_sql("bench", ps.conn, index=False)
+    return lambda: ps.to_dict(schema="main", table="bench", key="id", value="name", native=True)
+
+
+@benchmark("pgcopy.csv_chunks")
+def bench_csv_chunks(size):
+    from reagan.pgcopy import csv_chunks
+
+    df = _frame(size)
+    return lambda: sum(len(chunk) for chunk in csv_chunks(df, 100000))
+
+
+@benchmark("pgcopy.binary_chunks")
+def bench_binary_chunks(size):
+    from reagan.pgcopy import binary_chunks
+
+    df = _frame(size)
+    return lambda: sum(len(chunk) for chunk in binary_chunks(df, 100000))
+
+
+def import_times(statement="import reagan"):
+    """
+    Runs the import statement in a fresh interpreter with python -X importtime and
+    returns a dict of module to cumulative import time in seconds.
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, check=True)
+    times = {}
+    for line in output.stderr.decode().splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1]) / 10 ** 6
+    return times
+
+
+@benchmark("import reagan")
+def bench_import(size):
+    # Wall time of importing the package in a fresh interpreter, which should not load any connector
+    return lambda: import_times("import reagan")
+
+
+def measure(setup, size, repeat=3):
+    """
+    Returns the best time of [repeat] runs and the peak memory (MB) of one traced run.
+    """
+    run = setup(size)
+    run()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        run()
+        times.append(perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def run_benchmarks(sizes, names=None, repeat=3, verbose=True):
+    """
+    Runs the benchmarks (all of them if names is None) at each size and
+    returns a list of result dicts. Benchmarks whose connector cannot be
+    imported here (e.g. no ODBC driver) are recorded as skipped.
+    """
+    results = []
+    for name, setup in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        for size in sizes:
+            result = {"benchmark": name, "size": size}
+            try:
+                seconds, peak_mb = measure(setup, size, repeat=repeat)
+            except ImportError as e:
+                result["skipped"] = str(e)
+            else:
+                result["seconds"] = seconds
+                result["rows_per_second"] = size / seconds if seconds else None
+                result["peak_mb"] = peak_mb
+            results.append(result)
+            if verbose:
+                print(json.dumps(result))
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def save(results, path):
+    output = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2)
+
+
+def compare(baseline_path, path):
+    """
+    Returns a dataframe comparing two saved runs. Ratios above 1 mean the
+    second run is slower (time) or uses more memory (peak_mb).
+    """
+    frames = []
+    for run_path in (baseline_path, path):
+        with open(run_path, "r") as f:
+            df = pd.DataFrame(json.load(f)["results"])
+        frames.append(df.set_index(["benchmark", "size"]).reindex(columns=["seconds", "peak_mb"]))
+    df = frames[0].join(frames[1], lsuffix="_baseline", how="outer")
+    df["time_ratio"] = df["seconds"] / df["seconds_baseline"]
+    df["memory_ratio"] = df["peak_mb"] / df["peak_mb_baseline"]
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for reagan")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--benchmarks", nargs="+", help=f"Any of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Path of the json file to save results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), help="Compare two saved runs")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", FutureWarning)
+
+    if args.compare:
+        with pd.option_context("display.width", 200, "display.max_columns", None, "display.max_rows", None):
+            print(compare(*args.compare))
+        return
+
+    results = run_benchmarks(args.sizes, names=args.benchmarks, repeat=args.repeat)
+    if args.output:
+        save(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
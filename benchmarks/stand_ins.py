@@ -0,0 +1,552 @@
+"""
+Local stand-ins for the services reagan connects to, so connectors can be
+exercised offline: a parameter store, discovery services returning
+synthetic DCM/SA360/Drive data, a Smartsheet client, canned Ihub pages and
+SQLite (or a local Postgres) in place of the SQL servers.
+"""
+from bs4 import BeautifulSoup
+from reagan.ssm import LocalParameterStore, set_parameter_store
+from reagan.subclass import Subclass
+import sqlalchemy
+import random
+
+PARAMETERS = {
+    "/dcm/service_account_path": "service_account.json",
+    "/sa360/service_account_path": "service_account.json",
+    "/drive/service_account_path": "service_account.json",
+    "/smartsheets/bearer_token": "token",
+}
+
+
+def use_local_parameters(parameters=PARAMETERS):
+    """
+    Installs a LocalParameterStore with the parameters the stand-ins need.
+    """
+    store = LocalParameterStore(parameters)
+    set_parameter_store(store)
+    return store
+
+
+# Synthetic data
+# --------------
+
+
+def placement(i, rng):
+    """
+    Returns a synthetic DCM placement with the nesting of the real object.
+    """
+    return {
+        "kind": "dfareporting#placement",
+        "id": str(100000 + i),
+        "name": f"Placement {i}",
+        "accountId": "8334",
+        "advertiserId": str(rng.randint(1, 50)),
+        "campaignId": str(rng.randint(1, 500)),
+        "siteId": str(rng.randint(1, 200)),
+        "archived": rng.random() < 0.1,
+        "paymentSource": "PLACEMENT_AGENCY_PAID",
+        "compatibility": "DISPLAY",
+        "size": {"id": "1", "width": 300, "height": 250, "iab": True},
+        "tagFormats": ["PLACEMENT_TAG_STANDARD", "PLACEMENT_TAG_IFRAME_JAVASCRIPT"],
+        "tagSetting": {
+            "keywordOption": "PLACEHOLDER_WITH_LIST_OF_KEYWORDS",
+            "includeClickTracking": True,
+            "additionalKeyValues": f"kv={i}",
+        },
+        "pricingSchedule": {
+            "startDate": "2020-01-01",
+            "endDate": "2020-12-31",
+            "pricingType": "PRICING_TYPE_CPM",
+            "pricingPeriods": [
+                {"startDate": "2020-01-01", "endDate": "2020-06-30", "rateOrCostNanos": str(i * 1000), "units": "1000"},
+                {"startDate": "2020-07-01", "endDate": "2020-12-31", "rateOrCostNanos": str(i * 2000), "units": "1000"},
+            ],
+        },
+        "lookbackConfiguration": {"clickDuration": 30, "postImpressionActivitiesDuration": 30},
+        "createInfo": {"time": "1577836800000"},
+        "lastModifiedInfo": {"time": "1577836800000"},
+    }
+
+
+def placements(count, seed=0):
+    rng = random.Random(seed)
+    return [placement(i, rng) for i in range(count)]
+
+
+def report_csv(rows, seed=0):
+    """
+    Returns a synthetic DCM report file (bytes), with the metadata header,
+    the report fields and the grand total row of the real files.
+    """
+    rng = random.Random(seed)
+    lines = [
+        "Report Name,Benchmark",
+        "Report Time,2020-02-01 00:00:00",
+        "Date Range,2020-01-01 - 2020-01-31",
+        "",
+        "",
+        "",
+        "Report Fields",
+        "Date,Campaign,Campaign ID,Placement,Placement ID,Impressions,Clicks,Media Cost",
+    ]
+    for i in range(rows):
+        lines.append(
+            f"2020-01-{i % 28 + 1:02d},Campaign {i % 97},{i % 97},Placement {i},{100000 + i},"
+            f"{rng.randint(0, 100000)},{rng.randint(0, 1000)},{rng.random() * 100:.2f}"
+        )
+    lines.append("Grand Total:,,,,,0,0,0")
+    return "\n".join(lines).encode("utf-8")
+
+
+def sheet(rows, columns=10):
+    """
+    Returns a synthetic Smartsheet sheet, as returned by Sheet.to_dict().
+    """
+    return {
+        "id": 1,
+        "name": "Benchmark",
+        "createdAt": "2020-01-01T00:00:00Z",
+        "modifiedAt": "2020-01-01T00:00:00Z",
+        "permalink": "https://app.smartsheet.com/sheets/1",
+        "columns": [{"id": c, "index": c, "title": f"Column {c}", "type": "TEXT_NUMBER"} for c in range(columns)],
+        "rows": [
+            {
+                "id": r,
+                "rowNumber": r + 1,
+                "cells": [{"columnId": c, "value": r * columns + c, "displayValue": str(r * columns + c)} for c in range(columns)],
+            }
+            for r in range(rows)
+        ],
+    }
+
+
+IHUB_PAGE = """
+<html><body>
+<span id="ctl00_CP1_mh1_lblDate">1/1/2020 9:30:00 AM</span>
+<input id="ctl00_CP1_mh1_tbPost" value="{post_number}"/>
+<a id="ctl00_CP1_bbc1_hlBoard" href="/TICKER/">Ticker</a>
+<div id="ctl00_CP1_mbdy_dv">This stock is going to do great things this year, very happy with the results.</div>
+</body></html>
+"""
+
+
+# Discovery services
+# ------------------
+
+
+class Request(object):
+    def __init__(self, response, transports=None):
+        self.response = response
+        self.transports = transports
+
+    def execute(self, http=None, num_retries=0):
+        # The HTTP transports requests are executed on are kept, to check workers use their own
+        if self.transports is not None:
+            self.transports.append(http)
+        return self.response() if callable(self.response) else self.response
+
+
+# Files served by LocalHttp, by uri
+MEDIA = {}
+
+
+class LocalHttp(object):
+    """
+    HTTP transport serving the bytes of the files in MEDIA in the ranges requested, like a media download.
+    """
+
+    def __init__(self):
+        self.requests = 0
+
+    def request(self, uri, method="GET", headers=None, **kwargs):
+        import httplib2
+
+        self.requests += 1
+        data = MEDIA[uri]
+        start, end = (int(value) for value in headers["range"].split("=")[1].split("-"))
+        chunk = data[start : end + 1]
+        if not chunk:
+            return httplib2.Response({"status": 416, "content-range": f"bytes */{len(data)}"}), b""
+        content_range = f"bytes {start}-{start + len(chunk) - 1}/{len(data)}"
+        return httplib2.Response({"status": 206, "content-range": content_range}), chunk
+
+
+class MediaRequest(Request):
+    """
+    A get_media request, downloaded in chunks by MediaIoBaseDownload.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.uri = f"https://localhost/media/{id(data)}"
+        self.headers = {}
+        self.http = LocalHttp()
+        MEDIA[self.uri] = data
+
+
+class Resource(object):
+    """
+    A discovery resource (e.g. service.placements()) whose methods return requests.
+    """
+
+    def __init__(self, methods):
+        self.methods = methods
+
+    def __getattr__(self, name):
+        try:
+            return self.methods[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class PagedResource(Resource):
+    """
+    A resource whose list method pages through items like the Google APIs do.
+    """
+
+    def __init__(self, key, items, page_size):
+        self.key = key
+        self.items = items
+        self.page_size = page_size
+        self.transports = []
+        super().__init__({})
+
+    def _page(self, start, ids=None):
+        items = self.items
+        if ids is not None:
+            ids = set(str(i) for i in ids)
+            items = [item for item in items if item["id"] in ids]
+        response = {"kind": "list", self.key: items[start : start + self.page_size]}
+        if start + self.page_size < len(items):
+            response["nextPageToken"] = str(start + self.page_size)
+        request = Request(response, self.transports)
+        request.start, request.ids = start, ids
+        return request
+
+    def list(self, **kwargs):
+        return self._page(int(kwargs.get("pageToken", 0)), kwargs.get("ids"))
+
+    def list_next(self, request, response):
+        return self._page(request.start + self.page_size, request.ids)
+
+
+def http_error(status, reason="", message="error"):
+    """
+    Returns the googleapiclient HttpError of a failed call.
+    """
+    from googleapiclient.errors import HttpError
+    import httplib2
+    import json
+
+    content = {"error": {"code": status, "message": message, "errors": [{"reason": reason, "message": message}]}}
+    return HttpError(httplib2.Response({"status": status}), json.dumps(content).encode("utf-8"))
+
+
+class EntityResource(PagedResource):
+    """
+    A paged resource that also gets, patches, updates and inserts its items by id.
+    Calls on the ids in failures raise a rate limit error that many times first.
+    """
+
+    def __init__(self, key, items, page_size):
+        super().__init__(key, items, page_size)
+        self.by_id = {item["id"]: item for item in self.items}
+        self.failures = {}
+
+    def _call(self, id, action):
+        def response():
+            if self.failures.get(str(id)):
+                self.failures[str(id)] -= 1
+                raise http_error(403, "userRateLimitExceeded", "Quota exceeded")
+            if id is not None and str(id) not in self.by_id:
+                raise http_error(404, "notFound", f"{id} not found")
+            return action()
+
+        return Request(response, self.transports)
+
+    def get(self, profileId, id):
+        return self._call(id, lambda: self.by_id[str(id)])
+
+    def patch(self, profileId, id, body):
+        return self._call(id, lambda: self.by_id[str(id)].update(body) or self.by_id[str(id)])
+
+    def update(self, profileId, body):
+        return self._call(body["id"], lambda: self.by_id.update({str(body["id"]): body}) or body)
+
+    def insert(self, profileId, body):
+        def insert():
+            item = dict(body, id=str(100000 + len(self.items)))
+            self.items.append(item)
+            self.by_id[item["id"]] = item
+            return item
+
+        return self._call(None, insert)
+
+
+class BatchRequest(object):
+    """
+    Stand-in for googleapiclient's BatchHttpRequest, running the calls one after another.
+    """
+
+    def __init__(self, batches):
+        self.calls = []
+        batches.append(self.calls)
+
+    def add(self, request, callback=None, request_id=None):
+        self.calls.append((request, callback, request_id))
+
+    def execute(self, http=None):
+        for request, callback, request_id in self.calls:
+            try:
+                response, exception = request.execute(), None
+            except Exception as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class DCMService(object):
+    """
+    Stand-in for the dfareporting service built by DCMAPI. Report files are
+    processing for the first [polls] polls (an int, or a dict of report id to
+    polls), then have the given status.
+    """
+
+    def __init__(self, placements=(), report=b"", page_size=1000, polls=0, status="REPORT_AVAILABLE"):
+        self._placements = EntityResource("placements", list(placements), page_size)
+        self._report = report
+        self.batches = []
+        self.polls = polls
+        self.status = status
+        self.report_files = {}
+
+    def _run(self, profileId, reportId):
+        fileId = str(len(self.report_files) + 1)
+        polls = self.polls.get(reportId, 0) if isinstance(self.polls, dict) else self.polls
+        self.report_files[fileId] = polls
+        return Request({"id": fileId})
+
+    def _file_status(self, reportId, fileId):
+        # Files not run through the stand-in are available
+        polls = self.report_files.get(fileId, 0)
+        if polls:
+            self.report_files[fileId] -= 1
+            return {"status": "PROCESSING"}
+        return {"status": self.status}
+
+    def new_batch_http_request(self):
+        return BatchRequest(self.batches)
+
+    def placements(self):
+        return self._placements
+
+    def userProfiles(self):
+        profile = {"accountId": "8334", "profileId": "1", "userName": "bench"}
+        return Resource({"list": lambda **kwargs: Request({"items": [profile]})})
+
+    def reports(self):
+        return Resource({"run": self._run})
+
+    def files(self):
+        return Resource(
+            {
+                "get": lambda reportId, fileId: Request(lambda: self._file_status(reportId, fileId)),
+                "get_media": lambda **kwargs: MediaRequest(self._report),
+            }
+        )
+
+
+class SA360Service(object):
+    """
+    Stand-in for the doubleclicksearch service built by SA360. Reports are
+    not ready for the first [polls] polls.
+    """
+
+    def __init__(self, fragments=(), polls=0):
+        self.fragments = list(fragments)
+        self.polls = polls
+        self.requested = {}
+
+    def _request(self, body):
+        report_id = str(len(self.requested) + 1)
+        self.requested[report_id] = self.polls
+        return Request({"id": report_id})
+
+    def _status(self, reportId):
+        if self.requested.get(reportId):
+            self.requested[reportId] -= 1
+            return {"isReportReady": False}
+        files = [{"url": f"https://x/reports/{reportId}/files/{i}"} for i in range(len(self.fragments))]
+        return {"isReportReady": True, "files": files}
+
+    def reports(self):
+        return Resource(
+            {
+                "request": self._request,
+                "get": lambda reportId: Request(lambda: self._status(reportId)),
+                "getFile": lambda reportId, reportFragment: Request(self.fragments[int(reportFragment)]),
+            }
+        )
+
+
+class DriveService(object):
+    """
+    Stand-in for the drive service built by Drive.
+    """
+
+    def __init__(self, files=(), page_size=100):
+        self._files = list(files)
+        self.page_size = page_size
+
+    def _list(self, pageToken=0):
+        start = int(pageToken)
+        response = {"files": self._files[start : start + self.page_size]}
+        if start + self.page_size < len(self._files):
+            response["nextPageToken"] = str(start + self.page_size)
+        return Request(response)
+
+    def files(self):
+        return Resource({"list": self._list})
+
+
+class Sheet(object):
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class Smartsheet(object):
+    """
+    Stand-in for the smartsheet client used by SmartsheetAPI.
+    """
+
+    def __init__(self, sheets):
+        self.Sheets = Resource({"get_sheet": lambda sheet_id: Sheet(sheets[sheet_id])})
+
+
+# Connectors
+# ----------
+
+
+def without_rate_limits(api):
+    """
+    Gives the API a limiter without limits, since the stand-ins have no quotas.
+    """
+    from reagan.ratelimit import RateLimiter, set_limiter
+
+    set_limiter(api, RateLimiter())
+
+
+def local_dcm(service):
+    from reagan.dcm import DCMAPI
+
+    class LocalDCMAPI(DCMAPI):
+        def _create_service(self):
+            self.service = service
+
+        def _new_http(self):
+            return LocalHttp()
+
+    use_local_parameters()
+    without_rate_limits("dfareporting")
+    return LocalDCMAPI(profile_id="1")
+
+
+def local_sa360(service):
+    from reagan.sa360 import SA360
+
+    class LocalSA360(SA360):
+        def _create_service(self):
+            self.service = service
+
+        def _new_http(self):
+            return LocalHttp()
+
+    use_local_parameters()
+    without_rate_limits("doubleclicksearch")
+    return LocalSA360()
+
+
+def local_drive(service):
+    from reagan.drive import Drive
+
+    class LocalDrive(Drive):
+        def _create_service(self):
+            self.service = service
+
+    use_local_parameters()
+    without_rate_limits("drive")
+    return LocalDrive()
+
+
+def local_smartsheet(sheets):
+    from reagan.smartsheets import SmartsheetAPI
+
+    use_local_parameters()
+    ss = SmartsheetAPI()
+    ss.conn = Smartsheet(sheets)
+    return ss
+
+
+def local_ihub():
+    from reagan.ihub import Ihub
+
+    class LocalIhub(Ihub):
+        def page_response(self, message_id, timeout=60):
+            return BeautifulSoup(IHUB_PAGE.format(post_number=message_id % 100000), "lxml")
+
+    return LocalIhub()
+
+
+def sqlite_engine(path=":memory:"):
+    return sqlalchemy.create_engine(f"sqlite:///{path}")
+
+
+def local_psql(connection=None, cache=None):
+    """
+    Returns a PSQL connected to a local Postgres given its connection dict
+    (engine, user, password, host, port, dbname), or to SQLite if None.
+    """
+    from reagan.psql import PSQL
+
+    if connection:
+        use_local_parameters(dict(PARAMETERS, **{"/postgres/local": repr(connection)}))
+        return PSQL("local", cache=cache)
+
+    class LocalPSQL(PSQL):
+        def __init__(self):
+            Subclass.__init__(self)
+            self.server = "sqlite"
+            self.result_cache = cache
+            self.conn = sqlite_engine()
+
+    return LocalPSQL()
+
+
+def local_async_psql(connection, **kwargs):
+    """
+    Returns an AsyncPSQL connected to a local Postgres given its connection dict.
+    """
+    from reagan.async_psql import AsyncPSQL
+
+    use_local_parameters(dict(PARAMETERS, **{"/postgres/local": repr(connection)}))
+    return AsyncPSQL("local", **kwargs)
+
+
+def local_sqlserver(cache=None):
+    """
+    Returns a SQLServer whose engine is SQLite. pyodbc must still be importable.
+    """
+    from reagan.sqlserver import SQLServer
+
+    class LocalSQLServer(SQLServer):
+        def __init__(self):
+            Subclass.__init__(self)
+            self.server = "sqlite"
+            self.result_cache = cache
+            self._conn = None
+            self._conn_cursor = None
+            self.engine = sqlite_engine()
+
+    return LocalSQLServer()
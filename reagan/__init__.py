@@ -1,9 +1,38 @@
-from reagan.dcm import DCMAPI
-from reagan.sa360 import SA360
-from reagan.drive import Drive
-from reagan.smartsheets import SmartsheetAPI
-from reagan.sqlserver import SQLServer
-from reagan.gcp import GCP
-from reagan.psql import PSQL
-from reagan.ihub import Ihub
-from reagan.fidelity import Fidelity
+from importlib import import_module
+
+# Connectors are imported on first use, so their dependencies (googleapiclient,
+# pyodbc, psycopg2, smartsheet...) are only loaded when that connector is used
+_exports = {
+    "DCMAPI": "reagan.dcm",
+    "SA360": "reagan.sa360",
+    "Drive": "reagan.drive",
+    "SmartsheetAPI": "reagan.smartsheets",
+    "SQLServer": "reagan.sqlserver",
+    "GCP": "reagan.gcp",
+    "PSQL": "reagan.psql",
+    "AsyncPSQL": "reagan.async_psql",
+    "Ihub": "reagan.ihub",
+    "Fidelity": "reagan.fidelity",
+    "QueryTemplate": "reagan.query",
+    "compile_query": "reagan.query",
+    "Hook": "reagan.instrumentation",
+    "MetricsAggregator": "reagan.instrumentation",
+    "add_hook": "reagan.instrumentation",
+    "remove_hook": "reagan.instrumentation",
+    "ResultCache": "reagan.cache",
+    "ReportManager": "reagan.reports",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(import_module(_exports[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'reagan' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+from contextlib import asynccontextmanager
+from time import perf_counter
+from reagan.instrumentation import instrumented, current_event
+from reagan.pgcopy import copy_records, pg_type, upsert_statement
+from reagan.subclass import Subclass
+import asyncio
+import uuid
+import asyncpg
+import pandas as pd
+
+
+class AsyncPSQL(Subclass):
+    """
+    asyncio counterpart of PSQL, backed by an asyncpg connection pool, so many
+    concurrent calls share a few connections without threads. Queries take
+    asyncpg's $1, $2... placeholders for params.
+
+        async with AsyncPSQL('102') as ps:
+            df = await ps.to_df('SELECT * FROM gcm.site WHERE site_id = $1', params=[1234])
+    """
+
+    def __init__(self, server, verbose=0, min_size=1, max_size=10):
+        """
+            - server (string): Alias of the server, read from /postgres/[server] in the parameter store
+            - min_size (int): Connections opened with the pool
+            - max_size (int): Maximum number of open connections
+        """
+        super().__init__()
+        self.verbose = verbose
+        self.server = server
+        self.connection_string = eval(self.get_parameter_value(f"/postgres/{self.server}"))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._get_pool()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _get_pool(self):
+        # The pool is created by the first call, in the running event loop
+        if self.pool is None:
+            async with self._pool_lock:
+                if self.pool is None:
+                    connection = self.connection_string
+                    self.pool = await asyncpg.create_pool(
+                        user=connection["user"],
+                        password=connection["password"],
+                        host=connection["host"],
+                        port=connection["port"],
+                        database=connection["dbname"],
+                        ssl=connection.get("sslmode", "prefer"),
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                    )
+        return self.pool
+
+    async def close(self):
+        """
+        Closes every connection of the pool.
+        """
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def _connection(self):
+        # Acquires a connection from the pool, adding the wait to the current event
+        pool = await self._get_pool()
+        start = perf_counter()
+        async with pool.acquire() as conn:
+            event = current_event()
+            if event is not None:
+                event.wait += perf_counter() - start
+            yield conn
+
+    @instrumented()
+    async def to_df(self, query_input, replacements={}, params=None):
+        """
+        Takes in a string containing either a correctly formatted SQL
+        query, or filepath directed to a .sql file. Returns a pandas DataFrame
+        of the executed query.
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list): Values bound to the $1, $2... placeholders of the query. asyncpg
+              prepares each query once per connection and re-uses it.
+        """
+        query = self._format_query(query_input, replacements)
+        async with self._connection() as conn:
+            statement = await conn.prepare(query)
+            records = await statement.fetch(*(params or []))
+            columns = [attribute.name for attribute in statement.get_attributes()]
+        return pd.DataFrame.from_records([tuple(record) for record in records], columns=columns, coerce_float=True)
+
+    @instrumented()
+    async def execute(self, query, replacements={}, params=None, many=False):
+        """
+        Executes query.
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list): Values bound to the $1, $2... placeholders of the query, or a list of
+              parameter sets if many is True
+            - many (bool): Executes the query once for every parameter set in params
+        """
+        query = self._format_query(query, replacements)
+        async with self._connection() as conn:
+            if many:
+                await conn.executemany(query, params)
+            else:
+                await conn.execute(query, *(params or []))
+
+    @instrumented()
+    async def get_scalar(self, query, replacements={}, params=None):
+        """
+        Executes query and returns a single result
+            - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list): Values bound to the $1, $2... placeholders of the query
+        """
+        query = self._format_query(query, replacements)
+        async with self._connection() as conn:
+            return await conn.fetchval(query, *(params or []))
+
+    @instrumented()
+    async def to_sql(self, df, schema, table, if_exists='fail', index=False, keys=None):
+        """
+        Inserts a pandas dataframe into the specified table with binary COPY.
+            - if_exists (string): How to treat the insertion. Accepted values are: 'fail','append','replace','upsert' (default is fail).
+                - If 'replace' is selected, the table will be dropped and recreated with the pandas column types.
+                - If 'upsert' is selected, rows are copied to a temporary table, then inserted with
+                  INSERT ... ON CONFLICT on keys (see PSQL.copy_to_sql).
+            - index (bool): Whether to include the DataFrame index in the table (default is False).
+            - keys (list): Columns to match rows on for 'upsert'.
+        """
+        if if_exists not in ('fail', 'append', 'replace', 'upsert'):
+            raise ValueError(f"'{if_exists}' is not valid for if_exists")
+        if if_exists == 'upsert' and not keys:
+            raise ValueError("keys are required to upsert")
+        if index:
+            df = df.reset_index()
+
+        current_event().rows = len(df)
+        target = f'"{schema}"."{table}"'
+        columns = [str(col) for col in df.columns]
+
+        async with self._connection() as conn:
+            async with conn.transaction():
+                exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", target)
+                if exists and if_exists == 'fail':
+                    raise ValueError(f"Table {target} already exists.")
+                if exists and if_exists == 'replace':
+                    await conn.execute(f"DROP TABLE {target}")
+                if not exists or if_exists == 'replace':
+                    definition = ", ".join(f'"{col}" {pg_type(df[col])}' for col in columns)
+                    if if_exists == 'upsert':
+                        definition += ", PRIMARY KEY ({})".format(", ".join(f'"{key}"' for key in keys))
+                    await conn.execute(f"CREATE TABLE {target} ({definition})")
+
+                # Values are sent as the types of the table's columns, e.g. integers with NULLs as ints
+                rows = await conn.fetch(
+                    "SELECT attname, atttypid::regtype::text FROM pg_attribute WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped",
+                    target,
+                )
+                types = dict((row[0], row[1]) for row in rows)
+                records = copy_records(df, [types.get(col) for col in columns])
+                if if_exists == 'upsert':
+                    stage = f"_stage_{table}_{uuid.uuid4().hex[:8]}"
+                    await conn.execute(f'CREATE TEMP TABLE "{stage}" (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP')
+                    await conn.copy_records_to_table(stage, records=records, columns=columns)
+                    await conn.execute(upsert_statement(target, f'"{stage}"', columns, keys))
+                else:
+                    await conn.copy_records_to_table(table, records=records, columns=columns, schema_name=schema)
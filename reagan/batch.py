@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+from reagan.instrumentation import current_event
+import os
+import queue
+import threading
+
+
+def query_names(queries):
+    """
+    Returns a dict of name to query. A dict is returned as is; in a list, .sql
+    files are named after the file and other queries query_0, query_1...
+    """
+    if isinstance(queries, dict):
+        return dict(queries)
+    named = {}
+    for index, query in enumerate(queries):
+        if isinstance(query, str) and query.endswith(".sql"):
+            name = os.path.splitext(os.path.basename(query))[0]
+        else:
+            name = f"query_{index}"
+        if name in named:
+            raise ValueError(f"Two queries are named '{name}', pass a dict to name them")
+        named[name] = query
+    return named
+
+
+def run_many(func, queries, workers, errors="raise", **kwargs):
+    """
+    Runs func(query, **kwargs) for every query in a pool of [workers] threads and
+    returns a dict of name to result, in the order of the queries.
+        - func (function): Connector method, e.g. to_df
+        - queries (dict or list): Queries or .sql files (see query_names). A query can be a
+          dict of arguments to func instead, e.g. {'query': ..., 'params': [...]}
+        - workers (int): Maximum number of queries run at once
+        - errors (string): 'raise' cancels the queries not yet started and raises the first
+          error; 'return' returns the exception raised by a query as its result
+    """
+    if errors not in ("raise", "return"):
+        raise ValueError(f"'{errors}' is not valid for errors")
+    named = query_names(queries)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(named)), 1)) as executor:
+        futures = {}
+        for name, query in named.items():
+            arguments = dict(kwargs, **query) if isinstance(query, dict) else dict(kwargs, query=query)
+            futures[executor.submit(func, **arguments)] = name
+        try:
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    if errors == "raise":
+                        raise
+                    results[futures[future]] = e
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    event = current_event()
+    if event is not None:
+        rows = [len(result) for result in results.values() if hasattr(result, "__len__") and not isinstance(result, Exception)]
+        if rows:
+            event.rows = sum(rows)
+    return {name: results[name] for name in named}
+
+
+def prefetch(iterable, size=1, initializer=None):
+    """
+    Generator that yields the items of iterable while a background thread reads
+    up to [size] items ahead, e.g. to fetch the next page of a paged API while
+    the current page is handled. An error raised by iterable is raised where
+    its item would have been yielded.
+        - size (int): Maximum number of items read ahead
+        - initializer (function): Called first in the background thread, e.g. to give it its own HTTP transport
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Waits for room in the queue, unless the consumer stopped
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            if initializer is not None:
+                initializer()
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    # The reader runs in a copy of the current context, so it counts retries on the current event
+    thread = threading.Thread(target=copy_context().run, args=(read,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
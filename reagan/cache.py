@@ -0,0 +1,222 @@
+from contextlib import closing
+from hashlib import sha256
+from reagan.instrumentation import current_event
+from time import time
+import json
+import os
+import re
+import sqlite3
+import uuid
+import warnings
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    FORMAT = "pickle"
+else:
+    FORMAT = "parquet"
+
+_comments = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_whitespace = re.compile(r"\s+")
+_tables = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE|MERGE)\s+((?:[\w\[\]\"`]+\.)*[\w\[\]\"`]+)", re.I)
+
+
+def normalize_query(query):
+    """
+    Returns the query without comments, with runs of whitespace collapsed and no trailing semicolon.
+    """
+    return _whitespace.sub(" ", _comments.sub(" ", query)).strip().rstrip(";").strip()
+
+
+def normalize_table(table):
+    """
+    Returns the table name without quotes or brackets, in lower case, e.g. [gcm].[Site] is gcm.site.
+    """
+    return ".".join(part.strip() for part in re.sub(r"[\[\]\"`]", "", table).lower().split("."))
+
+
+def same_table(name, other):
+    """
+    Returns whether two normalized table names can be the same table: their parts match
+    up to the shorter one, as a name without schema (or database) resolves to any of them.
+    E.g. site is gcm.site, and gcm.site is db.gcm.site, but gcm.site is not dbo.site.
+    """
+    parts, other_parts = name.split("."), other.split(".")
+    length = min(len(parts), len(other_parts))
+    return parts[-length:] == other_parts[-length:]
+
+
+def query_tables(query):
+    """
+    Returns the set of tables (normalized schema.table names) the query reads or writes.
+    """
+    return {normalize_table(table) for table in _tables.findall(_comments.sub(" ", query))}
+
+
+class ResultCache(object):
+    """
+    Caches the dataframes returned by SQL queries in files on local disk, for the
+    SQLServer and PSQL to_df methods. Results are keyed by server alias, normalized
+    query and parameters, and stored as parquet (pickle if pyarrow is not installed).
+        - path (string): Directory of the cache (default is $REAGAN_CACHE_DIR or ~/.cache/reagan/results)
+        - ttl (int): Seconds a result is valid for
+        - max_bytes (int): Size of the cache on disk, above which the least recently used results are removed
+        - format (string): 'parquet' or 'pickle'
+    """
+
+    def __init__(self, path=None, ttl=3600, max_bytes=2 ** 30, format=None):
+        self.path = path or os.environ.get("REAGAN_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "reagan", "results")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.format = format or FORMAT
+        os.makedirs(self.path, exist_ok=True)
+        with closing(self._index()) as index, index:
+            index.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, alias TEXT, file TEXT, bytes INTEGER, created REAL, accessed REAL)"
+            )
+            index.execute("CREATE TABLE IF NOT EXISTS tables (key TEXT, alias TEXT, name TEXT)")
+            index.execute("CREATE INDEX IF NOT EXISTS tables_key ON tables (key)")
+
+    def _index(self):
+        # The index is a SQLite database, so processes sharing the directory can use it at once
+        return sqlite3.connect(os.path.join(self.path, "index.db"), timeout=30)
+
+    def key(self, alias, query, params=None):
+        """
+        Returns the key of a query's result.
+        """
+        text = json.dumps([alias, normalize_query(query), params], default=str, sort_keys=True)
+        return sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached dataframe for the key, or None if there is none or it has expired.
+        """
+        now = time()
+        with closing(self._index()) as index, index:
+            row = index.execute("SELECT file, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._remove(index, [key])
+                return None
+            index.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+        try:
+            return self._read(os.path.join(self.path, row[0]))
+        except (OSError, ValueError):
+            # Removed by another process since
+            return None
+
+    def put(self, key, df, alias=None, tables=()):
+        """
+        Stores the dataframe for the key, then removes the least recently used
+        results until the cache fits in max_bytes.
+            - alias (string): Server alias of the result, for invalidation
+            - tables (iterable): Tables the result was read from, for invalidation
+        """
+        file = f"{key}_{uuid.uuid4().hex[:8]}.{self.format}"
+        path = os.path.join(self.path, file)
+        try:
+            self._write(df, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+            raise
+        now = time()
+        with closing(self._index()) as index, index:
+            self._remove(index, [key])
+            index.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)", (key, alias, file, os.path.getsize(path), now, now))
+            index.executemany("INSERT INTO tables VALUES (?, ?, ?)", [(key, alias, normalize_table(table)) for table in tables])
+            self._evict(index)
+
+    def fetch(self, alias, query, load, params=None):
+        """
+        Returns the cached result of the query, or the result of load() after caching it.
+        Hits and misses are counted on the current instrumentation event.
+            - alias (string): Server alias, e.g. sqlserver/102
+            - query (string): The query, after replacements
+            - load (function): Runs the query and returns a dataframe
+            - params: Parameters bound to the query
+        """
+        key = self.key(alias, query, params)
+        df = self.get(key)
+        event = current_event()
+        if df is not None:
+            if event is not None:
+                event.cache_hits += 1
+            return df
+        if event is not None:
+            event.cache_misses += 1
+        df = load()
+        try:
+            self.put(key, df, alias=alias, tables=query_tables(query))
+        except (TypeError, ValueError) as e:
+            # Columns the format cannot store, e.g. mixed types for parquet
+            warnings.warn(f"Result not cached: {e!r}")
+        return df
+
+    def invalidate(self, table=None, alias=None):
+        """
+        Removes cached results and returns the number removed.
+            - table (string): Removes the results read from the table. Either schema.table, which also
+              removes the results of queries naming the table without a schema, or a table name
+              matching the table in any schema (see same_table).
+            - alias (string): Only removes results of this server alias. With no table, removes all its results.
+        """
+        with closing(self._index()) as index, index:
+            if table is None:
+                rows = index.execute("SELECT key FROM results WHERE ? IS NULL OR alias = ?", (alias, alias))
+                keys = [row[0] for row in rows]
+            else:
+                table = normalize_table(table)
+                rows = index.execute("SELECT key, name FROM tables WHERE ? IS NULL OR alias = ?", (alias, alias))
+                keys = {key for key, name in rows if same_table(name, table)}
+            self._remove(index, keys)
+        return len(keys)
+
+    def clear(self):
+        return self.invalidate()
+
+    def size(self):
+        """
+        Returns the number of results and bytes on disk in the cache.
+        """
+        with closing(self._index()) as index:
+            count, size = index.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results").fetchone()
+        return {"results": count, "bytes": size}
+
+    def _remove(self, index, keys):
+        for key in keys:
+            row = index.execute("SELECT file FROM results WHERE key = ?", (key,)).fetchone()
+            index.execute("DELETE FROM results WHERE key = ?", (key,))
+            index.execute("DELETE FROM tables WHERE key = ?", (key,))
+            if row is not None:
+                try:
+                    os.remove(os.path.join(self.path, row[0]))
+                except OSError:
+                    pass
+
+    def _evict(self, index):
+        total = index.execute("SELECT COALESCE(SUM(bytes), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        keys = []
+        for key, size in index.execute("SELECT key, bytes FROM results ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            keys.append(key)
+            total -= size
+        self._remove(index, keys)
+
+    def _write(self, df, path):
+        if self.format == "parquet":
+            df.to_parquet(path, index=False)
+        else:
+            df.to_pickle(path)
+
+    def _read(self, path):
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
@@ -1,18 +1,46 @@
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
+from reagan.batch import prefetch
+from reagan.discovery import build_service, get_credentials
+from reagan.instrumentation import instrumented, current_event, count_retry
+from reagan.reports import FAILED_STATUSES, ReportFailed, poll_intervals
+from reagan.ratelimit import execute, get_limiter, is_rate_limited, retry_wait
 from reagan.subclass import Subclass
-from io import StringIO
+from reagan.transport import ThreadTransports, authorized_http
+from tempfile import SpooledTemporaryFile
 import pandas as pd
 import os
+import threading
 from time import time, sleep
 from retrying import retry
 
+# Ids sent in a single list request, longer id lists are split into several requests
+IDS_PER_REQUEST = 500
+# Calls sent in a single batch request by the *_many methods
+BATCH_SIZE = 100
+# Report files are downloaded in chunks of this many bytes, to a file kept in memory up to SPOOL_SIZE
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+SPOOL_SIZE = 64 * 1024 * 1024
+# Bytes searched for the end of a report's metadata and for its grand total row
+MAX_HEADER_SIZE = 1024 * 1024
+# First lines of the metadata of a report file
+METADATA_LINES = (b"Report Name,", b"Report Time,", b"Date Range,")
+# Server errors of the calls retried by the *_many methods, as well as rate limits
+SERVER_ERRORS = {500, 502, 503, 504}
+
 
 class DCMAPI(Subclass):
     def __init__(self, networkId=8334, version = 'v3.5', verbose=0, profile_id=None, service_account_alias = None):
         super().__init__(verbose=verbose)
         self.version = version
         self.service_account_filepath = self.get_parameter_value(f'''/dcm/{"service_account_path" if not service_account_alias else service_account_alias}''')
+        # HTTP transport of each thread (see _execute) and lock for the call count
+        self.transports = ThreadTransports(self._new_http)
+        self._calls_lock = threading.Lock()
+        # Requests are throttled by the limiter shared by every DCMAPI in the process
+        self.limiter = get_limiter("dfareporting")
         self._create_service()
         self.dcm_api_calls = 0
 
@@ -21,47 +49,47 @@ class DCMAPI(Subclass):
         else:
             self.set_profile_id(networkId)
 
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
+    @instrumented()
+    @retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000, wait_exponential_max=60000, wait_jitter_max=1000, retry_on_exception=count_retry)
     def _create_service(self):
 
         api_name = "dfareporting"
-        self.credentials = service_account.Credentials.from_service_account_file(
-            self.service_account_filepath
-        )
-        self.service = build(api_name, self.version, credentials=self.credentials)
+        # Credentials and services are shared by the connectors of the process (see reagan.discovery)
+        self.credentials = get_credentials(self.service_account_filepath)
+        self.service = build_service(api_name, self.version, self.credentials)
 
-    def _add_missing(self, response, arguments):
-        ids_recieved = set([int(obj['id']) for obj in response])
+    def _missing_ids(self, ids_recieved, arguments):
+        # Placeholder objects for the requested ids that were not returned
         ids_requested = set(arguments.get('ids',[]))
-        for missing_id in ids_requested - ids_recieved:
-            response.append({'id':str(missing_id)})
-        return response
+        return [{'id':str(missing_id)} for missing_id in ids_requested - ids_recieved]
 
     def decode_error(self, error):
         # Returns a more concise error description
         return eval(error.content.decode())['error']['message']
 
-    def list(self, obj, arguments={}, all=False):
-        """
-        Calls the list method for the DCM Api.
-            - obj (string): The api object to pull from
-            - arguments (dict): Any additional arguments to pass to the list method.
-                (note: profile_id is automatically added)
-            - all (bool): Whether to make continuous api calls or just a single
-        """
+    def _new_http(self):
+        return authorized_http(self.credentials)
 
-        arguments["profileId"] = self.profile_id
+    def _count_calls(self, calls=1):
+        with self._calls_lock:
+            self.dcm_api_calls += calls
+
+    def _execute(self, request, tokens=1):
+        # Executes the request once the limiter allows it, on the HTTP transport of this thread
+        return execute(request, self.limiter, http=self.transports.get(), tokens=tokens)
+
+    def _list_request(self, obj, arguments):
         if obj == 'placementTags':
-            request = eval("self.service.placements().generatetags(**arguments)")
-        else:
-            request = eval("self.service.{0}().list(**arguments)".format(obj))
-        self.dcm_api_calls += 1
+            return self.service.placements().generatetags(**arguments)
+        return getattr(self.service, obj)().list(**arguments)
 
-        output = []
+    def _pages(self, obj, arguments, all):
+        # Pages of a single list request, following nextPageToken if all
+        request = self._list_request(obj, arguments)
 
         while True:
-            response = request.execute()
-            self.dcm_api_calls += 1
+            response = self._execute(request)
+            self._count_calls()
 
             # Need to re-work this logic below on how to get the key with the data (it's different then than the api object)
             s = set(response.keys()) - set(["kind", "nextPageToken"])
@@ -70,20 +98,92 @@ class DCMAPI(Subclass):
             else:
                 break
             data = response[obj_key]
-            output.extend(data)
+            yield data
 
             if not all:
                 break
             elif response[obj_key] and response.get("nextPageToken",0) and len(data) == 1000:
-                request = eval("self.service.{0}().list_next(request, response)".format(obj))
+                request = getattr(self.service, obj)().list_next(request, response)
             else:
                 break
+
+    def _batch(self, obj, arguments, all):
+        # Every object returned for one batch of ids, run in a worker thread
+        return [item for page in self._pages(obj, arguments, all) for item in page]
+
+    def _id_pages(self, obj, arguments, all, workers, ids_per_request):
+        # Pages of a list filtered on ids, split into requests of ids_per_request ids, in the order of the ids
+        ids = list(arguments['ids'])
+        if len(ids) <= ids_per_request:
+            batches = [arguments]
+        else:
+            batches = [dict(arguments, ids=ids[start:start + ids_per_request]) for start in range(0, len(ids), ids_per_request)]
+
+        executor = None
+        if workers > 1 and len(batches) > 1:
+            executor = ThreadPoolExecutor(max_workers=min(workers, len(batches)))
+            pages = executor.map(lambda batch: self._batch(obj, batch, all), batches)
+        else:
+            pages = (page for batch in batches for page in self._pages(obj, batch, all))
+
+        ids_recieved = set()
+        try:
+            for data in pages:
+                ids_recieved.update(int(item['id']) for item in data)
+                yield data
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        missing = self._missing_ids(ids_recieved, arguments)
+        if missing:
+            yield missing
+
+    @instrumented()
+    def list_pages(self, obj, arguments={}, all=False, workers=1, ids_per_request=IDS_PER_REQUEST):
+        """
+        Generator version of list. Yields each page of objects (list of dictionaries)
+        as soon as it is received, instead of waiting for every page.
+            - obj (string): The api object to pull from
+            - arguments (dict): Any additional arguments to pass to the list method.
+                (note: profile_id is automatically added)
+            - all (bool): Whether to make continuous api calls or just a single
+            - workers (int): Number of threads making requests. Ids are requested in batches
+                by this many threads at once, each with its own HTTP transport. Without ids, the
+                next page is fetched in the background while the current page is handled.
+            - ids_per_request (int): Ids sent in a single request. Each batch is yielded as one page
+                when several workers are used.
+        If ids are passed in the arguments, any ids not returned are yielded as a final page.
+        """
+
+        arguments["profileId"] = self.profile_id
         if 'ids' in arguments:
-            output = self._add_missing(output, arguments)
+            yield from self._id_pages(obj, arguments, all, workers, ids_per_request)
+        elif workers > 1:
+            yield from prefetch(self._pages(obj, arguments, all))
+        else:
+            yield from self._pages(obj, arguments, all)
 
         self.vprint(f"Complete. Made {self.dcm_api_calls} API call(s).")
+
+    @instrumented()
+    def list(self, obj, arguments={}, all=False, workers=1, ids_per_request=IDS_PER_REQUEST):
+        """
+        Calls the list method for the DCM Api.
+            - obj (string): The api object to pull from
+            - arguments (dict): Any additional arguments to pass to the list method.
+                (note: profile_id is automatically added)
+            - all (bool): Whether to make continuous api calls or just a single
+            - workers (int): Number of threads making requests (see list_pages)
+            - ids_per_request (int): Ids sent in a single request
+        """
+
+        output = []
+        for data in self.list_pages(obj, arguments=arguments, all=all, workers=workers, ids_per_request=ids_per_request):
+            output.extend(data)
         return output
 
+    @instrumented()
     def update(self, obj, body, arguments={}):
         """
         Calls the update method for the DCM Api.
@@ -96,9 +196,10 @@ class DCMAPI(Subclass):
         arguments["profileId"] = self.profile_id
         arguments["body"] = body
         request = eval("self.service.{0}().update(**arguments)".format(obj))
-        self.dcm_api_calls += 1
-        return request.execute()
+        self._count_calls()
+        return self._execute(request)
 
+    @instrumented()
     def insert(self, obj, body, arguments={}):
         """
         Calls the insert method for the DCM Api.
@@ -111,9 +212,10 @@ class DCMAPI(Subclass):
         arguments["profileId"] = self.profile_id
         arguments["body"] = body
         request = eval("self.service.{0}().insert(**arguments)".format(obj))
-        self.dcm_api_calls += 1
-        return request.execute()
+        self._count_calls()
+        return self._execute(request)
 
+    @instrumented()
     def get(self, obj, id, arguments={}):
         """
         Calls the get method for the DCM Api.
@@ -127,12 +229,16 @@ class DCMAPI(Subclass):
         arguments["id"] = id
         try:
             request = eval("self.service.{0}().get(**arguments)".format(obj))
-            response = request.execute()
-            self.dcm_api_calls += 1
+            self._count_calls()
+            response = self._execute(request)
             return response
-        except:
+        except HttpError as error:
+            # e.g. not found; rate limit and quota errors are raised once the retries are used up
+            if is_rate_limited(error):
+                raise
             return {'id':str(id)}
 
+    @instrumented()
     def patch(self, obj, body, params={}):
         """
         Calls the patch method for the DCM Api.
@@ -145,10 +251,113 @@ class DCMAPI(Subclass):
         params["profileId"] = self.profile_id
         params["body"] = body
         request = eval("self.service.{0}().patch(**params)".format(obj))
-        self.dcm_api_calls += 1
-        return request.execute()
+        self._count_calls()
+        return self._execute(request)
 
-    def to_df(self, obj, arguments={}, columns=None, all=False, dropna=False, method='list'):
+    def _retriable(self, error):
+        # Rate limit and server errors are worth retrying, other errors (e.g. not found) are not
+        return is_rate_limited(error) or (isinstance(error, HttpError) and int(error.resp.status) in SERVER_ERRORS)
+
+    def _run_batches(self, obj, method, calls, batch_size, retries, errors):
+        """
+        Runs the [method] call of every argument dict in calls through batch requests
+        of [batch_size] calls, and returns the response of each call (or the exception
+        it raised) in the order of calls. Calls failing with a rate limit or server
+        error are retried on their own, up to [retries] times, after their retry-after
+        or a jittered exponential backoff.
+        """
+        if errors not in ("raise", "return"):
+            raise ValueError(f"'{errors}' is not valid for errors")
+
+        results = [None] * len(calls)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = response if exception is None else exception
+
+        pending = list(range(len(calls)))
+        for attempt in range(retries + 1):
+            if attempt:
+                current_event().retries += len(pending)
+                sleep(retry_wait([results[index] for index in pending], attempt, self.limiter))
+            for start in range(0, len(pending), batch_size):
+                resource = getattr(self.service, obj)()
+                batch = self.service.new_batch_http_request()
+                chunk = pending[start:start + batch_size]
+                for index in chunk:
+                    batch.add(getattr(resource, method)(**calls[index]), callback=callback, request_id=str(index))
+                self._count_calls(len(chunk))
+                self._execute(batch, tokens=len(chunk))
+            pending = [index for index in pending if self._retriable(results[index])]
+            if not pending:
+                break
+
+        failed = [result for result in results if isinstance(result, Exception)]
+        self.vprint(f"Complete. {len(calls) - len(failed)} of {len(calls)} call(s) succeeded.")
+        if failed and errors == "raise":
+            raise failed[0]
+        return results
+
+    @instrumented()
+    def get_many(self, obj, ids, arguments={}, batch_size=BATCH_SIZE, retries=3, errors='return'):
+        """
+        Calls the get method for the DCM Api for every id, in batch requests.
+        Returns the objects in the order of the ids.
+            - obj (string): The api object to pull from
+            - ids (list): Ids of the objects
+            - arguments (dict): Any additional arguments to pass to every call. (Not Required)
+                (note: profile_id is automatically added)
+            - batch_size (int): Calls sent in a single batch request
+            - retries (int): Times the calls failing with a rate limit or server error are retried
+            - errors (string): 'return' returns the exception raised by a call (googleapiclient HttpError)
+              in place of its object; 'raise' raises the first one once every call has been made
+        """
+        calls = [dict(arguments, profileId=self.profile_id, id=obj_id) for obj_id in ids]
+        return self._run_batches(obj, 'get', calls, batch_size, retries, errors)
+
+    @instrumented()
+    def patch_many(self, obj, bodies, arguments={}, batch_size=BATCH_SIZE, retries=3, errors='return'):
+        """
+        Calls the patch method for the DCM Api for every body, in batch requests.
+        Returns the patched objects in the order of the bodies.
+            - obj (string): The api object to pull from
+            - bodies (list): The fields to patch, each with the id of its object
+            - arguments (dict): Any additional arguments to pass to every call. (Not Required)
+                (note: profile_id and id are automatically added)
+            - batch_size, retries, errors: See get_many
+        """
+        calls = [dict(arguments, profileId=self.profile_id, id=body['id'], body=body) for body in bodies]
+        return self._run_batches(obj, 'patch', calls, batch_size, retries, errors)
+
+    @instrumented()
+    def update_many(self, obj, bodies, arguments={}, batch_size=BATCH_SIZE, retries=3, errors='return'):
+        """
+        Calls the update method for the DCM Api for every body, in batch requests.
+        Returns the updated objects in the order of the bodies.
+            - obj (string): The api object to pull from
+            - bodies (list): The object bodies for which to update to dcm
+            - arguments (dict): Any additional arguments to pass to every call. (Not Required)
+                (note: profile_id is automatically added)
+            - batch_size, retries, errors: See get_many
+        """
+        calls = [dict(arguments, profileId=self.profile_id, body=body) for body in bodies]
+        return self._run_batches(obj, 'update', calls, batch_size, retries, errors)
+
+    @instrumented()
+    def insert_many(self, obj, bodies, arguments={}, batch_size=BATCH_SIZE, retries=3, errors='return'):
+        """
+        Calls the insert method for the DCM Api for every body, in batch requests.
+        Returns the inserted objects in the order of the bodies.
+            - obj (string): The api object to pull from
+            - bodies (list): The object bodies to insert to dcm
+            - arguments (dict): Any additional arguments to pass to every call. (Not Required)
+                (note: profile_id is automatically added)
+            - batch_size, retries, errors: See get_many
+        """
+        calls = [dict(arguments, profileId=self.profile_id, body=body) for body in bodies]
+        return self._run_batches(obj, 'insert', calls, batch_size, retries, errors)
+
+    @instrumented()
+    def to_df(self, obj, arguments={}, columns=None, all=False, dropna=False, method='list', flatten='unnest', chunked=False, workers=1):
         """
         Calls the list method for the DCM Api.
             - obj (string): The api object to pull from
@@ -159,68 +368,160 @@ class DCMAPI(Subclass):
             - all (bool): Whether to make continuous api calls or just a single
             - dropna (bool): Whether or not the dataframe can contain nulls
             - method (string): Which API endpoint to call. Only supports list and get.
+            - flatten (string): How to flatten the objects. Accepted values are: 'unnest','plan' (default is unnest).
+                - If 'plan' is selected, only the paths to the columns are read from the raw objects.
+            - chunked (bool): Whether to flatten each page as it is received and then combine the pages,
+                rather than holding every raw object until the last page (list only).
+            - workers (int): Number of threads making list requests (see list_pages)
         """
+        if method == 'list' and chunked:
+            return self._concat_chunks(
+                self.to_df_chunks(obj=obj, arguments=arguments, columns=columns, all=all, flatten=flatten, workers=workers),
+                columns=columns,
+            )
         if method == 'list':
-            data = self.list(obj=obj, arguments=arguments, all=all)
+            data = self.list(obj=obj, arguments=arguments, all=all, workers=workers)
         elif method == 'get':
             obj_id = arguments.pop('id')
             data = [self.get(obj=obj, id=obj_id, arguments=arguments)]
-        df = self._json_to_df(data, columns)
+        df = self._json_to_df(data, columns, flatten=flatten)
         return df
 
+    @instrumented()
+    def to_df_chunks(self, obj, arguments={}, columns=None, all=False, flatten='unnest', workers=1):
+        """
+        Generator that calls the list method for the DCM Api and yields a pandas dataframe
+        for each page, flattened as soon as the page is received.
+            - obj (string): The api object to pull from
+            - arguments (dict): Any additional arguments to pass to the list method.
+                (note: profile_id is automatically added)
+            - columns (list): Reduce each dataframe to the specified columns. Every chunk
+                will have all of these columns, in this order.
+            - all (bool): Whether to make continuous api calls or just a single
+            - flatten (string): How to flatten the objects. Accepted values are: 'unnest','plan' (default is unnest).
+            - workers (int): Number of threads making list requests (see list_pages)
+        """
+        pages = self.list_pages(obj=obj, arguments=arguments, all=all, workers=workers)
+        yield from self._json_to_df_chunks(pages, columns, flatten=flatten)
+
+    @instrumented()
+    def run_report(self, reportId):
+        """
+        Runs the report and returns the id of its file, without waiting for it to
+        finish processing (see report_status, or reagan.reports.ReportManager).
+            - reportId (string): The id of the report to run
+        """
+        report_file = self._execute(
+            self.service.reports().run(profileId=self.profile_id, reportId=reportId)
+        )
+        return report_file["id"]
+
+    @instrumented()
+    def report_status(self, reportId, fileId):
+        """
+        Returns the status of a report file: QUEUED, PROCESSING, REPORT_AVAILABLE, FAILED or CANCELLED.
+        """
+        report_file = self._execute(
+            self.service.files().get(reportId=reportId, fileId=fileId)
+        )
+        return report_file["status"]
+
+    def _wait_for_report(self, reportId, fileId):
+        # Polls the file with an exponential backoff, to conserve request quota
+        for interval in poll_intervals():
+            status = self.report_status(reportId, fileId)
+            if status == "REPORT_AVAILABLE":
+                return
+            if status in FAILED_STATUSES:
+                raise ReportFailed(f"File {fileId} of report {reportId} is {status}")
+            sleep(interval)
+
+    def _download(self, request, file):
+        # Streams the media of the request to file in chunks, on the HTTP transport of this thread
+        http = self.transports.get()
+        if http is not None:
+            request.http = http
+        downloader = MediaIoBaseDownload(file, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while not done:
+            self.limiter.acquire()
+            status, done = downloader.next_chunk(num_retries=3)
+        return file.tell()
+
+    def _report_body(self, file):
+        """
+        Positions a report file at the column header of its data, after the metadata
+        lines ending with 'Report Fields', and truncates the grand total row, so the
+        data can be parsed in a single pass. Files without the metadata are read whole;
+        a ValueError is raised if the metadata has no 'Report Fields' line.
+        """
+        file.seek(0)
+        start = None
+        first = file.readline()
+        file.seek(0)
+        for line in iter(file.readline, b""):
+            if line.rstrip(b"\r\n") == b"Report Fields":
+                start = file.tell()
+                break
+            if file.tell() > MAX_HEADER_SIZE:
+                break
+        if start is None:
+            if first.startswith(METADATA_LINES):
+                raise ValueError(f"The report file has no 'Report Fields' line in its first {MAX_HEADER_SIZE} bytes")
+            start = 0
+
+        end = file.seek(0, os.SEEK_END)
+        file.seek(max(start, end - MAX_HEADER_SIZE))
+        tail = file.read()
+        total = tail.rfind(b"\nGrand Total:")
+        if total >= 0:
+            file.truncate(end - len(tail) + total + 1)
+        file.seek(start)
+
+    @contextmanager
+    def _report_file(self, reportId, fileId, params):
+        # Spooled file of the report, positioned at its data
+        if not fileId:
+            fileId = self.run_report(reportId)
+            self._wait_for_report(reportId, fileId)
+        request = self.service.files().get_media(**dict(params, reportId=reportId, fileId=fileId))
+        with SpooledTemporaryFile(max_size=SPOOL_SIZE) as file:
+            current_event().bytes = self._download(request, file)
+            self._report_body(file)
+            yield file
+
+    @instrumented()
     def report_to_df(self, reportId, fileId = None, params={}):
         """
-        Makes a GET request to retrieve a file and returns the data in a Pandas Dataframe
+        Makes a GET request to retrieve a file and returns the data in a Pandas Dataframe.
+        The file is streamed to a temporary file (on disk above 64 MB) and parsed once,
+        without the metadata header and the grand total row.
             - reportId (string): The id of the report to pull from
-            - fildId (string): The id of the file to pull from
+            - fildId (string): The id of the file to pull from. If not given, the report is run first.
             - params (dict): Any additional arguments to pass to the GET request.
         """
+        with self._report_file(reportId, fileId, params) as file:
+            return pd.read_csv(file)
 
-        skiprows = 5
-        if not fileId:
-            skiprows = 4
-            report_file = (
-                self.service.reports()
-                .run(profileId=self.profile_id, reportId=reportId)
-                .execute()
-            )
-            fileId = report_file["id"]
-            # Wait for the report file to finish processing.
-            # An exponential backoff strategy is used to conserve request quota.
-            while True:
-                report_file = (
-                    self.service.files().get(reportId=reportId, fileId=fileId).execute()
-                )
-
-                status = report_file["status"]
-                if status == "REPORT_AVAILABLE":
-                    break
-                sleep(60)
-
-        params["reportId"] = reportId
-        params["fileId"] = fileId
-
-        request = self.service.files().get_media(**params)
-        response = request.execute()
-
-        s = str(response, "utf-8")
-        data = StringIO(s)
-
-        report_metadata = pd.read_csv(data, error_bad_lines=False, warn_bad_lines=False)
-        
-        skiprows = report_metadata.shape[0] + 4
-
-        s = str(response, "utf-8")
-        data = StringIO(s)
-        df = pd.read_csv(data, skiprows=skiprows)
-        # Remove the last row with the grand total
-        return df[:-1]
+    @instrumented()
+    def report_chunks(self, reportId, fileId = None, params={}, chunksize=100000):
+        """
+        Generator version of report_to_df, yielding the data in pandas dataframes of
+        [chunksize] rows, so reports larger than memory can be processed.
+            - reportId (string): The id of the report to pull from
+            - fildId (string): The id of the file to pull from. If not given, the report is run first.
+            - params (dict): Any additional arguments to pass to the GET request.
+            - chunksize (int): Rows per dataframe
+        """
+        with self._report_file(reportId, fileId, params) as file:
+            yield from pd.read_csv(file, chunksize=chunksize)
 
+    @instrumented()
     def set_profile_id(self, networkId):
         request = self.service.userProfiles().list()
 
         # Execute request and print response.
-        response = request.execute()
+        response = self._execute(request)
         for profile in response["items"]:
             if profile["accountId"] == str(networkId):
                 self.profile_id = profile["profileId"]
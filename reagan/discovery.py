@@ -0,0 +1,183 @@
+"""
+Discovery documents and services of the Google API connectors (DCMAPI, SA360,
+Drive, GCP), cached so a connector is built without fetching or parsing its
+discovery document again.
+"""
+from google.oauth2 import service_account
+from googleapiclient.discovery import DISCOVERY_URI, V2_DISCOVERY_URI, build_from_document
+from googleapiclient.errors import UnknownApiNameOrVersion
+from googleapiclient.http import build_http
+from threading import Lock, get_ident
+from time import time
+import os
+import uritemplate
+import warnings
+
+try:
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:
+    # Documents are not bundled before google-api-python-client 2.0
+    get_static_doc = None
+
+_lock = Lock()
+_caches = {}
+_documents = {}
+_credentials = {}
+_services = {}
+
+
+class DiscoveryCache(object):
+    """
+    Discovery documents stored on local disk, one file per API and version. A
+    stored document is used as is, so the API a connector is built with only
+    changes when the document is refreshed, and connectors are built offline.
+        - path (string): Directory of the cache (default is $REAGAN_DISCOVERY_DIR or ~/.cache/reagan/discovery)
+        - max_age (int): Seconds after which a document is fetched again. None pins documents until refresh is called.
+    """
+
+    def __init__(self, path=None, max_age=None):
+        self.path = path or os.environ.get("REAGAN_DISCOVERY_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "reagan", "discovery")
+        self.max_age = max_age
+
+    def _file(self, api, version):
+        return os.path.join(self.path, f"{api}.{version}.json")
+
+    def get(self, api, version):
+        """
+        Returns the stored document (json string) of the API version, or None if there is none or it has expired.
+        """
+        file = self._file(api, version)
+        try:
+            if self.max_age is not None and time() - os.path.getmtime(file) > self.max_age:
+                return None
+            with open(file, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, api, version, document):
+        """
+        Stores the document (json string) of the API version. If the cache cannot be
+        written (e.g. a read-only home directory), a warning is given and the document
+        is only kept in memory by discovery_document.
+        """
+        file = self._file(api, version)
+        temporary = file + f".{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Written to a temporary file first, so other processes never read part of a document
+            with open(temporary, "w", encoding="utf-8") as f:
+                f.write(document)
+            os.replace(temporary, file)
+        except OSError as e:
+            warnings.warn(f"Discovery document of {api} {version} not cached in {self.path}: {e}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def refresh(self, api, version):
+        """
+        Fetches the document of the API version again and stores it.
+        """
+        document = fetch_document(api, version)
+        self.put(api, version, document)
+        with _lock:
+            _documents[(api, version)] = document
+        return document
+
+
+def get_discovery_cache():
+    """
+    Returns the discovery cache shared by the whole process.
+    """
+    with _lock:
+        if "default" not in _caches:
+            _caches["default"] = DiscoveryCache()
+        return _caches["default"]
+
+
+def set_discovery_cache(cache):
+    """
+    Replaces the discovery cache of the process, e.g. with a DiscoveryCache in another
+    directory. Passing None resets it to the default.
+    """
+    with _lock:
+        if cache is None:
+            _caches.pop("default", None)
+        else:
+            _caches["default"] = cache
+
+
+def fetch_document(api, version):
+    """
+    Returns the discovery document of the API version: the one bundled with
+    google-api-python-client if there is one, else fetched from Google.
+    """
+    if get_static_doc is not None:
+        document = get_static_doc(api, version)
+        if document is not None:
+            return document
+    http = build_http()
+    for uri in (DISCOVERY_URI, V2_DISCOVERY_URI):
+        response, content = http.request(uritemplate.expand(uri, {"api": api, "apiVersion": version}))
+        if response.status < 400:
+            return content.decode("utf-8")
+    raise UnknownApiNameOrVersion(f"name: {api}  version: {version}")
+
+
+def discovery_document(api, version):
+    """
+    Returns the discovery document of the API version from memory, else the
+    discovery cache, else fetch_document (and stores it in the cache).
+    """
+    document = _documents.get((api, version))
+    if document is None:
+        cache = get_discovery_cache()
+        document = cache.get(api, version)
+        if document is None:
+            document = fetch_document(api, version)
+            cache.put(api, version, document)
+        with _lock:
+            document = _documents.setdefault((api, version), document)
+    return document
+
+
+def get_credentials(filepath, scopes=None):
+    """
+    Returns the credentials of a service account file, shared by the whole process.
+    """
+    key = (filepath, tuple(scopes or ()))
+    with _lock:
+        if key not in _credentials:
+            _credentials[key] = service_account.Credentials.from_service_account_file(filepath, scopes=scopes)
+        return _credentials[key]
+
+
+def build_service(api, version, credentials):
+    """
+    Returns the service of the API version for the credentials. A service is built
+    once per thread from the cached discovery document (see discovery_document),
+    then re-used by every connector created in that thread, since its HTTP
+    transport is not thread-safe.
+        - api (string): Name of the API, e.g. dfareporting
+        - version (string): Version of the API, e.g. v3.5
+        - credentials: Credentials of the service, e.g. from get_credentials
+    """
+    key = (api, version, credentials, get_ident())
+    service = _services.get(key)
+    if service is None:
+        document = discovery_document(api, version)
+        service = build_from_document(document, credentials=credentials)
+        with _lock:
+            service = _services.setdefault(key, service)
+    return service
+
+
+def clear_services():
+    """
+    Forgets the services, credentials and documents kept in memory, e.g. after a
+    service account file changed. The discovery cache on disk is kept.
+    """
+    with _lock:
+        _services.clear()
+        _credentials.clear()
+        _documents.clear()
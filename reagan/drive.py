@@ -1,5 +1,6 @@
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from reagan.discovery import build_service, get_credentials
+from reagan.instrumentation import instrumented, current_event, count_retry
+from reagan.ratelimit import execute, get_limiter
 from reagan.subclass import Subclass
 from io import BytesIO
 from retrying import retry
@@ -9,20 +10,21 @@ class Drive(Subclass):
     def __init__(self, verbose=0):
         super().__init__(verbose=verbose)
         self.service_account_filepath = self.get_parameter_value("/drive/service_account_path")
+        self.limiter = get_limiter("drive")
         self._create_service()
 
-    @retry(stop_max_attempt_number=10, wait_fixed=10000)
+    @instrumented()
+    @retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000, wait_exponential_max=60000, wait_jitter_max=1000, retry_on_exception=count_retry)
     def _create_service(self):
 
         api_name = "drive"
         api_version = "v3"
 
-        self.credentials = service_account.Credentials.from_service_account_file(
-            self.service_account_filepath
-        )
-        self.service = build(api_name, api_version, credentials=self.credentials)
+        self.credentials = get_credentials(self.service_account_filepath)
+        self.service = build_service(api_name, api_version, self.credentials)
 
     # https://levelup.gitconnected.com/google-drive-api-with-python-part-ii-connect-to-google-drive-and-search-for-file-7138422e0563
+    @instrumented()
     def retrieve_all_files(self):
         results = []
         page_token = None
@@ -34,7 +36,7 @@ class Drive(Subclass):
                 if page_token:
                     param['pageToken'] = page_token
 
-                files = self.service.files().list(**param).execute()
+                files = execute(self.service.files().list(**param), self.limiter)
                 # append the files from the current result page to our list
                 results.extend(files.get('files'))
                 # Google Drive API shows our files in multiple pages when the number of files exceed 100
@@ -52,6 +54,7 @@ class Drive(Subclass):
 
         return results
 
+    @instrumented()
     def download_file(self, file_id, path):
         
         request = self.service.files().get_media(fileId=file_id)
@@ -59,8 +62,10 @@ class Drive(Subclass):
         downloader = MediaIoBaseDownload(fh, request)
         done = False
         while done is False:
+            self.limiter.acquire()
             status, done = downloader.next_chunk()
             print("Download %d%%." % int(status.progress() * 100))
+        current_event().bytes = fh.tell()
         with open(path, 'wb') as f:
             f.write(fh.getvalue())
 
@@ -0,0 +1,197 @@
+from datetime import date, datetime
+from decimal import Decimal
+from reagan.batch import run_many
+from reagan.instrumentation import instrumented, current_event
+from reagan.pool import max_connections
+import numpy as np
+import pandas as pd
+
+# Rows fetched from the cursor at a time when no chunksize is given
+FETCH_SIZE = 10000
+
+
+def column_names(cursor):
+    """
+    Returns the names of the columns of the query the cursor has executed.
+    """
+    return [column[0] for column in cursor.description]
+
+
+def fetch_batches(cursor, chunksize=None):
+    """
+    Generator that yields lists of up to [chunksize] rows from a DB-API cursor
+    that has executed a query.
+    """
+    chunksize = chunksize or FETCH_SIZE
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        yield rows
+
+
+def _coerce(value):
+    # Decimals are returned as floats, as pandas.read_sql does
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def flatten_rows(batches):
+    """
+    Returns the values of every row of every batch in a single list, row by row.
+    """
+    output = []
+    for rows in batches:
+        output.extend([_coerce(value) for row in rows for value in row])
+    return output
+
+
+def rows_to_dict(batches):
+    """
+    Returns a dict mapping the first value of every row to its second value.
+    Later rows overwrite earlier rows with the same key.
+    """
+    output = {}
+    for rows in batches:
+        output.update((_coerce(row[0]), _coerce(row[1])) for row in rows)
+    return output
+
+
+def first_value(cursor):
+    """
+    Returns the first column of the first row fetched from the cursor as the driver
+    returns it, or None if there are no rows.
+    """
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def rows_to_frame(columns, batches):
+    """
+    Returns a dataframe of the rows of every batch, typed as pandas.read_sql types them.
+    """
+    rows = []
+    for batch in batches:
+        rows.extend(tuple(row) for row in batch)
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def frame_to_list(df):
+    """
+    Returns the values of every row of the dataframe in a single list, row by row. Values
+    are upcast to the common type of the columns (e.g. integers next to floats are floats)
+    and NULLs of numeric columns are NaN.
+    """
+    return df.values.flatten().tolist()
+
+
+def frame_to_dict(df):
+    """
+    Returns a dict mapping the first column of every row of the dataframe to its second.
+    Both are upcast to the common type of the two columns, as DataFrame.iterrows does.
+    """
+    values = df.values
+    if values.dtype != object:
+        return dict(zip(pd.Series(values[:, 0]).tolist(), pd.Series(values[:, 1]).tolist()))
+    # A row with NULLs can be typed differently from its columns, e.g. NaN next to NaT is NaT
+    return dict(pd.Series(row).tolist() if nulls else row for row, nulls in zip(values, pd.isna(values).any(axis=1)))
+
+
+def _typed(values):
+    # Returns a numpy array for the column, typed by the python types of its values
+    kinds = {type(value) for value in values} - {type(None)}
+    nulls = len(kinds) < len({type(value) for value in values})
+    if kinds == {bool} and not nulls:
+        return np.array(values, dtype=bool)
+    if kinds == {int} and not nulls:
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            return np.array(values, dtype=object)
+    if kinds and kinds <= {int, float, Decimal}:
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    if kinds and kinds <= {datetime, date} and not any(getattr(value, "tzinfo", None) for value in values):
+        return np.array(values, dtype="datetime64[ns]")
+    output = np.empty(len(values), dtype=object)
+    output[:] = values
+    return output
+
+
+def rows_to_columns(columns, batches):
+    """
+    Returns a dict mapping each column name to a numpy array of its values. Integer,
+    float, boolean and date columns are typed; NULLs make integers floats (NaN) and
+    dates NaT, as in pandas. Other columns, including timezone-aware dates (numpy
+    has no timezones), are object arrays.
+        - columns (list): Names of the columns, in the order of the row values
+        - batches (iterable): Lists of rows, e.g. from fetch_batches
+    """
+    values = [[] for column in columns]
+    for rows in batches:
+        for index, column in enumerate(zip(*rows)):
+            values[index].extend(column)
+    return {column: _typed(column_values) for column, column_values in zip(columns, values)}
+
+
+class SQLConnector(object):
+    """
+    Methods shared by the SQL connectors (PSQL and SQLServer), which have a SQLAlchemy
+    engine, a server alias, a result_cache, and _fetch and _execute_statement methods.
+        - cache_prefix (string): Prefix of the server's alias in the result cache, e.g. postgres
+    """
+
+    cache_prefix = None
+
+    @property
+    def _cache_alias(self):
+        return f"{self.cache_prefix}/{self.server}"
+
+    def _invalidate(self, tables):
+        # Removes the cached results read from tables this instance has written to
+        if self.result_cache is not None:
+            for table in tables:
+                self.result_cache.invalidate(table, alias=self._cache_alias)
+
+    def _max_workers(self, workers):
+        limit = max_connections(self.engine)
+        return min(workers, limit) if limit else workers
+
+    @instrumented()
+    def to_columns(self, query, replacements={}, chunksize=None, params=None):
+        """
+        Executes query and returns a dict mapping each column name to a numpy array of its
+        values, built from the cursor without a dataframe (see reagan.fetch.rows_to_columns).
+            - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - chunksize (int): Number of rows fetched from the cursor at a time
+            - params (list or dict): Values bound to the placeholders of the query
+        """
+        query = self._format_query(query, replacements)
+        output = self._fetch(
+            query, lambda cursor: rows_to_columns(column_names(cursor), fetch_batches(cursor, chunksize)), params
+        )
+        current_event().rows = len(next(iter(output.values()), []))
+        return output
+
+    @instrumented()
+    def to_df_many(self, queries, replacements={}, workers=4, errors="raise"):
+        """
+        Runs the queries concurrently over the connection pool and returns a dict of
+        name to pandas dataframe (see reagan.batch.run_many).
+            - queries (dict or list): Queries or .sql files, by name. A list is named after the
+              .sql files (query_0, query_1... for other queries). A query can be a dict of
+              arguments to to_df, e.g. {'query': ..., 'params': [...]}.
+            - replacements (dict): Modifies every query and replaces any instance of [key] with [value]
+            - workers (int): Maximum number of queries run at once, at most the size of the pool
+            - errors (string): 'raise' raises the first error; 'return' returns the exception
+              raised by a query in place of its dataframe
+        """
+        return run_many(self.to_df, queries, self._max_workers(workers), errors, replacements=replacements)
+
+    @instrumented()
+    def execute_many(self, queries, replacements={}, workers=4, errors="raise"):
+        """
+        Executes the statements concurrently over the connection pool and returns a dict
+        of name to None, or to the exception raised if errors is 'return' (see to_df_many).
+        A failed statement raises its error.
+        """
+        return run_many(self._execute_statement, queries, self._max_workers(workers), errors, replacements=replacements)
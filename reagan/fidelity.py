@@ -1,3 +1,4 @@
+from reagan.instrumentation import instrumented
 from reagan.subclass import Subclass
 import datetime as dt
 import pandas as pd
@@ -47,6 +48,7 @@ class Fidelity(Subclass):
         df.date = df.index
         return df
 
+    @instrumented()
     def pull_data(self, symbol):
 
         url = self.base_url + symbol.upper()
@@ -1,24 +1,29 @@
+from reagan.instrumentation import instrumented
+from reagan.ratelimit import execute, get_limiter
 from reagan.subclass import Subclass
-from googleapiclient import discovery
-from google.oauth2 import service_account
+from reagan.discovery import build_service, get_credentials
 
 
 class GCP(Subclass):
     def __init__(self, verbose=0):
         super().__init__(verbose=verbose)
+        self.get_parameters(
+            ["/gcp/service_account_path", "/gcp/project", "/gcp/region", "/gcp/zone"]
+        )
         self.service_account_filepath = self.get_parameter_value("/gcp/service_account_path")
         self.project = self.get_parameter_value("/gcp/project")
         self.region = self.get_parameter_value("/gcp/region")
         self.zone = self.get_parameter_value("/gcp/zone")
+        self.limiter = get_limiter("compute")
         self._create_compute()
 
+    @instrumented()
     def _create_compute(self):
         SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
-        credentials = service_account.Credentials.from_service_account_file(
-            self.service_account_filepath, scopes=SCOPES
-        )
-        self.compute = discovery.build("compute", "v1", credentials=credentials)
+        credentials = get_credentials(self.service_account_filepath, scopes=SCOPES)
+        self.compute = build_service("compute", "v1", credentials)
 
+    @instrumented()
     def create_instance(
         self, name, machine_type, source_disk_image, startup_script=None
     ):
@@ -79,22 +84,23 @@ class GCP(Subclass):
                 ]
             }
 
-        return (
-            self.compute.instances()
-            .insert(project=self.project, zone=self.zone, body=body)
-            .execute()
+        return execute(
+            self.compute.instances().insert(project=self.project, zone=self.zone, body=body),
+            self.limiter,
         )
 
+    @instrumented()
     def list_to_df(self):
         request = self.compute.instances().list(project=self.project, zone=self.zone)
-        response = request.execute()
+        response = execute(request, self.limiter)
         return self._json_to_df(response.get('items'))
 
+    @instrumented()
     def delete_instance(self, name):
-        return self.compute.instances().delete(
-            project=self.project,
-            zone=self.zone,
-            instance=name).execute()
+        return execute(
+            self.compute.instances().delete(project=self.project, zone=self.zone, instance=name),
+            self.limiter,
+        )
 
 if __name__ == "__main__":
     gcp = GCP()
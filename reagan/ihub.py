@@ -1,3 +1,4 @@
+from reagan.instrumentation import instrumented
 from reagan.subclass import Subclass
 import requests
 from bs4 import BeautifulSoup
@@ -12,6 +13,7 @@ class Ihub(Subclass):
             "User-Agent": 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
         }
 
+    @instrumented()
     def page_response(self, message_id, timeout = 60):
         '''
         Use the requests and beautifulsoup modules to make the request to the website
@@ -21,6 +23,7 @@ class Ihub(Subclass):
         r = requests.get(url=url, timeout=timeout, headers=self.headers, params = payload)
         return BeautifulSoup(r.content, "lxml")
 
+    @instrumented()
     def get_message_data(self, message_id):
         """ Web scrapes post information from the specified message_id
 
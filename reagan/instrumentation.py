@@ -0,0 +1,333 @@
+from collections import deque
+from contextvars import ContextVar
+from functools import wraps
+from inspect import isgenerator, iscoroutinefunction, isgeneratorfunction
+from threading import Lock
+from time import perf_counter, time
+import random
+import warnings
+import weakref
+import numpy as np
+import pandas as pd
+
+# Hooks that receive the events of every connector in the process
+_hooks = []
+_hooks_lock = Lock()
+
+# Events of the instrumented calls running, per thread and per asyncio task
+_stack = ContextVar("reagan_events", default=())
+
+
+class Event(object):
+    """
+    A single connector call, passed to hooks when it starts and when it ends.
+        - connector (string): Class name of the connector, e.g. SQLServer
+        - operation (string): Name of the method called, e.g. to_df
+        - started (float): Unix time the call started
+        - duration (float): Seconds the call took (set when it ends)
+        - rows (int): Rows returned or written, if known
+        - bytes (int): Bytes transferred, if known
+        - retries (int): Number of retried attempts
+        - wait (float): Seconds spent waiting for a pooled connection
+        - cache_hits (int): Results read from the result cache
+        - cache_misses (int): Results not found in the result cache
+        - error (Exception): The exception raised by the call, if any
+    """
+
+    def __init__(self, connector, operation):
+        self.connector = connector
+        self.operation = operation
+        self.started = time()
+        self.duration = None
+        self.rows = None
+        self.bytes = None
+        self.retries = 0
+        self.wait = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.error = None
+        self._start = perf_counter()
+
+    @property
+    def name(self):
+        return f"{self.connector}.{self.operation}"
+
+    def __repr__(self):
+        return f"Event({self.name}, duration={self.duration}, rows={self.rows}, error={self.error!r})"
+
+
+class Hook(object):
+    """
+    Base class for instrumentation hooks. Override on_start and/or on_end,
+    then register the hook with add_hook (every connector) or
+    Subclass.add_hook (a single instance).
+    """
+
+    def on_start(self, event):
+        pass
+
+    def on_end(self, event):
+        pass
+
+
+class OperationMetrics(object):
+    """
+    Totals of the events of one operation, with a fixed-size random sample
+    (reservoir) of their durations for the percentiles.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.wait = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.durations = []
+
+    def add(self, event):
+        self.calls += 1
+        self.errors += event.error is not None
+        self.retries += event.retries
+        self.wait += event.wait
+        self.cache_hits += event.cache_hits
+        self.cache_misses += event.cache_misses
+        self.total += event.duration
+        self.max = max(self.max, event.duration)
+        self.rows += event.rows or 0
+        self.bytes += event.bytes or 0
+        if len(self.durations) < self.samples:
+            self.durations.append(event.duration)
+        else:
+            # Every duration so far has the same chance of being in the sample
+            index = random.randrange(self.calls)
+            if index < self.samples:
+                self.durations[index] = event.duration
+
+
+class MetricsAggregator(Hook):
+    """
+    Hook that reports latency percentiles, rows, bytes, retries, connection waits,
+    cache hits and errors per operation. Memory stays bounded in long-running jobs:
+    only totals and a sample of durations are kept per operation, and the last errors as strings.
+        - samples (int): Durations kept per operation for the percentiles
+        - max_errors (int): Number of recent errors kept in errors
+    """
+
+    def __init__(self, samples=1000, max_errors=100):
+        self._lock = Lock()
+        self.samples = samples
+        self.max_errors = max_errors
+        self.operations = {}
+        self.errors = deque(maxlen=max_errors)
+
+    def on_end(self, event):
+        with self._lock:
+            if event.name not in self.operations:
+                self.operations[event.name] = OperationMetrics(self.samples)
+            self.operations[event.name].add(event)
+            if event.error is not None:
+                self.errors.append((event.name, repr(event.error)))
+
+    def clear(self):
+        with self._lock:
+            self.operations = {}
+            self.errors = deque(maxlen=self.max_errors)
+
+    def report(self):
+        """
+        Returns a pandas dataframe with one row per operation (connector.method),
+        ordered by total time spent.
+        """
+        rows = []
+        with self._lock:
+            for name, metrics in self.operations.items():
+                durations = np.array(metrics.durations)
+                rows.append(
+                    {
+                        "operation": name,
+                        "calls": metrics.calls,
+                        "errors": metrics.errors,
+                        "retries": metrics.retries,
+                        "wait": metrics.wait,
+                        "cache_hits": metrics.cache_hits,
+                        "cache_misses": metrics.cache_misses,
+                        "total": metrics.total,
+                        "mean": metrics.total / metrics.calls,
+                        "p50": np.percentile(durations, 50),
+                        "p95": np.percentile(durations, 95),
+                        "p99": np.percentile(durations, 99),
+                        "max": metrics.max,
+                        "rows": metrics.rows,
+                        "bytes": metrics.bytes,
+                    }
+                )
+        columns = ["operation", "calls", "errors", "retries", "wait", "cache_hits", "cache_misses", "total", "mean", "p50", "p95", "p99", "max", "rows", "bytes"]
+        df = pd.DataFrame(rows, columns=columns)
+        return df.sort_values("total", ascending=False).reset_index(drop=True)
+
+
+def add_hook(hook):
+    """
+    Registers a hook that receives the events of every connector in the process.
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+def current_event():
+    """
+    Returns the event of the instrumented call running in this thread, so
+    the call can add details such as bytes or retries. None if there is none.
+    """
+    stack = _stack.get()
+    return stack[-1] if stack else None
+
+
+def count_retry(exception):
+    """
+    Use as retry_on_exception for retrying.retry, to count retries on the current event.
+    """
+    event = current_event()
+    if event is not None:
+        event.retries += 1
+    return True
+
+
+def _dispatch(instance, method, event):
+    hooks = list(_hooks) + list(getattr(instance, "hooks", []))
+    for hook in hooks:
+        try:
+            getattr(hook, method)(event)
+        except Exception as e:
+            warnings.warn(f"Instrumentation hook {hook!r} failed: {e!r}")
+
+
+def _count(event, result):
+    if isinstance(result, bytes):
+        event.bytes = (event.bytes or 0) + len(result)
+    elif isinstance(result, (pd.DataFrame, list)):
+        event.rows = (event.rows or 0) + len(result)
+
+
+def _run(event, func, *args, **kwargs):
+    # Runs func with the event as the current event of this thread
+    token = _stack.set(_stack.get() + (event,))
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _stack.reset(token)
+
+
+def _finish(instance, event, error=None):
+    event.duration = perf_counter() - event._start
+    event.error = error
+    _dispatch(instance, "on_end", event)
+
+
+def _iterate(instance, event, generator):
+    # Yields the chunks of the generator with the event as the current event, and ends the event with it
+    try:
+        while True:
+            try:
+                chunk = _run(event, next, generator)
+            except StopIteration:
+                break
+            _count(event, chunk)
+            yield chunk
+    except GeneratorExit:
+        _run(event, generator.close)
+        _finish(instance, event)
+        raise
+    except BaseException as e:
+        _finish(instance, event, e)
+        raise
+    _finish(instance, event)
+
+
+def _abandon(instance, event, generator):
+    # Ends the event of a returned generator dropped before it finished, e.g. never iterated
+    if event.duration is None:
+        _run(event, generator.close)
+        _finish(instance, event)
+
+
+def instrumented(operation=None):
+    """
+    Decorator for connector methods that sends start and end events to the
+    registered hooks. Rows (dataframes and lists) and bytes returned
+    are counted automatically. Generators, and methods returning a generator,
+    produce a single event lasting until the last chunk, with the rows of
+    every chunk. A generator closed or garbage collected before its last chunk
+    ends its event then, including one returned but never iterated (a generator
+    function that is never iterated does not start an event). Coroutines produce
+    an event lasting until they return.
+        - operation (string): Name of the operation (default is the method name)
+    """
+
+    def decorator(func):
+        name = operation or func.__name__
+
+        if isgeneratorfunction(func):
+
+            @wraps(func)
+            def generator_wrapper(self, *args, **kwargs):
+                event = Event(type(self).__name__, name)
+                _dispatch(self, "on_start", event)
+                yield from _iterate(self, event, func(self, *args, **kwargs))
+
+            return generator_wrapper
+
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def coroutine_wrapper(self, *args, **kwargs):
+                event = Event(type(self).__name__, name)
+                _dispatch(self, "on_start", event)
+                token = _stack.set(_stack.get() + (event,))
+                try:
+                    result = await func(self, *args, **kwargs)
+                except BaseException as e:
+                    _finish(self, event, e)
+                    raise
+                finally:
+                    _stack.reset(token)
+                _count(event, result)
+                _finish(self, event)
+                return result
+
+            return coroutine_wrapper
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            event = Event(type(self).__name__, name)
+            _dispatch(self, "on_start", event)
+            try:
+                result = _run(event, func, self, *args, **kwargs)
+            except BaseException as e:
+                _finish(self, event, e)
+                raise
+            if isgenerator(result):
+                # e.g. to_df(chunksize=...): the event lasts until the chunks are read
+                chunks = _iterate(self, event, result)
+                weakref.finalize(chunks, _abandon, self, event, result)
+                return chunks
+            _count(event, result)
+            _finish(self, event)
+            return result
+
+        return wrapper
+
+    return decorator
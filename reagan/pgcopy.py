@@ -0,0 +1,276 @@
+"""
+Encoding of dataframes for Postgres COPY ... FROM STDIN, streamed in chunks
+so the whole file is never held in memory.
+"""
+import io
+import struct
+import numpy as np
+import pandas as pd
+
+# Start of a binary COPY file: signature, flags and header extension length
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+BINARY_TRAILER = struct.pack(">h", -1)
+NULL = struct.pack(">i", -1)
+
+# Postgres timestamps are microseconds since 2000-01-01, and dates days since then
+_EPOCH = np.datetime64("2000-01-01", "us").astype(np.int64)
+_EPOCH_DAYS = np.datetime64("2000-01-01", "D").astype(np.int64)
+
+
+class CopyStream(object):
+    """
+    File-like object that reads the bytes of an iterable of chunks, for cursor.copy_expert.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.offset = 0
+        self.bytes = 0
+
+    def read(self, size=-1):
+        while self.offset >= len(self.buffer):
+            self.buffer = next(self.chunks, None)
+            self.offset = 0
+            if self.buffer is None:
+                self.buffer = b""
+                return b""
+        end = len(self.buffer) if size is None or size < 0 else self.offset + size
+        data = self.buffer[self.offset : end]
+        self.offset += len(data)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def csv_chunks(df, chunksize, types=None):
+    """
+    Generator that yields every [chunksize] rows of df as CSV bytes, with NULLs written
+    as \\N. Use with COPY ... WITH (FORMAT csv, NULL '\\N').
+        - types (list): Postgres type of the table column of every dataframe column (see binary_compatible).
+          Integral floats bound for integer columns (integers with NULLs) are written as integers.
+    """
+    integers = integral_columns(df, types)
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start : start + chunksize]
+        if integers:
+            chunk = chunk.astype({col: "Int64" for col in integers})
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, header=False, index=False, na_rep="\\N")
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _fixed_fields(values, dtype, nulls):
+    # Length prefixed fields of a fixed width type, from one numpy conversion of the column
+    size = np.dtype(dtype).itemsize
+    fields = np.empty(len(values), dtype=[("length", ">i4"), ("value", dtype)])
+    fields["length"] = size
+    fields["value"] = values
+    data = fields.tobytes()
+    width = size + 4
+    output = [data[i : i + width] for i in range(0, len(data), width)]
+    for index in np.flatnonzero(nulls):
+        output[index] = NULL
+    return output
+
+
+# Numpy type of the value of each Postgres type sent in binary COPY (as named by regtype)
+BINARY_TYPES = {
+    "boolean": ">u1",
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double precision": ">f8",
+    "timestamp without time zone": ">i8",
+    "timestamp with time zone": ">i8",
+    "date": ">i4",
+}
+TEXT_TYPES = ("text", "character varying", "character")
+_INTEGER_TYPES = ("smallint", "integer", "bigint")
+_FLOAT_TYPES = ("real", "double precision")
+
+
+def _fits(series, column_type):
+    # Whether the non-null numbers of the column are integers in the range of the integer type
+    values = series.dropna().values
+    if not len(values):
+        return True
+    if pd.api.types.is_float_dtype(series) and not np.all(np.mod(values, 1) == 0):
+        return False
+    limits = np.iinfo(np.dtype(BINARY_TYPES[column_type]))
+    return limits.min <= values.min() and values.max() <= limits.max
+
+
+def integral_columns(df, types):
+    """
+    Returns the float columns of df bound for integer table columns whose values are all
+    integers, e.g. integers with NULLs, which pandas keeps as floats.
+        - types (list): Postgres type of the table column of every dataframe column (see binary_compatible)
+    """
+    return [
+        col
+        for col, column_type in zip(df.columns, types or [])
+        if column_type in _INTEGER_TYPES and pd.api.types.is_float_dtype(df[col]) and _fits(df[col], column_type)
+    ]
+
+
+def copy_records(df, types=None):
+    """
+    Returns the rows of df as tuples of Python values, for asyncpg's copy_records_to_table:
+    NULLs (NaN, NaT) are None, and the values of integral_columns are ints.
+    """
+    df = df.astype({col: "Int64" for col in integral_columns(df, types)})
+    values = df.astype(object)
+    return list(values.where(values.notnull(), None).itertuples(index=False, name=None))
+
+
+def binary_compatible(series, column_type):
+    """
+    Returns whether the column can be sent in binary COPY to a table column of the Postgres
+    type (e.g. integer, as given by regtype). Binary values must have the exact width of
+    the column's type, so e.g. fractional floats cannot be sent to an integer column.
+    """
+    if pd.api.types.is_bool_dtype(series):
+        return column_type == "boolean"
+    if pd.api.types.is_integer_dtype(series) or pd.api.types.is_float_dtype(series):
+        if column_type in _INTEGER_TYPES:
+            return _fits(series, column_type)
+        return column_type in _FLOAT_TYPES
+    if pd.api.types.is_datetime64tz_dtype(series):
+        return column_type == "timestamp with time zone"
+    if pd.api.types.is_datetime64_dtype(series):
+        return column_type in ("timestamp without time zone", "date")
+    if column_type == "boolean":
+        # e.g. booleans with NULLs, an object column
+        return pd.api.types.infer_dtype(series, skipna=True) in ("boolean", "empty")
+    return column_type in TEXT_TYPES
+
+
+def binary_fields(series, column_type=None):
+    """
+    Returns the binary COPY fields (length and value) of every value in the column, for a
+    table column of the Postgres type (see binary_compatible). The default type is pg_type's.
+    """
+    column_type = column_type or pg_type(series).lower()
+    nulls = series.isna().values
+    if column_type in TEXT_TYPES:
+        output = []
+        for value, null in zip(series.values, nulls):
+            if null:
+                output.append(NULL)
+            else:
+                data = str(value).encode("utf-8")
+                output.append(struct.pack(">i", len(data)) + data)
+        return output
+    if pd.api.types.is_datetime64tz_dtype(series):
+        series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+    if pd.api.types.is_datetime64_dtype(series):
+        if column_type == "date":
+            days = series.values.astype("datetime64[D]").astype(np.int64) - _EPOCH_DAYS
+            return _fixed_fields(days, ">i4", nulls)
+        micros = series.values.astype("datetime64[us]").astype(np.int64) - _EPOCH
+        return _fixed_fields(micros, ">i8", nulls)
+    dtype = BINARY_TYPES[column_type]
+    values = series.where(~nulls, 0).values if nulls.any() else series.values
+    return _fixed_fields(values.astype(np.dtype(dtype).newbyteorder("=")), dtype, nulls)
+
+
+def binary_chunks(df, chunksize, types=None):
+    """
+    Generator that yields a binary COPY file of df: the header, every [chunksize]
+    rows, then the trailer. Use with COPY ... WITH (FORMAT binary).
+        - types (list): Postgres type of the table column of every dataframe column (see binary_compatible).
+          The default is the type pg_type gives each column.
+    """
+    yield BINARY_HEADER
+    count = struct.pack(">h", len(df.columns))
+    types = types or [None] * len(df.columns)
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start : start + chunksize]
+        columns = [binary_fields(chunk.iloc[:, i], types[i]) for i in range(len(chunk.columns))]
+        yield b"".join(count + b"".join(fields) for fields in zip(*columns))
+    yield BINARY_TRAILER
+
+
+# Type OIDs of the columns COPY TO STDOUT sends as text, by the pandas type read_sql gives them
+_INTEGERS = {20, 21, 23, 26}
+_FLOATS = {700, 701, 1700}
+_DATES = {1082, 1114, 1184}
+_BOOLEANS = {16}
+
+
+def csv_options(description, dtype=None):
+    """
+    Returns the pandas.read_csv arguments that read the CSV of COPY ... TO STDOUT
+    WITH (FORMAT csv, HEADER true, NULL '\\N') into the dtypes read_sql gives,
+    from the cursor description of the query.
+        - dtype (dict): Column dtypes overriding the ones from the description
+    """
+    types = {}
+    dates = []
+    for column in description:
+        name, oid = column[0], column[1]
+        if oid in _INTEGERS:
+            continue
+        elif oid in _FLOATS:
+            types[name] = "float64"
+        elif oid in _DATES:
+            dates.append(name)
+        else:
+            # Text is kept as is, e.g. leading zeros
+            types[name] = "object"
+    dtype = dtype or {}
+    types.update(dtype)
+    return {
+        "dtype": types,
+        "parse_dates": [name for name in dates if name not in dtype],
+        "na_values": ["\\N"],
+        "keep_default_na": False,
+    }
+
+
+def convert_booleans(df, description):
+    """
+    Converts the boolean columns of a dataframe read with csv_options from t/f to True/False.
+    """
+    for column in description:
+        if column[1] in _BOOLEANS and column[0] in df.columns:
+            df[column[0]] = df[column[0]].map({"t": True, "f": False})
+    return df
+
+
+def pg_type(series):
+    """
+    Returns the Postgres type pandas.to_sql gives a dataframe column.
+    """
+    if pd.api.types.is_bool_dtype(series):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(series):
+        if series.dtype.name.lower() in ("int8", "uint8", "int16"):
+            return "SMALLINT"
+        if series.dtype.name.lower() in ("uint16", "int32"):
+            return "INTEGER"
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(series):
+        return "REAL" if series.dtype.name.lower() == "float32" else "DOUBLE PRECISION"
+    if pd.api.types.is_datetime64tz_dtype(series):
+        return "TIMESTAMP WITH TIME ZONE"
+    if pd.api.types.is_datetime64_dtype(series):
+        return "TIMESTAMP WITHOUT TIME ZONE"
+    if pd.api.types.infer_dtype(series, skipna=True) == "boolean":
+        return "BOOLEAN"
+    return "TEXT"
+
+
+def upsert_statement(target, stage, columns, keys):
+    """
+    Returns the statement that inserts the staging table into the target, updating the rows whose keys conflict.
+    """
+    column_list = ", ".join(f'"{col}"' for col in columns)
+    conflict = ", ".join(f'"{key}"' for key in keys)
+    updates = ", ".join(f'"{col}" = EXCLUDED."{col}"' for col in columns if col not in keys)
+    action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    return f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {stage} ON CONFLICT ({conflict}) {action}"
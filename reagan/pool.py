@@ -0,0 +1,131 @@
+from threading import Lock
+from time import perf_counter
+from reagan.instrumentation import current_event
+from sqlalchemy.pool import QueuePool
+import sqlalchemy
+import warnings
+
+# Maximum number of open connections of an engine when none is given
+POOL_SIZE = 10
+
+_engines_lock = Lock()
+_engines = {}
+
+
+class TimedQueuePool(QueuePool):
+    """
+    SQLAlchemy QueuePool that records how long each checkout waited for a
+    connection, and adds the wait to the current instrumentation event.
+    """
+
+    def _stats(self):
+        if "_wait_stats" not in self.__dict__:
+            self.__dict__["_wait_stats"] = {
+                "lock": Lock(),
+                "checkouts": 0,
+                "waits": 0,
+                "wait_seconds": 0.0,
+                "max_wait_seconds": 0.0,
+                "peak_checked_out": 0,
+            }
+        return self.__dict__["_wait_stats"]
+
+    def _do_get(self):
+        start = perf_counter()
+        connection = super()._do_get()
+        wait = perf_counter() - start
+
+        stats = self._stats()
+        with stats["lock"]:
+            stats["checkouts"] += 1
+            stats["wait_seconds"] += wait
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+            # Waits under a millisecond are the cost of the checkout itself
+            if wait > 0.001:
+                stats["waits"] += 1
+            stats["peak_checked_out"] = max(stats["peak_checked_out"], self.checkedout())
+
+        event = current_event()
+        if event is not None:
+            event.wait += wait
+        return connection
+
+
+def get_engine(key, url, pool_size=None, timeout=30, recycle=3600, **kwargs):
+    """
+    Returns the SQLAlchemy engine for the key (e.g. the server alias), shared by
+    the whole process. Its pool is used for raw DB-API connections too, so every
+    instance shares one bounded set of connections.
+        - key (string): Identifies the database, e.g. sqlserver/102
+        - url (string): SQLAlchemy connection url. If it changed, the previous engine's pool is closed.
+        - pool_size (int): Maximum number of open connections (default is POOL_SIZE). Set when the
+          engine is created; a different size for an existing engine is ignored with a warning.
+        - timeout (int): Seconds to wait for a connection before raising an error
+        - recycle (int): Seconds after which a connection is replaced
+    Health checks run on every checkout (pool_pre_ping), replacing dead connections.
+    """
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None and str(engine.url) != str(sqlalchemy.engine.make_url(url)):
+            engine.dispose()
+            engine = None
+        if engine is not None and pool_size is not None and pool_size != engine.pool.size():
+            warnings.warn(f"The pool of {key} already has {engine.pool.size()} connections, pool_size={pool_size} is ignored")
+        if engine is None:
+            engine = sqlalchemy.create_engine(
+                url,
+                poolclass=TimedQueuePool,
+                pool_size=pool_size or POOL_SIZE,
+                max_overflow=0,
+                pool_timeout=timeout,
+                pool_recycle=recycle,
+                pool_pre_ping=True,
+                **kwargs,
+            )
+            _engines[key] = engine
+        return engine
+
+
+def dispose_engines():
+    """
+    Closes every pooled connection in the process, e.g. after forking.
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def max_connections(engine):
+    """
+    Returns the maximum number of connections in the engine's pool, or None if it is not bounded.
+    """
+    pool = engine.pool
+    return pool.size() + max(pool._max_overflow, 0) if isinstance(pool, QueuePool) else None
+
+
+def pool_stats(engine):
+    """
+    Returns a dict describing the engine's pool: its size, connections checked
+    out and idle, utilisation (checked out / size), and checkout wait times.
+    """
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "utilisation": pool.checkedout() / pool.size() if pool.size() else None,
+            }
+        )
+    if isinstance(pool, TimedQueuePool):
+        wait_stats = pool._stats()
+        with wait_stats["lock"]:
+            stats.update({k: v for k, v in wait_stats.items() if k != "lock"})
+        stats["mean_wait_seconds"] = (
+            stats["wait_seconds"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        )
+        stats["peak_utilisation"] = stats["peak_checked_out"] / pool.size() if pool.size() else None
+    return stats
@@ -1,15 +1,41 @@
 #!/usr/bin/python
+from contextlib import contextmanager
+from threading import Lock, Thread
+from reagan.cache import query_tables
+from reagan.fetch import SQLConnector, column_names, fetch_batches, first_value, flatten_rows, frame_to_dict, frame_to_list, rows_to_dict, rows_to_frame
+from reagan.instrumentation import instrumented, current_event
+from reagan.pgcopy import CopyStream, binary_chunks, binary_compatible, convert_booleans, csv_chunks, csv_options, pg_type, upsert_statement
+from reagan.statements import ordered, preparable, statement_cache, statement_name, to_numbered
 from reagan.subclass import Subclass
 from sqlalchemy import create_engine
 import pandas as pd
+import os
+import re
+import uuid
+import warnings
 import psycopg2
+import psycopg2.extras
 
-class PSQL(Subclass):
+def _deallocate(statement, conn):
+    # Releases a statement evicted from the cache of the connection checked out
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DEALLOCATE {statement[0]}")
+    finally:
+        cursor.close()
 
-    def __init__(self, server, verbose=0):
+
+class PSQL(SQLConnector, Subclass):
+    cache_prefix = "postgres"
+
+    def __init__(self, server, verbose=0, cache=None):
+        '''
+            - cache (ResultCache): Caches the results of to_df on local disk (see reagan.cache)
+        '''
         super().__init__()
         self.verbose = verbose
         self.server = server
+        self.result_cache = cache
         self.connection_string = eval(self.get_parameter_value(f"/postgres/{self.server}"))
         self._connect_to_database(self.connection_string)
 
@@ -21,70 +47,443 @@ class PSQL(Subclass):
 
         self.conn = create_engine('''{engine}+psycopg2://{user}:{password}@{host}:{port}/{dbname}'''.format(**connection), connect_args={'sslmode':'prefer'})
 
-    def to_df(self,query_input,replacements={}):
+    @instrumented()
+    def to_df(self,query_input,replacements={},params=None,method=None,chunksize=None):
         '''
         Takes in a string containing either a correctly formatted SQL
         query, or filepath directed to a .sql file. Returns a pandas DataFrame
         of the executed query.
+            - params (list or dict): Values bound to the %s or %(name)s placeholders of the query.
+              The statement is prepared once per connection and re-used for other values.
+            - method (string): Set to 'copy' to export the results with COPY TO STDOUT (see copy_to_df)
+            - chunksize (int): If given, returns a generator of dataframes of [chunksize] rows
+              (see to_df_chunks, or copy_to_df for the copy method)
         '''
 
+        if method == 'copy' and params is not None:
+            raise ValueError("params cannot be bound to queries run with the copy method")
+        if chunksize:
+            if method == 'copy':
+                return self.copy_to_df(query_input, replacements=replacements, chunksize=chunksize)
+            return self.to_df_chunks(query_input, replacements=replacements, chunksize=chunksize, params=params)
         query = self._format_query(query_input,replacements)
         if self.verbose:
             print ('Executing Query:\n\n',format(query,reindent=True,keyword_case='upper'))
+        if self.result_cache is not None:
+            return self.result_cache.fetch(self._cache_alias, query, lambda: self._read(query, params, method), params)
+        return self._read(query, params, method)
+
+    def _read(self, query, params=None, method=None):
+        if method == 'copy':
+            return self.copy_to_df(query)
+        if params is not None:
+            return self._fetch(query, self._records, params)
         return pd.read_sql(query,self.conn)
 
-    def to_dict(self, schema, table, key, value):
+    @instrumented()
+    def to_df_chunks(self, query, replacements={}, chunksize=100000, itersize=None, params=None):
+        """
+        Executes query on a server-side (named) cursor and returns a generator that yields
+        pandas dataframes of [chunksize] rows. Rows stay on the server until fetched, so
+        results of any size are read in constant memory.
+            - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - chunksize (int): Number of rows in each dataframe
+            - itersize (int): Number of rows fetched from the server at a time (default is chunksize)
+            - params (list or dict): Values bound to the placeholders of the query
+        """
+        query = self._format_query(query, replacements)
+        itersize = itersize or chunksize
+        with self._connection() as conn:
+            if self.conn.driver == "psycopg2":
+                cursor = conn.cursor(name=f"reagan_{uuid.uuid4().hex[:12]}")
+                cursor.itersize = itersize
+            else:
+                cursor = conn.cursor()
+            try:
+                if params is None:
+                    cursor.execute(query)
+                else:
+                    cursor.execute(query, params)
+                rows = []
+                columns = None
+                for batch in fetch_batches(cursor, itersize):
+                    # The description of a named cursor is known once rows are fetched
+                    columns = columns or column_names(cursor)
+                    rows.extend(batch)
+                    while len(rows) >= chunksize:
+                        yield pd.DataFrame.from_records(rows[:chunksize], columns=columns, coerce_float=True)
+                        del rows[:chunksize]
+                if rows:
+                    yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+            finally:
+                cursor.close()
+                conn.rollback()
+
+    @contextmanager
+    def _copy_out(self, query):
+        """
+        Yields a file object reading the CSV of the query's results, written by
+        COPY TO STDOUT in another thread as the server sends it. If the results were
+        not all read, the query is cancelled, and the thread and its connection are
+        released before returning.
+        """
+        read_fd, write_fd = os.pipe()
+        reader, writer = os.fdopen(read_fd, "rb"), os.fdopen(write_fd, "wb")
+        errors = []
+        lock = Lock()
+        # conn is the connection while it is copying, to cancel the copy with
+        state = {"conn": None, "finished": False, "stopped": False}
+
+        def copy():
+            try:
+                with self._connection() as conn:
+                    with lock:
+                        if state["stopped"]:
+                            return
+                        state["conn"] = conn
+                    try:
+                        cursor = conn.cursor()
+                        try:
+                            cursor.copy_expert(f"COPY (\n{query}\n) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '\\N')", writer)
+                        except OSError:
+                            # The reader was closed (pandas closes it when its chunks are), so the rest of the
+                            # results are not read: without cancelling, the server would still send them all
+                            conn.cancel()
+                            raise
+                        finally:
+                            cursor.close()
+                    finally:
+                        with lock:
+                            state["conn"] = None
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with lock:
+                    state["finished"] = True
+                try:
+                    writer.close()
+                except OSError:
+                    # The reader was closed before the end of the results
+                    pass
+
+        thread = Thread(target=copy, daemon=True)
+        thread.start()
+        try:
+            yield reader
+        finally:
+            with lock:
+                # Results not all read: the copy is stopped, and its errors are those of stopping it
+                stopped = state["stopped"] = not state["finished"]
+                if stopped and state["conn"] is not None:
+                    state["conn"].cancel()
+            reader.close()
+            thread.join()
+            if errors and not stopped:
+                raise errors[0]
+
+    @instrumented()
+    def copy_to_df(self, query, replacements={}, dtype=None, chunksize=None):
+        """
+        Exports the results of the query with COPY TO STDOUT and parses them with
+        pandas.read_csv as they arrive, which is faster than fetching rows for large
+        results. Columns get the dtypes read_sql gives them, from the types of the query's columns.
+            - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - dtype (dict): dtypes of columns, overriding the ones from the query, e.g. {'id': 'Int64'}
+            - chunksize (int): If given, returns a generator of dataframes of [chunksize] rows. Closing it
+              (or deleting it) before the last chunk cancels the query.
+        """
+        # The query is a subquery of COPY: without trailing semicolons, and closed on a new line after any comment
+        query = re.sub(r"[\s;]+$", "", self._format_query(query, replacements))
+        description = self._fetch(f"SELECT * FROM (\n{query}\n) AS q LIMIT 0", lambda cursor: cursor.description)
+        options = csv_options(description, dtype)
+        if chunksize:
+            return self._copy_chunks(query, description, options, chunksize)
+        with self._copy_out(query) as reader:
+            df = convert_booleans(pd.read_csv(reader, **options), description)
+        return df
+
+    def _copy_chunks(self, query, description, options, chunksize):
+        with self._copy_out(query) as reader:
+            for df in pd.read_csv(reader, chunksize=chunksize, **options):
+                yield convert_booleans(df, description)
+
+    def _records(self, cursor):
+        # Dataframe of the cursor's remaining rows, as read_sql builds it
+        return pd.DataFrame.from_records(cursor.fetchall(), columns=column_names(cursor), coerce_float=True)
+
+    @contextmanager
+    def _connection(self):
+        # Checks a DB-API connection out of the engine's pool for one call
+        conn = self.conn.raw_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _prepare(self, conn, query):
+        """
+        Returns the name and parameter order of the statement prepared for the query
+        on the connection, preparing it (PREPARE) the first time the query is run.
         """
-        Executes query and returns results into a dict via sqlalchemy
+        cache = statement_cache(conn, on_evict=_deallocate)
+        statement = cache.get(query)
+        if statement is None:
+            numbered, order = to_numbered(query)
+            statement = (statement_name(), order)
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"PREPARE {statement[0]} AS {numbered}")
+            finally:
+                cursor.close()
+            cache.put(query, statement, conn)
+        return statement
+
+    def _execute(self, conn, cursor, query, params=None, many=False):
+        """
+        Executes the query on the cursor. On Postgres, parameterized queries run as
+        EXECUTE of a statement prepared once per connection, so only the values are
+        sent and planning is not repeated (see reagan.statements.preparable for the
+        queries executed as they are). Parameter sets are sent in pages (execute_batch).
+        """
+        if params is not None and self.conn.dialect.name == "postgresql" and preparable(query, params, many):
+            name, order = self._prepare(conn, query)
+            query = f"EXECUTE {name}" + (f" ({', '.join('%s' for parameter in order)})" if order else "")
+            params = [ordered(values, order) for values in params] if many else ordered(params, order)
+        if many and self.conn.driver == "psycopg2":
+            psycopg2.extras.execute_batch(cursor, query, params)
+        elif many:
+            cursor.executemany(query, params)
+        elif params is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, params)
+
+    def _fetch(self, query, handler, params=None):
+        # Executes the query on a DB-API cursor and returns handler(cursor)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._execute(conn, cursor, query, params)
+                return handler(cursor)
+            finally:
+                cursor.close()
+
+    @instrumented()
+    def to_dict(self, schema, table, key, value, chunksize=None, native=False):
+        """
+        Executes query and returns results into a dict, with keys and values upcast to their
+        common type as in the rows of to_df (see reagan.fetch.frame_to_dict)
             - schema (string): schema of the table to pull
             - table (string): table name of the table to pull
             - key (string): column name in the table to be used as the dictionary key
             - value (string): column name in the table to be used as the dictionary value
+            - chunksize (int): Number of rows fetched from the cursor at a time
+            - native (bool): Builds the dict from the cursor without a dataframe, with the values
+              the driver returns. Faster and uses less memory.
         """
-        df = self.to_df(f'''SELECT DISTINCT {key} AS key, {value} AS value FROM {schema}.{table}''')
-        return {row["key"]: row["value"] for idx, row in df.iterrows()}
+        query = f'''SELECT DISTINCT {key} AS key, {value} AS value FROM {schema}.{table}'''
+        if native:
+            output = self._fetch(query, lambda cursor: rows_to_dict(fetch_batches(cursor, chunksize)))
+        else:
+            output = self._fetch(
+                query, lambda cursor: frame_to_dict(rows_to_frame(column_names(cursor), fetch_batches(cursor, chunksize)))
+            )
+        current_event().rows = len(output)
+        return output
 
-    def to_list(self, query):
+    @instrumented()
+    def to_list(self, query, replacements={}, chunksize=None, params=None, native=False):
         """
-        Executes query and returns results into a list via sqlalchemy
+        Executes query and returns the values of every row in a single list, as the values
+        of to_df flattened row by row (see reagan.fetch.frame_to_list)
             - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - chunksize (int): Number of rows fetched from the cursor at a time
+            - params (list or dict): Values bound to the placeholders of the query
+            - native (bool): Builds the list from the cursor without a dataframe, with the values
+              the driver returns: NULLs are None and integers are not upcast. Faster and uses less memory.
         """
-        df = self.to_df(query)
-        return df.values.flatten().tolist()
+        query = self._format_query(query, replacements)
+        if native:
+            return self._fetch(query, lambda cursor: flatten_rows(fetch_batches(cursor, chunksize)), params)
+        return self._fetch(
+            query, lambda cursor: frame_to_list(rows_to_frame(column_names(cursor), fetch_batches(cursor, chunksize))), params
+        )
 
-    def execute(self, query, replacements={}):
+    @instrumented()
+    def execute(self, query, replacements={}, params=None, many=False):
         """
         Executes query and returns results into a pandas dataframe via sqlalchmey
             - query (string): The SQL query to execute. Should be a SELECT
             - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list or dict): Values bound to the %s or %(name)s placeholders of the query,
+              or a list of parameter sets if many is True
+            - many (bool): Executes the query once for every parameter set in params
         """
         query = self._format_query(query, replacements)
-        with self.conn.connect() as con:
-            con.execute(query)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._execute(conn, cursor, query, params, many)
+            except Exception:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                cursor.close()
+        self._invalidate(query_tables(query))
 
-    def to_sql(self, df, schema, table, if_exists='fail', index = False, chunksize = 1000):
+    # Statements of execute_many raise their errors, as execute does
+    _execute_statement = execute
+
+    @property
+    def engine(self):
+        # The SQLAlchemy engine (conn), named as in SQLServer
+        return self.conn
+
+    @instrumented()
+    def to_sql(self, df, schema, table, if_exists='fail', index = False, chunksize = None, method = None, keys = None, format = 'csv'):
         '''
         Inserts a pandas dataframe into the specified table in DADL.
-        Types accepted are 'append' and 'replace'
+        Types accepted are 'append' and 'replace', and 'upsert' (uses the copy method)
+            - chunksize (int): Rows written at a time (default is 1000, or 100000 for the copy method)
+            - method (string): Set to 'copy' to stream the rows with COPY FROM STDIN (see copy_to_sql)
+            - keys (list): Columns to match rows on for 'upsert'
+            - format (string): 'csv' or 'binary', for the copy method
         '''
 
+        current_event().rows = len(df)
+        if method == 'copy' or if_exists == 'upsert':
+            if index:
+                df = df.reset_index()
+            return self.copy_to_sql(
+                df,
+                schema=schema,
+                table=table,
+                if_exists=if_exists,
+                keys=keys,
+                format=format,
+                chunksize=chunksize or 100000,
+            )
         df.to_sql(
             name=table,
             if_exists=if_exists,
             schema=schema,
             index=index,
             con=self.conn,
-            chunksize=chunksize,
+            chunksize=chunksize or 1000,
+        )
+        self._invalidate([f"{schema}.{table}"])
+
+    def _table_exists(self, cursor, schema, table):
+        cursor.execute("SELECT to_regclass(%s)", (f'"{schema}"."{table}"',))
+        return cursor.fetchone()[0] is not None
+
+    def _column_types(self, cursor, target, columns):
+        # Postgres type of each column of the table (e.g. integer), None for columns it does not have
+        cursor.execute(
+            "SELECT attname, atttypid::regtype::text FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+            (target,),
         )
+        types = dict(cursor.fetchall())
+        return [types.get(col) for col in columns]
+
+    def _upsert_statement(self, target, stage, columns, keys):
+        """
+        Returns the statement that inserts the staging table into the target, updating the rows whose keys conflict.
+        """
+        return upsert_statement(target, stage, columns, keys)
+
+    @instrumented()
+    def copy_to_sql(self, df, schema, table, if_exists='append', keys=None, format='csv', chunksize=100000):
+        """
+        Loads a pandas dataframe into the table with COPY FROM STDIN. The rows are encoded
+        [chunksize] at a time as the server reads them, so the whole file is never held in memory.
+            - df (DataFrame): The data which to insert into the SQL table.
+            - schema (string): The schema location of the table.
+            - table (string): The table name to insert data into.
+            - if_exists (string): How to treat the insertion. Accepted values are: 'fail','append','replace','upsert' (default is append).
+                - If 'replace' is selected, the table will be dropped and recreated with the pandas column types.
+                - If 'upsert' is selected, rows are copied to a temporary table, then inserted with
+                  INSERT ... ON CONFLICT on keys, updating the rows that exist. The table needs a unique
+                  constraint on keys (it is created with a primary key if it does not exist) and keys
+                  must be unique in the dataframe.
+            - keys (list): Columns to match rows on for 'upsert'.
+            - format (string): 'csv' (text) or 'binary'. Binary is faster to parse. Values are sent with the types
+              of the table's columns (read from pg_attribute); if a column cannot be sent as its type in binary
+              (e.g. a numeric column, or fractional floats for an integer column), csv is used with a warning.
+            - chunksize (int): Number of rows encoded at a time.
+        """
+        if if_exists not in ('fail', 'append', 'replace', 'upsert'):
+            raise ValueError(f"'{if_exists}' is not valid for if_exists")
+        if if_exists == 'upsert' and not keys:
+            raise ValueError("keys are required to upsert")
+        if format not in ('csv', 'binary'):
+            raise ValueError(f"'{format}' is not a valid format")
+
+        current_event().rows = len(df)
+        target = f'"{schema}"."{table}"'
+        columns = [str(col) for col in df.columns]
+        column_list = ", ".join(f'"{col}"' for col in columns)
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                exists = self._table_exists(cursor, schema, table)
+                conn.commit()
+                if exists and if_exists == 'fail':
+                    raise ValueError(f"Table {target} already exists.")
+                # Dropped and created in the transaction of the COPY, so a failed load keeps the table
+                if exists and if_exists == 'replace':
+                    cursor.execute(f"DROP TABLE {target}")
+                if not exists or if_exists == 'replace':
+                    definition = ", ".join(f'"{col}" {pg_type(df[col])}' for col in columns)
+                    if if_exists == 'upsert':
+                        definition += ", PRIMARY KEY ({})".format(", ".join(f'"{key}"' for key in keys))
+                    cursor.execute(f"CREATE TABLE {target} ({definition})")
+
+                # Values are written for the types of the table's columns
+                types = self._column_types(cursor, target, columns)
+                if format == 'binary':
+                    if all(binary_compatible(df[col], column_type) for col, column_type in zip(columns, types)):
+                        stream = CopyStream(binary_chunks(df, chunksize, types))
+                        options = "FORMAT binary"
+                    else:
+                        warnings.warn(f"The columns of {target} do not match the dataframe's types, copied as csv instead of binary")
+                        format = 'csv'
+                if format == 'csv':
+                    stream = CopyStream(csv_chunks(df, chunksize, types))
+                    options = "FORMAT csv, NULL '\\N'"
+
+                if if_exists == 'upsert':
+                    stage = f'"_stage_{table}_{uuid.uuid4().hex[:8]}"'
+                    cursor.execute(f"CREATE TEMP TABLE {stage} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP")
+                    cursor.copy_expert(f"COPY {stage} ({column_list}) FROM STDIN WITH ({options})", stream)
+                    cursor.execute(self._upsert_statement(target, stage, columns, keys))
+                else:
+                    cursor.copy_expert(f"COPY {target} ({column_list}) FROM STDIN WITH ({options})", stream)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        current_event().bytes = stream.bytes
+        self._invalidate([f"{schema}.{table}"])
 
-    def get_scalar(self, query, replacements={}):
+    @instrumented()
+    def get_scalar(self, query, replacements={}, params=None):
         """
         Executes query and returns a single result
             - query (string): The SQL query to execute. Should be a SELECT
             - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list or dict): Values bound to the placeholders of the query
         """
         query = self._format_query(query, replacements)
-        return self.conn.scalar(query)
+        return self._fetch(query, first_value, params)
 
 if __name__ == "__main__":
     q = PSQL('scp')
@@ -0,0 +1,80 @@
+from functools import lru_cache
+from threading import Lock
+import os
+import re
+
+_cache_lock = Lock()
+_file_cache = {}
+
+
+@lru_cache(maxsize=256)
+def _replacement_pattern(keys):
+    # Longest keys first, so a key that contains another key wins
+    return re.compile("|".join(re.escape(key) for key in sorted(keys, key=len, reverse=True)))
+
+
+class QueryTemplate(object):
+    """
+    A sql query parsed once, that can be formatted many times.
+        - query (string): The query text
+        - path (string): The .sql file the query was read from, if any
+
+    Replacements are substituted in a single pass over the query, so the
+    result does not depend on the order of the replacements. Where keys
+    overlap, the longest key is used.
+    """
+
+    def __init__(self, query, path=None):
+        self.query = query
+        self.path = path
+
+    def __str__(self):
+        return self.query
+
+    def __repr__(self):
+        return f"QueryTemplate({self.path or self.query[:40]!r})"
+
+    def format(self, replacements={}):
+        """
+        Returns the query with every instance of each key in replacements replaced with str(value)
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+        """
+        replacements = {str(key): str(value) for key, value in replacements.items() if key != ""}
+        if not replacements:
+            return self.query
+        pattern = _replacement_pattern(tuple(sorted(replacements)))
+        return pattern.sub(lambda match: replacements[match.group(0)], self.query)
+
+
+def read_sql_file(path):
+    """
+    Returns the QueryTemplate for a .sql file. Files are read once and
+    cached by path, and read again only when the file is modified.
+        - path (string): Path to the .sql file
+    """
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        cached = _file_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    with open(path, "r") as f:
+        # reading files with a guillemet », add an uncessary Â to the string
+        template = QueryTemplate(f.read().replace("Â", ""), path=path)
+
+    with _cache_lock:
+        _file_cache[path] = (mtime, template)
+    return template
+
+
+def compile_query(query_input):
+    """
+    Returns a QueryTemplate for a query string, a path to a .sql file, or
+    an existing QueryTemplate. Compiled templates can be passed anywhere a
+    query is accepted, e.g. SQLServer.to_df or PSQL.execute.
+    """
+    if isinstance(query_input, QueryTemplate):
+        return query_input
+    if query_input.split(".")[-1] == "sql":
+        return read_sql_file(query_input)
+    return QueryTemplate(query_input)
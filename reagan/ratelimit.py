@@ -0,0 +1,199 @@
+"""
+Client-side rate limiting of the Google API connectors (DCMAPI, SA360, Drive, GCP),
+so many threads can call an API at once without tripping its quotas.
+"""
+from googleapiclient.errors import HttpError
+from reagan.instrumentation import current_event, count_retry
+from threading import Lock
+from time import monotonic, sleep
+import random
+
+# Default limits of each API: (queries per second, queries per day). Set the
+# quotas of your project with set_limiter.
+LIMITS = {
+    "dfareporting": (10, None),
+    "doubleclicksearch": (10, None),
+    "drive": (10, None),
+    "compute": (20, None),
+}
+
+# Reasons of the 403 errors that are rate limits rather than missing permissions
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+
+_limiters_lock = Lock()
+_limiters = {}
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """
+    Tokens added at [rate] per second up to [capacity]. Tokens are taken as they are
+    requested, so the balance can go below zero and later callers wait their turn.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def wait(self, tokens, now):
+        # Seconds until the bucket holds the tokens
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def take(self, tokens):
+        self.tokens -= tokens
+
+
+class RateLimiter(object):
+    """
+    Token buckets for the queries per second and per day of one API, shared by
+    every thread and connector instance in the process calling it (see get_limiter).
+        - qps (float): Queries per second, None for no limit. Bursts of up to a second of queries are allowed.
+        - per_day (int): Queries per day, None for no limit
+        - max_wait (float): Longest wait for the daily quota, above which QuotaExceeded is raised
+    """
+
+    def __init__(self, qps=None, per_day=None, max_wait=300):
+        self.qps = qps
+        self.per_day = per_day
+        self.max_wait = max_wait
+        self._lock = Lock()
+        self._second = TokenBucket(qps, max(qps, 1)) if qps else None
+        self._day = TokenBucket(per_day / 86400, per_day) if per_day else None
+        self._paused_until = 0.0
+        self.calls = 0
+        self.waited = 0.0
+
+    def acquire(self, tokens=1):
+        """
+        Waits until [tokens] queries can be made, and returns the seconds waited.
+        The wait is added to the current instrumentation event.
+        """
+        with self._lock:
+            now = monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self._day is not None:
+                day_wait = self._day.wait(tokens, now)
+                if day_wait > self.max_wait:
+                    raise QuotaExceeded(f"Daily quota of {self.per_day} queries used, next query in {day_wait:.0f}s")
+                wait = max(wait, day_wait)
+            if self._second is not None:
+                wait = max(wait, self._second.wait(tokens, now))
+            for bucket in (self._second, self._day):
+                if bucket is not None:
+                    bucket.take(tokens)
+            self.calls += tokens
+            self.waited += wait
+
+        if wait > 0:
+            event = current_event()
+            if event is not None:
+                event.wait += wait
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Makes every caller wait [seconds] before its next query, e.g. for a retry-after sent by the API.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+
+def get_limiter(api):
+    """
+    Returns the rate limiter of the API (e.g. dfareporting), shared by the whole process.
+    """
+    with _limiters_lock:
+        if api not in _limiters:
+            qps, per_day = LIMITS.get(api, (None, None))
+            _limiters[api] = RateLimiter(qps=qps, per_day=per_day)
+        return _limiters[api]
+
+
+def set_limiter(api, limiter):
+    """
+    Replaces the rate limiter of the API, e.g. with RateLimiter(qps=..., per_day=...) for
+    the quotas of your project. Passing None resets it to the default.
+    Connectors created before keep the limiter they had.
+    """
+    with _limiters_lock:
+        if limiter is None:
+            _limiters.pop(api, None)
+        else:
+            _limiters[api] = limiter
+
+
+def is_rate_limited(error):
+    """
+    Returns whether the error is a 429, or a 403 for a rate limit or quota.
+    """
+    if not isinstance(error, HttpError):
+        return False
+    status = int(error.resp.status)
+    if status == 429:
+        return True
+    return status == 403 and any(reason in error.content.decode("utf-8", "replace") for reason in RATE_LIMIT_REASONS)
+
+
+def retry_after(error):
+    """
+    Returns the seconds of the error's retry-after header, or None.
+    """
+    value = error.resp.get("retry-after") if isinstance(error, HttpError) else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # Missing, or an HTTP date
+        return None
+
+
+def backoff(attempt, base=1.0, cap=64.0):
+    """
+    Returns the seconds to wait before retry [attempt] (1 for the first): an
+    exponential backoff with full jitter, so callers failing together spread out.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_wait(errors, attempt, limiter=None):
+    """
+    Returns the seconds to wait before retrying calls that failed with errors: the
+    longest retry-after they carry, which also pauses every caller of the limiter,
+    or else backoff(attempt).
+    """
+    waits = [wait for wait in map(retry_after, errors) if wait is not None]
+    if not waits:
+        return backoff(attempt)
+    if limiter is not None:
+        limiter.pause(max(waits))
+    return max(waits)
+
+
+def execute(request, limiter=None, http=None, retries=5, tokens=1):
+    """
+    Executes a googleapiclient request (or batch request) once the limiter allows it,
+    retrying rate limit errors after retry_wait. Retries are counted on the current event.
+        - limiter (RateLimiter): Limiter of the API, None for no limit
+        - http: HTTP transport to execute the request on (default is the service's own)
+        - retries (int): Times a rate limited request is retried
+        - tokens (int): Queries the request counts for, e.g. the calls in a batch request
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire(tokens)
+        try:
+            if http is None:
+                return request.execute()
+            return request.execute(http=http)
+        except HttpError as error:
+            if attempt == retries or not is_rate_limited(error):
+                raise
+            count_retry(error)
+            sleep(retry_wait([error], attempt + 1, limiter))
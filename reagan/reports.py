@@ -0,0 +1,209 @@
+"""
+Runs many DCM and SA360 reports at once: every report is submitted up front,
+polled with an exponential backoff, and downloaded by a pool of threads as
+soon as it is ready.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, sleep
+import pandas as pd
+
+# Seconds before the first poll of a report, doubled after every poll up to MAX_POLL_INTERVAL
+POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 300
+# Statuses of DCM report files that will never be available
+FAILED_STATUSES = ("FAILED", "CANCELLED")
+
+
+class ReportFailed(Exception):
+    pass
+
+
+def poll_intervals(interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """
+    Generator of the seconds to wait between polls of a report: interval,
+    doubled every time up to max_interval.
+    """
+    while True:
+        yield interval
+        interval = min(interval * 2, max_interval)
+
+
+class DCMReport(object):
+    """
+    A DCM report run by a ReportManager.
+        - dcm (DCMAPI): Connector to run the report with
+        - reportId (string): The id of the report to run
+        - params (dict): Any additional arguments to pass to the GET request of the file
+        - chunksize (int): If given, the result is a list of dataframes of [chunksize] rows
+    """
+
+    def __init__(self, dcm, reportId, params=None, chunksize=None):
+        self.dcm = dcm
+        self.reportId = reportId
+        self.params = params or {}
+        self.chunksize = chunksize
+        self.fileId = None
+
+    @property
+    def name(self):
+        return f"dcm_{self.reportId}"
+
+    def submit(self):
+        self.fileId = self.dcm.run_report(self.reportId)
+
+    def ready(self):
+        status = self.dcm.report_status(self.reportId, self.fileId)
+        if status in FAILED_STATUSES:
+            raise ReportFailed(f"File {self.fileId} of report {self.reportId} is {status}")
+        return status == "REPORT_AVAILABLE"
+
+    def download(self):
+        if self.chunksize:
+            return list(self.dcm.report_chunks(self.reportId, self.fileId, self.params, chunksize=self.chunksize))
+        return self.dcm.report_to_df(self.reportId, self.fileId, self.params)
+
+
+class SA360Report(object):
+    """
+    A SA360 report run by a ReportManager. The result is a single dataframe of every fragment.
+        - sa (SA360): Connector to request the report with
+        - agency_id, report_type, columns, timerange: See SA360.request_report
+    """
+
+    def __init__(self, sa, agency_id, report_type, columns, timerange=None):
+        self.sa = sa
+        self.arguments = dict(agency_id=agency_id, report_type=report_type, columns=columns, timerange=timerange)
+        self.report_id = None
+        self.fragments = None
+
+    @property
+    def name(self):
+        # The report id is only known once the report is submitted
+        return f"sa360_{self.report_id}" if self.report_id is not None else None
+
+    def submit(self):
+        self.report_id = self.sa.request_report(**self.arguments)
+
+    def ready(self):
+        self.fragments = self.sa.report_status(self.report_id)
+        return self.fragments is not None
+
+    def download(self):
+        dfs = [self.sa.file_to_df(report_id=self.report_id, report_fragment=fragment) for fragment in self.fragments]
+        return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+
+class ReportManager(object):
+    """
+    Runs many DCM and SA360 reports at once. Reports are submitted when added,
+    then polled together, each with its own exponential backoff, and every
+    finished report is downloaded and parsed by a pool of threads while the
+    others are still processing.
+
+        manager = ReportManager(workers=4)
+        manager.add_dcm(dcm, reportId=1234)
+        manager.add_sa360(sa, agency_id=1, report_type='campaign', columns=['campaignId'])
+        for name, df in manager.as_completed():
+            ...
+
+        - workers (int): Threads downloading and parsing reports
+        - poll_interval (float): Seconds before the first poll of a report
+        - max_interval (float): Longest wait between polls of a report
+        - callback (function): Called with the name and result (dataframe or exception) of every report as it completes
+    """
+
+    def __init__(self, workers=4, poll_interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, callback=None):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.callback = callback
+        self.reports = {}
+
+    def add(self, report, name=None):
+        """
+        Submits a report: a DCMReport, SA360Report or any object with submit, ready and
+        download methods and a name.
+            - name (string): Name of the report in the results (default is report.name)
+        """
+        # Names known before submitting (e.g. of DCM reports) are checked without running the report
+        if (name or report.name) in self.reports:
+            raise ValueError(f"A report is already named '{name or report.name}'")
+        report.submit()
+        name = name or report.name
+        if name in self.reports:
+            raise ValueError(f"A report is already named '{name}'")
+        self.reports[name] = report
+        return report
+
+    def add_dcm(self, dcm, reportId, name=None, params=None, chunksize=None):
+        """
+        Runs a DCM report (see DCMReport). Named dcm_[reportId] by default.
+        """
+        return self.add(DCMReport(dcm, reportId, params=params, chunksize=chunksize), name=name)
+
+    def add_sa360(self, sa, agency_id, report_type, columns, timerange=None, name=None):
+        """
+        Requests a SA360 report (see SA360Report). Named sa360_[report id] by default.
+        """
+        return self.add(SA360Report(sa, agency_id, report_type, columns, timerange=timerange), name=name)
+
+    def as_completed(self, errors="return"):
+        """
+        Generator that yields the name and result of every report as soon as it is downloaded and parsed.
+            - errors (string): 'return' yields the exception of a failed report as its result;
+              'raise' raises it, cancelling the downloads not yet started
+        """
+        if errors not in ("raise", "return"):
+            raise ValueError(f"'{errors}' is not valid for errors")
+
+        now = monotonic()
+        polls = {name: [now, poll_intervals(self.poll_interval, self.max_interval)] for name in self.reports}
+        downloads = {}
+        executor = ThreadPoolExecutor(max_workers=max(self.workers, 1))
+        try:
+            while polls or downloads:
+                completed = []
+                for name, poll in list(polls.items()):
+                    if poll[0] > monotonic():
+                        continue
+                    try:
+                        ready = self.reports[name].ready()
+                    except Exception as e:
+                        del polls[name]
+                        completed.append((name, e))
+                        continue
+                    if ready:
+                        del polls[name]
+                        downloads[executor.submit(self.reports[name].download)] = name
+                    else:
+                        poll[0] = monotonic() + next(poll[1])
+
+                # Waits for a download, or until the next report is due to be polled
+                timeout = max(min(poll[0] for poll in polls.values()) - monotonic(), 0) if polls else None
+                if completed:
+                    timeout = 0
+                if downloads:
+                    done, _ = wait(downloads, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = downloads.pop(future)
+                        error = future.exception()
+                        completed.append((name, error if error is not None else future.result()))
+                elif timeout:
+                    sleep(timeout)
+
+                for name, result in completed:
+                    if self.callback is not None:
+                        self.callback(name, result)
+                    if isinstance(result, Exception) and errors == "raise":
+                        raise result
+                    yield name, result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def run(self, errors="raise"):
+        """
+        Waits for every report and returns a dict of name to result, in the order the reports were added.
+            - errors (string): See as_completed
+        """
+        results = dict(self.as_completed(errors=errors))
+        return {name: results[name] for name in self.reports}
@@ -1,6 +1,9 @@
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from reagan.discovery import build_service, get_credentials
+from reagan.instrumentation import instrumented, current_event
+from reagan.ratelimit import execute, get_limiter
+from reagan.reports import poll_intervals
 from reagan.subclass import Subclass
+from reagan.transport import ThreadTransports, authorized_http
 from io import BytesIO
 import pandas as pd
 from time import sleep
@@ -11,35 +14,55 @@ class SA360(Subclass):
         super().__init__(verbose=verbose)
         self.version = version
         self.service_account_filepath = self.get_parameter_value("/sa360/service_account_path")
+        self.limiter = get_limiter("doubleclicksearch")
+        # HTTP transport of each thread, so reports can be downloaded from several threads
+        self.transports = ThreadTransports(self._new_http)
         self._create_service()
         self.dcm_api_calls = 0
 
     def _create_service(self):
 
         api_name = "doubleclicksearch"
-        self.credentials = service_account.Credentials.from_service_account_file(
-            self.service_account_filepath
-        )
-        self.service = build(api_name, self.version, credentials=self.credentials)
+        self.credentials = get_credentials(self.service_account_filepath)
+        self.service = build_service(api_name, self.version, self.credentials)
+
+    def _new_http(self):
+        return authorized_http(self.credentials)
+
+    def _execute(self, request):
+        # Executes the request once the limiter allows it, on the HTTP transport of this thread
+        return execute(request, self.limiter, http=self.transports.get())
+
+    @instrumented()
+    def report_status(self, report_id):
+        """
+        Returns a list containing the fragments (ints) of a report if it is ready, else None
+            - report_id (int): Id of the Report used to make the calls
+        """
+
+        report_status = self._execute(self.service.reports().get(reportId=report_id))
+        if not report_status["isReportReady"]:
+            return None
+        return [
+            report_file["url"].split("/")[-1]
+            for report_file in report_status["files"]
+        ]
 
+    @instrumented()
     def get_report_fragments(self, report_id):
         """
-        Returns a list containing the fragments (ints) of a report
+        Waits for a report to be ready and returns a list containing its fragments (ints).
+        The report is polled with an exponential backoff.
             - report_id (int): Id of the Report used to make the calls
         """
 
-        request = self.service.reports().get(reportId=report_id)
-        report_status = request.execute()
-        while True:
-            if report_status["isReportReady"]:
-                return [
-                    report_file["url"].split("/")[-1]
-                    for report_file in report_status["files"]
-                ]
-            request = self.service.reports().get(reportId=report_id)
-            report_status = request.execute()
-        sleep(60)
+        for interval in poll_intervals():
+            report_fragments = self.report_status(report_id)
+            if report_fragments is not None:
+                return report_fragments
+            sleep(interval)
 
+    @instrumented()
     def file_to_df(self, report_id, report_fragment):
         """
         Returns a pandas dataframe given a Report Id and Fragment
@@ -50,12 +73,15 @@ class SA360(Subclass):
         request = self.service.reports().getFile(
             reportId=report_id, reportFragment=report_fragment
         )
-        report_file = request.execute()
+        report_file = self._execute(request)
+        current_event().bytes = len(report_file)
         return pd.read_csv(BytesIO(report_file))
 
-    def reports_to_df(self, agency_id, report_type, columns, timerange=None):
+    @instrumented()
+    def request_report(self, agency_id, report_type, columns, timerange=None):
         """
-        Returns a generator that yields a pandas dataframe with 1000000 rows with the report specifications
+        Requests a report and returns its id, without waiting for it to be ready
+        (see report_status, or reagan.reports.ReportManager).
             - agency_id (int): Id of the Agency used to make the calls
             - report_type (string): Specified report type
             - columns (list): Columns to include in the report
@@ -73,10 +99,20 @@ class SA360(Subclass):
         if timerange:
             body['timeRange'] = timerange
 
+        report = self._execute(self.service.reports().request(body=body))
+        return report["id"]
+
+    @instrumented()
+    def reports_to_df(self, agency_id, report_type, columns, timerange=None):
+        """
+        Returns a generator that yields a pandas dataframe with 1000000 rows with the report specifications
+            - agency_id (int): Id of the Agency used to make the calls
+            - report_type (string): Specified report type
+            - columns (list): Columns to include in the report
+        """
+
         # 1. Request Report
-        report_request = self.service.reports().request(body=body)
-        report = report_request.execute()
-        report_id = report["id"]
+        report_id = self.request_report(agency_id, report_type, columns, timerange=timerange)
 
         # 2. Wait for it to finish
         report_fragments = self.get_report_fragments(report_id)
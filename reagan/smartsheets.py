@@ -1,5 +1,6 @@
 import pandas as pd
 from configparser import ConfigParser
+from reagan.instrumentation import instrumented
 from reagan.subclass import Subclass
 import smartsheet
 
@@ -10,6 +11,7 @@ class SmartsheetAPI(Subclass):
         self.bearer_token = self.get_parameter_value("/smartsheets/bearer_token")
         self.conn = smartsheet.Smartsheet(self.bearer_token)
 
+    @instrumented()
     def get_attachment_url(self, sheet_id, attachment_id):
         """
         Inputs - sheet_id (int), attachment_id (int)
@@ -23,6 +25,7 @@ class SmartsheetAPI(Subclass):
         else:
             self.vprint("No url returned: {a}")
 
+    @instrumented()
     def attachment_to_dict(self, sheet_id, attachment_id):
         """
         Use only for excel attachments
@@ -39,6 +42,7 @@ class SmartsheetAPI(Subclass):
             attachment[sheet_name] = df
         return attachment
 
+    @instrumented()
     def discussions_to_df(self, sheet_id):
         discussions_obj = self.conn.Discussions.get_all_discussions(
             sheet_id, include_all=True, include=["comments", "attachments"]
@@ -54,6 +58,7 @@ class SmartsheetAPI(Subclass):
 
         return disc
 
+    @instrumented()
     def sheet_to_df(self, sheet_id):
         # Make API Call
         sheet_obj = self.conn.Sheets.get_sheet(sheet_id)
@@ -1,110 +1,485 @@
 #!/usr/bin/python
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from reagan.cache import query_tables
+from reagan.fetch import SQLConnector, column_names, fetch_batches, first_value, flatten_rows, frame_to_dict, frame_to_list, rows_to_dict, rows_to_frame
+from reagan.instrumentation import instrumented, current_event
+from reagan.pool import get_engine, max_connections, pool_stats
+from reagan.statements import statement_cache
 from reagan.subclass import Subclass
 import pandas as pd
+import math
+import uuid
+import warnings
 import pyodbc
-import sqlalchemy
 import urllib
 
 
-class SQLServer(Subclass):
-    def __init__(self, server):
+class SQLServer(SQLConnector, Subclass):
+    cache_prefix = "sqlserver"
+
+    def __init__(self, server, pool_size=None, cache=None):
+        """
+        Connects to the server's database through a connection pool shared by every
+        SQLServer instance for the same server in the process.
+            - server (string): Alias of the server, read from /sqlserver/[server] in the parameter store
+            - pool_size (int): Maximum number of open connections to the server (default is 10). Set by the
+              first instance; a different size for later instances is ignored with a warning.
+            - cache (ResultCache): Caches the results of to_df on local disk (see reagan.cache)
+        """
         super().__init__()
         self.server = server
-        self._connect_to_database(self.get_parameter_value(f"/sqlserver/{self.server}"))
+        self.result_cache = cache
+        self._conn = None
+        self._conn_cursor = None
+        self._connect_to_database(self.get_parameter_value(f"/sqlserver/{self.server}"), pool_size)
 
-    def _connect_to_database(self, connection):
+    def __enter__(self):
+        return self
 
-        # Connect via pyodbc. Used for DML statements
-        self.conn = pyodbc.connect(connection)
+    def __exit__(self, *exc_info):
+        self.close()
 
-        # conn.cursor will return a cursor object, you can use this cursor to perform queries
-        self.cursor = self.conn.cursor()
+    def _connect_to_database(self, connection, pool_size=None):
 
-        # Connect via sqlalchemy to perform interactions with the pandas
+        # Every call checks a pyodbc connection out of the engine's pool and returns it when done
+        self.connection_string = connection
         conn_string = "mssql+pyodbc:///?odbc_connect={}".format(
             urllib.parse.quote_plus(connection)
         )
-        self.engine = sqlalchemy.create_engine(
-            conn_string, echo=False, fast_executemany=True
+        self.engine = get_engine(
+            f"sqlserver/{self.server}", conn_string, pool_size=pool_size, echo=False, fast_executemany=True
         )
 
-    def to_df(self, query, replacements={}, table=None):
+    @property
+    def conn(self):
+        """
+        A pyodbc connection checked out of the pool for code that uses it directly. The
+        methods of the class do not use it. It is held until close is called or the
+        instance is used as a context manager (with SQLServer(...) as ss), so instances
+        created in loops do not exhaust the pool.
+        """
+        if self._conn is None:
+            self._conn = self.engine.raw_connection()
+        return self._conn
+
+    @property
+    def cursor(self):
+        if self._conn_cursor is None:
+            self._conn_cursor = self.conn.cursor()
+        return self._conn_cursor
+
+    def close(self):
+        """
+        Returns the connection of conn (and cursor) to the pool. It is checked out again
+        if conn is used after.
+        """
+        if self._conn_cursor is not None:
+            self._conn_cursor.close()
+            self._conn_cursor = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    @contextmanager
+    def _connection(self):
+        # Checks a connection out of the pool for one call, returning it when done
+        conn = self.engine.raw_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def pool_stats(self):
+        """
+        Returns a dict with the size, utilisation and checkout wait times of the
+        connection pool shared by the instances for this server.
+        """
+        return pool_stats(self.engine)
+
+    def _cursor(self, conn, query, params):
+        """
+        Returns a cursor for the query and whether to close it after use. Parameterized
+        queries re-use the cursor cached for their text on the connection, as pyodbc
+        prepares a statement once per cursor and re-uses it while the text is unchanged.
+        """
+        if params is None:
+            return conn.cursor(), True
+        cache = statement_cache(conn, on_evict=lambda cursor, conn: cursor.close())
+        cursor = cache.get(query)
+        if cursor is None:
+            cursor = conn.cursor()
+            cache.put(query, cursor, conn)
+        return cursor, False
+
+    def _drain(self, cursor):
+        """
+        Discards the results left on a cached cursor (e.g. after get_scalar), before it is
+        re-used: without MARS, a connection with results left is busy for any other statement,
+        including the pool's pre-ping.
+        """
+        while True:
+            if cursor.description is not None:
+                cursor.fetchall()
+            # nextset is optional in DB-API
+            if not hasattr(cursor, "nextset") or not cursor.nextset():
+                return
+
+    def _execute(self, cursor, query, params=None, many=False):
+        if many:
+            cursor.fast_executemany = True
+            cursor.executemany(query, params)
+        elif params is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, params)
+
+    def _iter_batches(self, query, chunksize, params=None):
+        """
+        Generator that executes the query on its own cursor and yields
+        (columns, rows) for every [chunksize] rows fetched, so only one batch
+        is held in memory and the first is available before the query finishes.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._execute(cursor, query, params)
+                columns = column_names(cursor)
+                for rows in fetch_batches(cursor, chunksize):
+                    yield columns, rows
+            finally:
+                cursor.close()
+
+    @instrumented()
+    def to_df(self, query, replacements={}, table=None, chunksize=None, params=None):
         """
         Executes query and returns results into a pandas dataframe via sqlalchemy
             - query (string): The SQL query to execute. Should be a SELECT
             - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - chunksize (int): If given, returns a generator of dataframes of [chunksize] rows (see to_df_chunks)
+            - params (list): Values bound to the ? placeholders of the query. Queries differing only
+              in their values share one plan, and the statement is prepared once per connection.
+        """
+        if chunksize:
+            return self.to_df_chunks(query, replacements=replacements, table=table, chunksize=chunksize, params=params)
+        if table:
+            query = f'SELECT * FROM {table}'
+        else:
+            query = self._format_query(query, replacements)
+        if self.result_cache is not None:
+            return self.result_cache.fetch(self._cache_alias, query, lambda: self._read(query, params), params)
+        return self._read(query, params)
+
+    def _read(self, query, params=None):
+        if params is not None:
+            return self._fetch(query, self._records, params)
+        with self._connection() as conn:
+            return pd.read_sql(query, conn)
+
+    def _records(self, cursor):
+        # Dataframe of the cursor's remaining rows, as read_sql builds it
+        return pd.DataFrame.from_records(
+            [tuple(row) for row in cursor.fetchall()], columns=column_names(cursor), coerce_float=True
+        )
+
+    @instrumented()
+    def to_df_chunks(self, query, replacements={}, table=None, chunksize=100000, params=None):
+        """
+        Executes query and returns a generator that yields pandas dataframes of [chunksize] rows,
+        fetched from the cursor as they are needed. Use for results too large to hold in memory.
+            - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - chunksize (int): Number of rows in each dataframe
+            - params (list): Values bound to the ? placeholders of the query
         """
         if table:
             query = f'SELECT * FROM {table}'
         else:
             query = self._format_query(query, replacements)
-        return pd.read_sql(query, self.conn)
+        for columns, rows in self._iter_batches(query, chunksize, params):
+            yield pd.DataFrame.from_records(
+                [tuple(row) for row in rows], columns=columns, coerce_float=True
+            )
+
+    def _fetch(self, query, handler, params=None):
+        # Executes the query on a pooled connection and returns handler(cursor)
+        with self._connection() as conn:
+            cursor, close = self._cursor(conn, query, params)
+            try:
+                self._execute(cursor, query, params)
+                return handler(cursor)
+            finally:
+                if close:
+                    cursor.close()
+                else:
+                    self._drain(cursor)
 
-    def to_list(self, query):
+    @instrumented()
+    def to_list(self, query, replacements={}, chunksize=None, params=None, native=False):
         """
-        Executes query and returns results into a list via sqlalchemy
+        Executes query and returns the values of every row in a single list, as the values
+        of to_df flattened row by row (see reagan.fetch.frame_to_list)
             - query (string): The SQL query to execute. Should be a SELECT
+            - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - chunksize (int): Number of rows fetched from the cursor at a time
+            - params (list): Values bound to the ? placeholders of the query
+            - native (bool): Builds the list from the cursor without a dataframe, with the values
+              the driver returns: NULLs are None and integers are not upcast. Faster and uses less memory.
         """
-        df = self.to_df(query)
-        return df.values.flatten().tolist()
+        query = self._format_query(query, replacements)
+        if native:
+            return self._fetch(query, lambda cursor: flatten_rows(fetch_batches(cursor, chunksize)), params)
+        return self._fetch(
+            query, lambda cursor: frame_to_list(rows_to_frame(column_names(cursor), fetch_batches(cursor, chunksize))), params
+        )
 
-    def to_dict(self, schema, table, key, value):
+    @instrumented()
+    def to_dict(self, schema, table, key, value, chunksize=None, native=False):
         """
-        Executes query and returns results into a dict via sqlalchemy
+        Executes query and returns results into a dict, with keys and values upcast to their
+        common type as in the rows of to_df (see reagan.fetch.frame_to_dict)
             - schema (string): schema of the table to pull
             - table (string): table name of the table to pull
             - key (string): column name in the table to be used as the dictionary key
             - value (string): column name in the table to be used as the dictionary value
+            - chunksize (int): Number of rows fetched from the cursor at a time
+            - native (bool): Builds the dict from the cursor without a dataframe, with the values
+              the driver returns. Faster and uses less memory.
         """
-        df = self.to_df(
-            f"SELECT DISTINCT {key} AS [key], {value} AS [value] FROM {schema}.{table}"
-        )
-        return {row["key"]: row["value"] for idx, row in df.iterrows()}
+        query = f"SELECT DISTINCT {key} AS [key], {value} AS [value] FROM {schema}.{table}"
+        if native:
+            output = self._fetch(query, lambda cursor: rows_to_dict(fetch_batches(cursor, chunksize)))
+        else:
+            output = self._fetch(
+                query, lambda cursor: frame_to_dict(rows_to_frame(column_names(cursor), fetch_batches(cursor, chunksize)))
+            )
+        current_event().rows = len(output)
+        return output
 
-    def to_sql(self, df, name, schema, if_exists="fail", index=False, chunksize=1000):
+    @instrumented()
+    def to_sql(self, df, name, schema, if_exists="fail", index=False, chunksize=None, method=None, keys=None, dtype=None, workers=1):
         """
         Inserts a pandas dataframe into the specified table in DADL.
             - df (DataFrame): The data which to insert into the SQL table.
             - name (string): The table name to insert data into.
             - schema (string): The schema location of the table.
-            - if_exists (string): How to treat the insertion. Accepted values are: 'fail','append','replace' (default is fail).
+            - if_exists (string): How to treat the insertion. Accepted values are: 'fail','append','replace','upsert' (default is fail).
                 - If 'replace' is selected, the table will be dropped and recreated with auto-assigned datatypes.
+                - If 'upsert' is selected, rows matching on keys are updated and the rest inserted (uses the bulk method).
             - index (string): Whether to include the DataFrame index in the table (default is False).
-            - chunksize (int): Chunksize will determine how many rows are written to the database at a time.
+            - chunksize (int): Chunksize will determine how many rows are written to the database at a time
+              (default is 1000, or 50000 for the bulk method).
+            - method (string): Set to 'bulk' to load through a staging table (see bulk_to_sql).
+            - keys (list): Columns to match rows on for 'upsert'.
+            - dtype (dict): SQL Server types of columns for the bulk method, e.g. {'Site': 'NVARCHAR(255)'}.
+            - workers (int): Number of connections loading chunks in parallel for the bulk method.
         """
 
+        current_event().rows = len(df)
+        if method == "bulk" or if_exists == "upsert":
+            if index:
+                df = df.reset_index()
+            return self.bulk_to_sql(
+                df,
+                name=name,
+                schema=schema,
+                if_exists=if_exists,
+                keys=keys,
+                dtype=dtype,
+                chunksize=chunksize or 50000,
+                workers=workers,
+            )
         df.to_sql(
             name=name,
             if_exists=if_exists,
             schema=schema,
             index=index,
             con=self.engine,
-            chunksize=chunksize,
+            chunksize=chunksize or 1000,
+        )
+        self._invalidate([f"{schema}.{name}"])
+
+    def _sql_type(self, series):
+        # SQL Server type for a dataframe column, used when no dtype is given
+        if pd.api.types.is_bool_dtype(series):
+            return "BIT"
+        if pd.api.types.is_integer_dtype(series):
+            return "BIGINT"
+        if pd.api.types.is_float_dtype(series):
+            return "FLOAT"
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return "DATETIME2"
+        length = series.dropna().astype(str).str.len().max()
+        if pd.isnull(length) or length <= 16:
+            return "NVARCHAR(16)"
+        if length > 4000:
+            return "NVARCHAR(MAX)"
+        return f"NVARCHAR({min(2 ** math.ceil(math.log2(length)), 4000)})"
+
+    def _merge_statement(self, target, stage, columns, keys):
+        """
+        Returns the MERGE statement that upserts the staging table into the target on keys.
+        """
+        on = " AND ".join(f"t.[{key}] = s.[{key}]" for key in keys)
+        updates = ", ".join(f"t.[{col}] = s.[{col}]" for col in columns if col not in keys)
+        insert_columns = ", ".join(f"[{col}]" for col in columns)
+        insert_values = ", ".join(f"s.[{col}]" for col in columns)
+        statement = f"MERGE {target} WITH (HOLDLOCK) AS t USING {stage} AS s ON {on}"
+        if updates:
+            statement += f" WHEN MATCHED THEN UPDATE SET {updates}"
+        statement += f" WHEN NOT MATCHED BY TARGET THEN INSERT ({insert_columns}) VALUES ({insert_values});"
+        return statement
+
+    def _table_exists(self, cursor, schema, name):
+        cursor.execute(
+            "SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?",
+            schema,
+            name,
         )
+        return cursor.fetchone()[0] > 0
+
+    def _load_chunks(self, df, insert, chunksize, conn):
+        # Inserts every [chunksize] rows of df as one parameter array
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
+        try:
+            for start in range(0, len(df), chunksize):
+                chunk = df.iloc[start : start + chunksize].astype(object)
+                rows = list(chunk.where(chunk.notnull(), None).itertuples(index=False, name=None))
+                cursor.executemany(insert, rows)
+            conn.commit()
+        finally:
+            cursor.close()
+
+    def _load_part(self, df, insert, chunksize):
+        with self._connection() as conn:
+            self._load_chunks(df, insert, chunksize, conn)
 
-    def execute(self, query, replacements={}):
+    @instrumented()
+    def bulk_to_sql(self, df, name, schema, if_exists="append", keys=None, dtype=None, chunksize=50000, workers=1):
+        """
+        Loads a pandas dataframe into the specified table through a staging table, for large loads.
+        Rows are written to the staging table with explicit column types, in parameter arrays of
+        [chunksize] rows, then moved to the table in a single set-based statement.
+            - df (DataFrame): The data which to insert into the SQL table.
+            - name (string): The table name to insert data into.
+            - schema (string): The schema location of the table.
+            - if_exists (string): How to treat the insertion. Accepted values are: 'fail','append','replace','upsert' (default is append).
+                - If 'replace' is selected, the table will be dropped and recreated with the staging column types.
+                - If 'upsert' is selected, rows matching on keys are updated and the rest inserted with a MERGE.
+                  Keys must be unique in the dataframe.
+            - keys (list): Columns to match rows on for 'upsert'.
+            - dtype (dict): SQL Server types of columns, e.g. {'Site': 'NVARCHAR(255)'}. Other columns are inferred.
+            - chunksize (int): Number of rows sent in each parameter array.
+            - workers (int): Number of connections loading chunks into the staging table in parallel,
+              at most one less than the size of the connection pool.
+        """
+        if if_exists not in ("fail", "append", "replace", "upsert"):
+            raise ValueError(f"'{if_exists}' is not valid for if_exists")
+        if if_exists == "upsert" and not keys:
+            raise ValueError("keys are required to upsert")
+
+        current_event().rows = len(df)
+        dtype = dtype or {}
+        columns = [str(col) for col in df.columns]
+        target = f"[{schema}].[{name}]"
+        stage = f"[{schema}].[_stage_{name}_{uuid.uuid4().hex[:8]}]"
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                exists = self._table_exists(cursor, schema, name)
+                if exists and if_exists == "fail":
+                    raise ValueError(f"Table {target} already exists.")
+
+                definition = ", ".join(
+                    f"[{col}] {dtype.get(col) or self._sql_type(df[col])}" for col in columns
+                )
+                cursor.execute(f"CREATE TABLE {stage} ({definition})")
+                conn.commit()
+
+                # 1. Load the staging table
+                insert = f"INSERT INTO {stage} ({', '.join(f'[{col}]' for col in columns)}) VALUES ({', '.join('?' for col in columns)})"
+                # This call already holds one of the pool's connections
+                limit = max_connections(self.engine)
+                if limit:
+                    workers = min(workers, max(limit - 1, 1))
+                if workers > 1 and len(df) > chunksize:
+                    # Each worker loads a contiguous slice of the rows over its own pooled connection
+                    size = math.ceil(len(df) / workers)
+                    parts = [df.iloc[start : start + size] for start in range(0, len(df), size)]
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        for future in [executor.submit(self._load_part, part, insert, chunksize) for part in parts]:
+                            future.result()
+                else:
+                    self._load_chunks(df, insert, chunksize, conn)
+
+                # 2. Move the rows to the table in one statement
+                if not exists or if_exists == "replace":
+                    if exists:
+                        cursor.execute(f"DROP TABLE {target}")
+                    cursor.execute(f"SELECT * INTO {target} FROM {stage}")
+                elif if_exists == "upsert":
+                    cursor.execute(self._merge_statement(target, stage, columns, keys))
+                else:
+                    column_list = ", ".join(f"[{col}]" for col in columns)
+                    cursor.execute(f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {stage}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.execute(f"DROP TABLE IF EXISTS {stage}")
+                conn.commit()
+                cursor.close()
+        self._invalidate([f"{schema}.{name}"])
+
+    @instrumented("execute")
+    def _execute_statement(self, query, replacements={}, params=None, many=False):
+        # Executes the statement (see execute), rolling back and raising its error if it fails
+        query = self._format_query(query, replacements)
+        with self._connection() as conn:
+            cursor, close = self._cursor(conn, query, params)
+            try:
+                self._execute(cursor, query, params, many)
+                if not close:
+                    self._drain(cursor)
+            except Exception:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                if close:
+                    cursor.close()
+        self._invalidate(query_tables(query))
+
+    def execute(self, query, replacements={}, params=None, many=False):
         """
         Executes query and returns results into a pandas dataframe via sqlalchmey
             - query (string): The SQL query to execute. Should be a SELECT
             - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list): Values bound to the ? placeholders of the query, or a list of
+              parameter sets if many is True
+            - many (bool): Executes the query once for every parameter set in params, sent
+              to the server as one parameter array (executemany)
+        A failed statement is rolled back and its database error given as a warning.
         """
-        query = self._format_query(query, replacements)
         try:
-            self.cursor.execute(query)
+            self._execute_statement(query, replacements=replacements, params=params, many=many)
         except pyodbc.DatabaseError as e:
-            print(e)
-            self.conn.rollback()
-        else:
-            self.conn.commit()
+            warnings.warn(f"Statement failed and was rolled back: {e}")
 
-    def get_scalar(self, query, replacements={}):
+    @instrumented()
+    def get_scalar(self, query, replacements={}, params=None):
         """
         Executes query and returns a single result
             - query (string): The SQL query to execute. Should be a SELECT
             - replacements (dict): Modifies the query and replaces any instance of [key] with [value]
+            - params (list): Values bound to the ? placeholders of the query
         """
         query = self._format_query(query, replacements)
-        return self.engine.scalar(query)
+        return self._fetch(query, first_value, params)
 
 
 if __name__ == "__main__":
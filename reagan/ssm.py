@@ -0,0 +1,210 @@
+from threading import Lock
+from time import monotonic
+import json
+import os
+import boto3
+
+# AWS caps get_parameters at 10 names per call
+MAX_NAMES_PER_CALL = 10
+
+_client_lock = Lock()
+_clients = {}
+
+_store_lock = Lock()
+_stores = {}
+
+
+def get_client(region="us-east-2"):
+    """
+    Returns the boto3 ssm client for the region, shared by the whole process.
+    Clients are thread-safe once created, the lock only guards their creation.
+    """
+    with _client_lock:
+        if region not in _clients:
+            _clients[region] = boto3.client(
+                "ssm",
+                region_name=region,
+                aws_access_key_id=os.environ["AWS_ACCESS_KEY"],
+                aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+            )
+        return _clients[region]
+
+
+def get_parameter_store(region="us-east-2"):
+    """
+    Returns the parameter store for the region, shared by the whole process.
+    If the REAGAN_PARAMETERS_FILE environment variable is set, parameters are
+    read from that json file instead of AWS.
+    """
+    with _store_lock:
+        if region not in _stores:
+            if os.environ.get("REAGAN_PARAMETERS_FILE"):
+                _stores[region] = LocalParameterStore(filepath=os.environ["REAGAN_PARAMETERS_FILE"])
+            else:
+                _stores[region] = ParameterStore(region=region)
+        return _stores[region]
+
+
+def set_parameter_store(store, region="us-east-2"):
+    """
+    Replaces the parameter store used for the region, e.g. with a LocalParameterStore
+    to run offline. Passing None resets it to the default.
+    """
+    with _store_lock:
+        if store is None:
+            _stores.pop(region, None)
+        else:
+            _stores[region] = store
+
+
+class ParameterStore(object):
+    """
+    Thread-safe cache in front of the AWS Parameter Store.
+        - region (string): AWS region of the parameters
+        - ttl (int): Seconds a value is cached for. None caches until invalidated.
+        - client: boto3 ssm client to use (default is the client shared by the process)
+    """
+
+    def __init__(self, region="us-east-2", ttl=3600, client=None):
+        self.region = region
+        self.ttl = ttl
+        self._client = client
+        self._lock = Lock()
+        self._cache = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_client(self.region)
+        return self._client
+
+    def _fetch(self, names):
+        # Returns {name: value} for the names found
+        if len(names) == 1:
+            parameter = self.client.get_parameter(Name=names[0], WithDecryption=True)
+            return {names[0]: parameter["Parameter"]["Value"]}
+
+        values = {}
+        for i in range(0, len(names), MAX_NAMES_PER_CALL):
+            response = self.client.get_parameters(
+                Names=names[i : i + MAX_NAMES_PER_CALL], WithDecryption=True
+            )
+            for parameter in response["Parameters"]:
+                values[parameter["Name"]] = parameter["Value"]
+        return values
+
+    def _fetch_path(self, path):
+        # Returns {name: value} for every parameter under the path
+        values = {}
+        paginator = self.client.get_paginator("get_parameters_by_path")
+        for response in paginator.paginate(
+            Path=path.rstrip("/") or "/", Recursive=True, WithDecryption=True
+        ):
+            for parameter in response["Parameters"]:
+                values[parameter["Name"]] = parameter["Value"]
+        return values
+
+    def _cached(self, name):
+        with self._lock:
+            if name not in self._cache:
+                return None
+            value, expires = self._cache[name]
+            if expires is not None and monotonic() >= expires:
+                del self._cache[name]
+                return None
+            return value
+
+    def _store(self, values):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        with self._lock:
+            for name, value in values.items():
+                self._cache[name] = (value, expires)
+
+    def get(self, name):
+        """
+        Returns the decrypted value of a parameter, from the cache when possible.
+            - name (string): Name of the parameter, e.g. /sqlserver/102
+        """
+        value = self._cached(name)
+        if value is None:
+            value = self._fetch([name])[name]
+            self._store({name: value})
+        return value
+
+    def get_parameters(self, names=None, path=None):
+        """
+        Fetches many parameters at once and caches them, so later calls to get cost nothing.
+        Names already cached are not fetched again. Returns a dict of {name: value}.
+            - names (list): Names of the parameters to fetch
+            - path (string): Fetch every parameter under this path, e.g. /gcp/
+        """
+        values = {}
+        if names:
+            missing = []
+            for name in names:
+                value = self._cached(name)
+                if value is None:
+                    missing.append(name)
+                else:
+                    values[name] = value
+            if missing:
+                fetched = self._fetch(missing)
+                self._store(fetched)
+                values.update(fetched)
+        if path:
+            fetched = self._fetch_path(path)
+            self._store(fetched)
+            values.update(fetched)
+        return values
+
+    def invalidate(self, names=None, path=None):
+        """
+        Removes parameters from the cache so they are fetched again on next use.
+        Clears the whole cache if neither names nor path are given.
+            - names (list): Names of the parameters to remove
+            - path (string): Remove every parameter under this path
+        """
+        with self._lock:
+            if names is None and path is None:
+                self._cache.clear()
+                return
+            for name in names or []:
+                self._cache.pop(name, None)
+            if path:
+                path = path.rstrip("/") + "/"
+                for name in [name for name in self._cache if name.startswith(path)]:
+                    del self._cache[name]
+
+
+class LocalParameterStore(ParameterStore):
+    """
+    Stand-in for the AWS Parameter Store that reads parameters from memory
+    or a json file of {name: value}, for running and testing offline.
+        - parameters (dict): Parameters to serve
+        - filepath (string): Path to a json file of parameters to serve
+    """
+
+    def __init__(self, parameters=None, filepath=None, ttl=None):
+        super().__init__(ttl=ttl)
+        self.parameters = dict(parameters or {})
+        if filepath:
+            with open(filepath, "r") as f:
+                self.parameters.update(json.load(f))
+        self.calls = 0
+
+    @property
+    def client(self):
+        return None
+
+    def _fetch(self, names):
+        self.calls += 1
+        if len(names) == 1 and names[0] not in self.parameters:
+            raise KeyError(f"Parameter {names[0]} not found")
+        return {name: str(self.parameters[name]) for name in names if name in self.parameters}
+
+    def _fetch_path(self, path):
+        self.calls += 1
+        path = path.rstrip("/") + "/"
+        return {
+            name: str(value) for name, value in self.parameters.items() if name.startswith(path)
+        }
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from itertools import count
+import re
+
+# Prepared statements kept per connection
+CACHE_SIZE = 100
+
+_placeholder = re.compile(r"%\((\w+)\)s|%s|%%")
+_names = count()
+# First keyword of a statement, after any comments and opening parentheses
+_keyword = re.compile(r"(?:\s+|--[^\n]*|/\*.*?\*/|\()*(\w+)", re.DOTALL)
+# Statements Postgres can PREPARE (WITH is a SELECT or data-modifying statement)
+PREPARABLE = ("select", "insert", "update", "delete", "values", "with")
+
+
+class StatementCache(object):
+    """
+    Least recently used cache of the prepared statements of one connection,
+    keyed by query text.
+        - size (int): Maximum number of statements kept
+        - on_evict (function): Called with each statement removed and the connection given
+          to put, to release it. The connection is not kept, as the pool hands out a new proxy
+          of the same DB-API connection on every checkout.
+    """
+
+    def __init__(self, size=CACHE_SIZE, on_evict=None):
+        self.size = size
+        self.on_evict = on_evict
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query):
+        statement = self.statements.get(query)
+        if statement is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.statements.move_to_end(query)
+        return statement
+
+    def put(self, query, statement, conn=None):
+        """
+        Adds the statement, evicting the least recently used above size.
+            - conn: The connection checked out when the statement is added, passed to on_evict
+        """
+        self.statements[query] = statement
+        self.statements.move_to_end(query)
+        while len(self.statements) > self.size:
+            evicted = self.statements.popitem(last=False)[1]
+            if self.on_evict is not None:
+                self.on_evict(evicted, conn)
+
+
+def statement_cache(conn, size=None, on_evict=None):
+    """
+    Returns the statement cache of a pooled connection (a SQLAlchemy raw connection),
+    kept in its info dict so it lasts as long as the DB-API connection.
+        - size (int): Maximum number of statements kept (default is CACHE_SIZE)
+    """
+    cache = conn.info.get("reagan_statements")
+    if cache is None:
+        cache = conn.info["reagan_statements"] = StatementCache(size or CACHE_SIZE, on_evict)
+    return cache
+
+
+def preparable(query, params, many=False):
+    """
+    Returns whether the query can run as a prepared statement with the params: a SELECT,
+    INSERT, UPDATE, DELETE or VALUES statement whose parameters are all scalars. Others, e.g.
+    DDL or a tuple for IN %s (adapted by psycopg2 to a list of values), are executed as they are.
+        - many (bool): params is a list of parameter sets
+    """
+    match = _keyword.match(query)
+    if match is None or match.group(1).lower() not in PREPARABLE:
+        return False
+    for values in params if many else [params]:
+        for value in values.values() if isinstance(values, dict) else values:
+            if isinstance(value, (tuple, list, dict)):
+                return False
+    return True
+
+
+def statement_name():
+    """
+    Returns a name for a server-side prepared statement, unique in the process.
+    """
+    return f"reagan_{next(_names)}"
+
+
+def to_numbered(query):
+    """
+    Converts a query with psycopg2 placeholders (%s or %(name)s) to Postgres
+    numbered parameters ($1, $2, ...) for PREPARE. Returns the query and the
+    parameter names in order (positions for %s), to order the values with.
+    """
+    order = []
+    positions = {}
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        name = match.group(1)
+        if name is None:
+            order.append(len(order))
+            return f"${len(order)}"
+        if name not in positions:
+            order.append(name)
+            positions[name] = len(order)
+        return f"${positions[name]}"
+
+    return _placeholder.sub(replace, query), order
+
+
+def ordered(params, order):
+    """
+    Returns the values of params (a sequence or a dict) in the order of the
+    parameters returned by to_numbered.
+    """
+    if isinstance(params, dict):
+        return [params[name] for name in order]
+    if len(params) != len(order):
+        raise ValueError(f"The query has {len(order)} parameters but {len(params)} were given")
+    return list(params)
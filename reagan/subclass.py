@@ -1,8 +1,8 @@
 from pandas.io.json import json_normalize
+from reagan.query import compile_query
+from reagan.ssm import get_parameter_store
 import pandas as pd
 import numpy as np
-import boto3
-import os
 
 
 class Subclass(object):
@@ -10,11 +10,38 @@ class Subclass(object):
         super().__init__()
         self.verbose = verbose
         self.region = region
-        self.ssm = boto3.client("ssm",region_name=self.region,aws_access_key_id=os.environ["AWS_ACCESS_KEY"],aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"])
+        # Parameters are cached by a store shared across every instance in the process
+        self.parameters = get_parameter_store(self.region)
+        # Instrumentation hooks for this instance only (see reagan.instrumentation)
+        self.hooks = []
+
+    @property
+    def ssm(self):
+        return self.parameters.client
 
     def get_parameter_value(self,parameter_name):
-        parameter = self.ssm.get_parameter(Name=parameter_name,WithDecryption=True)
-        return parameter['Parameter']['Value']
+        return self.parameters.get(parameter_name)
+
+    def get_parameters(self, names=None, path=None):
+        """
+        Fetches many parameters in as few calls as possible and caches them,
+        so later calls to get_parameter_value cost nothing.
+            - names (list): Names of the parameters to fetch
+            - path (string): Fetch every parameter under this path, e.g. /gcp/
+        """
+        return self.parameters.get_parameters(names=names, path=path)
+
+    def add_hook(self, hook):
+        """
+        Registers an instrumentation hook (reagan.instrumentation.Hook) that
+        receives the start and end events of this instance's calls.
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
 
     def vprint(self, obj):
         if self.verbose:
@@ -28,42 +55,72 @@ class Subclass(object):
         returns: a dataframe with each entry for the target column separated, with each element moved into a new row.
         The values in the other columns are duplicated across the newly divided rows.
         """
-        row_accumulator = []
+        counts = np.empty(len(df), dtype=np.int64)
+        values = []
 
-        def _split_list_to_rows(row, separator):
-            split_row = row[target_column]
+        # Only the target column is walked in Python, the other columns are
+        # repeated with a single take on the row positions
+        for num, value in enumerate(df[target_column].tolist()):
             try:
-                for s in split_row:
-                    new_row = row.to_dict()
-                    new_row[target_column] = s
-                    row_accumulator.append(new_row)
-            except:
+                split_row = list(value)
+            except TypeError:
                 split_row = [np.nan]
-                for s in split_row:
-                    new_row = row.to_dict()
-                    new_row[target_column] = s
-                    row_accumulator.append(new_row)
+            counts[num] = len(split_row)
+            values.extend(split_row)
+
+        if not values:
+            return pd.DataFrame()
 
-        df.apply(_split_list_to_rows, axis=1, args=(separator,))
-        new_df = pd.DataFrame(row_accumulator)
-        return new_df
+        new_df = df.take(np.repeat(np.arange(len(df)), counts))
+        new_df.index = pd.RangeIndex(len(new_df))
+        new_df[target_column] = pd.Series(values, index=new_df.index)
+        return new_df.infer_objects()
 
     def _get_nested_columns(self, df, columns):
         """
-        When unnesting the
-        """
-        nested_cols = {}
-        for row in df.iterrows():
-            for num, value in enumerate(row[1]):
-                col = df.columns.tolist()[num]
-                # This behavior means we could potentially want a dict as a final value, but not a list
-                if type(value) == list:
-                    nested_cols[col] = "list"
-                elif col in columns:
-                    pass
-                elif type(value) == dict:
-                    nested_cols[col] = "dict"
-        return nested_cols
+        Returns the columns that still need unnesting, mapped to "list" or "dict".
+
+        Each column is typed in a single pass over its values. A column is
+        labelled by the last list (or dict, if not a requested column) found
+        in it, and columns are ordered by the first row they are nested in.
+        """
+        columns = columns or []
+        found = []
+        for num, col in enumerate(df.columns):
+            series = df.iloc[:, num]
+            if series.dtype != object:
+                continue
+            types = series.map(type).to_numpy()
+            is_list = types == list
+            is_dict = types == dict if col not in columns else np.zeros(len(types), dtype=bool)
+            nested = is_list | is_dict
+            if not nested.any():
+                continue
+            last_list = len(types) - is_list[::-1].argmax() if is_list.any() else 0
+            last_dict = len(types) - is_dict[::-1].argmax() if is_dict.any() else 0
+            found.append((nested.argmax(), num, col, "list" if last_list > last_dict else "dict"))
+        return {col: typ for _, _, col, typ in sorted(found)}
+
+    def _split_dataframe_dict(self, df, target_column):
+        """
+        Expands a column of dicts into one column per key, named
+        [target_column]_[key], in order of first appearance. The new columns
+        are appended to the end of the dataframe and the original is dropped.
+        """
+        records = []
+        for value in df[target_column].tolist():
+            if type(value) == dict:
+                records.append(value)
+            elif type(value) == list:
+                records.append(dict(enumerate(value)))
+            elif pd.isnull(value):
+                records.append({})
+            else:
+                records.append({0: value})
+
+        df_new = pd.DataFrame(records, index=df.index)
+        df_new.columns = [f"{target_column}_{x}" for x in df_new.columns.tolist()]
+        return pd.concat([df.drop(columns=target_column), df_new], axis=1)
 
     def _reduce_columns(self, df, final_columns, sep="_"):
 
@@ -84,7 +141,7 @@ class Subclass(object):
             for col in current_columns:
                 action = "Keep" if col in columns_to_keep else "Remove"
                 self.vprint(f"{col} - {action}")
-        return df[list(columns_to_keep)]
+        return df[[col for col in df.columns if col in columns_to_keep]]
 
     def _unnest(self, df, columns=None):
 
@@ -99,49 +156,162 @@ class Subclass(object):
                     df = self._split_dataframe_list(df, col, separator="_")
                 elif typ == "dict":
                     self.vprint("\nSplitting {0} into separate columns".format(col))
-                    df_new = df[col].apply(lambda x: {} if pd.isnull(x) else x)
-                    df_new = df_new.apply(pd.Series)
-                    df_new.columns = list(
-                        map(lambda x: str(col) + "_" + str(x), df_new.columns.tolist())
-                    )
-                    df = pd.concat([df, df_new], axis=1).drop(columns=col)
+                    df = self._split_dataframe_dict(df, col)
             if columns:
                 df = self._reduce_columns(df, columns)
             cols = self._get_nested_columns(df, columns)
         return df
 
+    def _compile_columns(self, columns, sep="_"):
+        """
+        Compiles the requested columns into a path plan: every column name
+        maps to "leaf", and every shorter path leading to one maps to "branch".
+        """
+        plan = {}
+        for col in columns:
+            split_col = col.split(sep)
+            for i in range(len(split_col) - 1):
+                plan.setdefault(sep.join(split_col[0 : i + 1]), "branch")
+            plan[col] = "leaf"
+        return plan
+
+    def _flatten_value(self, value, name, plan, sep="_"):
+        """
+        Walks a single raw value at path [name] and returns the rows it
+        produces, as dicts holding only the leaf columns in the plan.
+            - Lists produce one set of rows per element (an empty list produces none)
+            - Dicts on a branch are descended into, one key at a time, and the
+              rows of each key are combined with each other
+            - Anything on a leaf, including a dict, is kept as the value
+        """
+        if type(value) == list:
+            rows = []
+            for item in value:
+                rows.extend(self._flatten_value(item, name, plan, sep))
+            return rows
+        if plan[name] == "leaf":
+            return [{name: value}]
+        if type(value) != dict:
+            return [{}]
+
+        rows = [{}]
+        for key, child in value.items():
+            child_name = f"{name}{sep}{key}"
+            if child_name in plan:
+                child_rows = self._flatten_value(child, child_name, plan, sep)
+                rows = [{**row, **child_row} for row in rows for child_row in child_rows]
+        return rows
+
+    def _flatten_records(self, data, columns):
+        """
+        Flattens raw API records straight to a dataframe holding only the
+        requested columns, in the order requested. Nothing outside of the
+        column paths is ever turned into a column. Rows produced by several
+        lists in the same record are combined in the order of the columns: the
+        list of the first column varies slowest. _unnest instead splits the
+        shallowest lists first, so crossed lists can give the same rows in
+        another order.
+        """
+        if isinstance(data, dict):
+            data = [dict(zip(data, values)) for values in zip(*data.values())]
+
+        plan = self._compile_columns(columns)
+        order = {name: num for num, name in enumerate(plan)}
+
+        # Top level keys are matched once per distinct key rather than once per record
+        seen, keys = set(), {}
+        rows = []
+        for record in data:
+            new_keys = record.keys() - seen
+            if new_keys:
+                seen.update(new_keys)
+                for key in new_keys:
+                    if key.replace(".", "_") in plan:
+                        keys[key] = key.replace(".", "_")
+                keys = dict(sorted(keys.items(), key=lambda item: order[item[1]]))
+
+            record_rows = [{}]
+            for key, name in keys.items():
+                if key in record:
+                    value_rows = self._flatten_value(record[key], name, plan)
+                    record_rows = [{**row, **value_row} for row in record_rows for value_row in value_rows]
+            rows.extend(record_rows)
+
+        found = set()
+        for row in rows:
+            found.update(row)
+        df = pd.DataFrame.from_records(
+            rows, columns=[col for col in dict.fromkeys(columns) if col in found]
+        )
+        df.index = pd.RangeIndex(len(df))
+        return df
+
     def _format_query(self, query_input, replacements={}):
         """
-        Takes in a string or .sql file and optional 'replacements' dictionary.
+        Takes in a string, .sql file or QueryTemplate and optional 'replacements' dictionary.
 
         Returns a string containing the formatted sql query and replaces the
         keys in the replacements dictionary with their values.
         """
 
-        # checks if input is a file or query
-        if query_input.split(".")[-1] == "sql":
-            # print("Reading .sql File")
-            f = open(query_input, "r")
-            # reading files with a guillemet », add an uncessary Â to the string
-            query = f.read().replace("Â", "")
-            f.close()
-        else:
-            query = query_input
-        if replacements:
-            for key, value in replacements.items():
-                query = query.replace(key, str(value))
-        return query
+        # .sql files are only read again when they change (see reagan.query)
+        return compile_query(query_input).format(replacements)
 
-    def _json_to_df(self, data, columns=[]):
+    def _json_to_df(self, data, columns=[], flatten="unnest"):
+        """
+        Converts a list of raw API records to a pandas dataframe, splitting
+        nested lists into rows and nested dicts into [parent]_[key] columns.
+            - data (list): The records to convert
+            - columns (list): If given, only return these columns
+            - flatten (string): How to flatten the records. Accepted values are: 'unnest','plan' (default is unnest).
+                - If 'plan' is selected (and columns are given), the records are walked once and only the
+                  column paths are read, without building a dataframe of the full objects first.
+                  Columns are returned in the order requested. When a record has several lists,
+                  the rows are the same as unnest's but ordered by the requested columns (the
+                  first column's list varies slowest), not by how deep the lists are.
+        """
+        columns = columns or []
 
-        # df = json_normalize(data)
-        df = pd.DataFrame(data)
-        df.columns = [col.replace(".", "_") for col in df.columns.to_list()]
-        df = self._unnest(df, columns)
+        if flatten == "plan" and columns:
+            df = self._flatten_records(data, columns)
+        else:
+            # df = json_normalize(data)
+            df = pd.DataFrame(data)
+            df.columns = [col.replace(".", "_") for col in df.columns.to_list()]
+            df = self._unnest(df, columns)
 
         columns_not_found = set(columns) - set(df.columns)
         self.vprint(
             f'\nColumns not found in the object: {", ".join(columns_not_found)}'
         )
 
-        return df
\ No newline at end of file
+        return df
+
+    def _json_to_df_chunks(self, pages, columns=[], flatten="unnest"):
+        """
+        Generator that converts pages of raw API records as they arrive,
+        yielding one pandas dataframe per page.
+            - pages (iterable): Lists of records, e.g. one per API response
+            - columns (list): If given, every chunk has exactly these columns, in this order,
+              with the columns not found in a page filled with nulls
+            - flatten (string): How to flatten the records (see _json_to_df)
+        """
+        columns = list(dict.fromkeys(columns or []))
+        for page in pages:
+            if not page:
+                continue
+            df = self._json_to_df(page, columns, flatten=flatten)
+            if columns:
+                df = df.reindex(columns=columns)
+            yield df
+
+    def _concat_chunks(self, chunks, columns=None):
+        """
+        Collects dataframe chunks into a single dataframe. Columns are those
+        of every chunk, in order of first appearance (or the given columns),
+        with values missing from a chunk filled with nulls.
+        """
+        chunks = list(chunks)
+        if not chunks:
+            return pd.DataFrame(columns=list(dict.fromkeys(columns or [])))
+        return pd.concat(chunks, ignore_index=True, sort=False)
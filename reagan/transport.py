@@ -0,0 +1,35 @@
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+import threading
+
+
+def authorized_http(credentials):
+    """
+    Returns a new HTTP transport authorized with the credentials.
+    """
+    return AuthorizedHttp(credentials, http=httplib2.Http())
+
+
+class ThreadTransports(object):
+    """
+    HTTP transports of a Google API connector, one per thread, since httplib2
+    transports are not thread-safe. The thread that created the connector uses
+    the transport of its service; other threads get their own on first use.
+        - new_http (function): Returns a new transport, e.g. authorized_http(credentials)
+    """
+
+    def __init__(self, new_http):
+        self.new_http = new_http
+        self.owner = threading.get_ident()
+        self._local = threading.local()
+
+    def get(self):
+        """
+        Returns the transport of this thread, or None for the service's own.
+        """
+        if threading.get_ident() == self.owner:
+            return None
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = self.new_http()
+        return http
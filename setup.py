@@ -13,5 +13,6 @@ setup(
     packages=["reagan"],
     zip_safe=False,
     install_requires=requirements,
+    extras_require={"cache": ["pyarrow"], "async": ["asyncpg"]},
 )
 
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import unittest
+import pandas as pd
+
+try:
+    from benchmarks import stand_ins
+    from reagan.async_psql import AsyncPSQL
+except ImportError:
+    AsyncPSQL = None
+
+# Set REAGAN_TEST_POSTGRES to a json connection dict of a local Postgres to run these tests
+POSTGRES = json.loads(os.environ.get("REAGAN_TEST_POSTGRES", "null"))
+
+
+@unittest.skipIf(AsyncPSQL is None or POSTGRES is None, "asyncpg or REAGAN_TEST_POSTGRES is not available")
+class TestAsyncPSQL(unittest.TestCase):
+    def run_async(self, test):
+        async def run():
+            async with stand_ins.local_async_psql(POSTGRES, max_size=3) as ps:
+                await ps.execute("DROP SCHEMA IF EXISTS reagan_test CASCADE")
+                await ps.execute("CREATE SCHEMA reagan_test")
+                try:
+                    await test(ps)
+                finally:
+                    await ps.execute("DROP SCHEMA reagan_test CASCADE")
+
+        asyncio.run(run())
+
+    def test_to_sql_and_to_df(self):
+        df = pd.DataFrame({"id": range(100), "name": [f"x{i}" if i % 3 else None for i in range(100)], "cost": 0.5})
+
+        async def test(ps):
+            await ps.to_sql(df, schema="reagan_test", table="t")
+            pd.testing.assert_frame_equal(await ps.to_df("SELECT * FROM reagan_test.t ORDER BY id"), df)
+            empty = await ps.to_df("SELECT * FROM reagan_test.t WHERE id < $1", params=[0])
+            self.assertEqual(empty.columns.tolist(), ["id", "name", "cost"])
+            with self.assertRaises(ValueError):
+                await ps.to_sql(df, schema="reagan_test", table="t")
+
+        self.run_async(test)
+
+    def test_concurrent_lookups(self):
+        async def test(ps):
+            await ps.execute("CREATE TABLE reagan_test.t (id INTEGER, name TEXT)")
+            await ps.execute("INSERT INTO reagan_test.t VALUES ($1, $2)", params=[(i, f"x{i}") for i in range(50)], many=True)
+            names = await asyncio.gather(*[ps.get_scalar("SELECT name FROM reagan_test.t WHERE id = $1", params=[i]) for i in range(50)])
+            self.assertEqual(names, [f"x{i}" for i in range(50)])
+
+        self.run_async(test)
+
+    def test_upsert(self):
+        df = pd.DataFrame({"id": range(5), "name": "a"})
+
+        async def test(ps):
+            await ps.to_sql(df, schema="reagan_test", table="t", if_exists="upsert", keys=["id"])
+            await ps.to_sql(df.iloc[3:].assign(name="b"), schema="reagan_test", table="t", if_exists="upsert", keys=["id"])
+            names = await ps.to_df("SELECT name FROM reagan_test.t ORDER BY id")
+            self.assertEqual(names["name"].tolist(), ["a", "a", "a", "b", "b"])
+
+        self.run_async(test)
+
+    def test_nullable_integers(self):
+        # Integers with NULLs are floats in pandas, sent as ints to the integer columns
+        async def test(ps):
+            await ps.execute("CREATE TABLE reagan_test.t (id INTEGER PRIMARY KEY, n BIGINT, cost REAL)")
+            df = pd.DataFrame({"id": [1, 2], "n": [None, 2 ** 40], "cost": [None, 2.0]})
+            await ps.to_sql(df, schema="reagan_test", table="t", if_exists="append")
+            await ps.to_sql(df.assign(n=[3, None]), schema="reagan_test", table="t", if_exists="upsert", keys=["id"])
+            rows = await ps.to_df("SELECT * FROM reagan_test.t ORDER BY id")
+            self.assertEqual(rows["n"].tolist()[0], 3)
+            self.assertTrue(pd.isnull(rows["n"][1]))
+            self.assertTrue(pd.isnull(rows["cost"][0]))
+
+        self.run_async(test)
+
+
+if __name__ == "__main__":
+    unittest.main()
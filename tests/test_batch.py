@@ -0,0 +1,84 @@
+import threading
+import time
+import unittest
+from reagan.batch import prefetch, query_names, run_many
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def query(self, query, replacements={}):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        if query == "fail":
+            raise ValueError(query)
+        return [query] * replacements.get("n", 1)
+
+    def test_query_names(self):
+        names = query_names(["sql/sites.sql", "SELECT 1", "/tmp/placements.sql"])
+        self.assertEqual(list(names), ["sites", "query_1", "placements"])
+        with self.assertRaises(ValueError):
+            query_names(["a/sites.sql", "b/sites.sql"])
+
+    def test_results_in_order(self):
+        queries = {f"q{i}": str(i) for i in range(8)}
+        results = run_many(self.query, queries, workers=3, replacements={"n": 2})
+        self.assertEqual(list(results), list(queries))
+        self.assertEqual(results["q5"], ["5", "5"])
+        self.assertEqual(self.peak, 3)
+
+    def test_query_arguments(self):
+        results = run_many(self.query, {"a": {"query": "x", "replacements": {"n": 3}}}, workers=2)
+        self.assertEqual(results["a"], ["x", "x", "x"])
+
+    def test_errors(self):
+        queries = ["a", "fail", "b"]
+        with self.assertRaises(ValueError):
+            run_many(self.query, queries, workers=2)
+        results = run_many(self.query, queries, workers=2, errors="return")
+        self.assertIsInstance(results["query_1"], ValueError)
+        self.assertEqual(results["query_2"], ["b"])
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_reads_ahead(self):
+        read = []
+
+        def pages():
+            for page in range(5):
+                read.append(page)
+                yield page
+
+        items = prefetch(pages())
+        self.assertEqual(next(items), 0)
+        time.sleep(0.05)
+        # The next pages were read while the first was handled, at most size + 1 ahead
+        self.assertIn(read, [[0, 1], [0, 1, 2]])
+        self.assertEqual(list(items), [1, 2, 3, 4])
+
+    def test_errors_and_close(self):
+        def pages():
+            yield 1
+            raise ValueError("page")
+
+        items = prefetch(pages())
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+        threads = threading.active_count()
+        items = prefetch(iter(range(100)))
+        next(items)
+        items.close()
+        self.assertEqual(threading.active_count(), threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
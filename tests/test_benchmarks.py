@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+import warnings
+from benchmarks import stand_ins
+from benchmarks.run import BENCHMARKS, compare, run_benchmarks, save
+from reagan.ssm import set_parameter_store
+
+
+class TestStandIns(unittest.TestCase):
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def test_dcm_pages_and_report(self):
+        dcm = stand_ins.local_dcm(
+            stand_ins.DCMService(placements=stand_ins.placements(2500), report=stand_ins.report_csv(10))
+        )
+        self.assertEqual(len(dcm.list("placements", arguments={}, all=True)), 2500)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            df = dcm.report_to_df(reportId="1", fileId="1", params={})
+        self.assertEqual(len(df), 10)
+
+    def test_sheet_to_df(self):
+        ss = stand_ins.local_smartsheet({1: stand_ins.sheet(5, columns=3)})
+        df = ss.sheet_to_df(1)
+        self.assertEqual(len(df), 15)
+        self.assertEqual(df["columns_title"].iloc[1], "Column 1")
+
+
+class TestBenchmarks(unittest.TestCase):
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def test_every_benchmark_runs(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", FutureWarning)
+            results = run_benchmarks([20], repeat=1, verbose=False)
+        self.assertEqual(len(results), len(BENCHMARKS))
+        for result in results:
+            if "skipped" not in result:
+                self.assertGreater(result["seconds"], 0)
+                self.assertGreater(result["peak_mb"], 0)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "results.json")
+            save(results, path)
+            df = compare(path, path)
+        ran = df["seconds"].notnull()
+        self.assertTrue((df.loc[ran, "time_ratio"] == 1).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
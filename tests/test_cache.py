@@ -0,0 +1,117 @@
+import tempfile
+import time
+import unittest
+import pandas as pd
+from reagan.cache import ResultCache, normalize_query, query_tables
+from reagan.instrumentation import Hook
+
+try:
+    from benchmarks import stand_ins
+    from reagan.psql import PSQL
+except ImportError:
+    PSQL = None
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.directory.name, format="pickle")
+        self.df = pd.DataFrame({"k": range(5), "v": list("abcde")})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_normalize(self):
+        self.assertEqual(normalize_query("SELECT *\n  FROM t -- all rows\n;"), "SELECT * FROM t")
+        self.assertEqual(
+            self.cache.key("a", "SELECT * FROM t"), self.cache.key("a", " SELECT *\n\tFROM t;")
+        )
+        self.assertNotEqual(self.cache.key("a", "SELECT * FROM t"), self.cache.key("b", "SELECT * FROM t"))
+        self.assertNotEqual(self.cache.key("a", "SELECT ?", [1]), self.cache.key("a", "SELECT ?", [2]))
+        self.assertEqual(
+            query_tables("SELECT * FROM [gcm].[Site] s JOIN gcm.Placement p ON s.id = p.site_id"),
+            {"gcm.site", "gcm.placement"},
+        )
+
+    def test_put_and_get(self):
+        key = self.cache.key("a", "SELECT * FROM t")
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, self.df, alias="a", tables=["t"])
+        pd.testing.assert_frame_equal(self.cache.get(key), self.df)
+        self.assertEqual(self.cache.size()["results"], 1)
+
+    def test_ttl(self):
+        self.cache.ttl = 0
+        key = self.cache.key("a", "SELECT * FROM t")
+        self.cache.put(key, self.df)
+        time.sleep(0.01)
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(self.cache.size()["results"], 0)
+
+    def test_least_recently_used_evicted(self):
+        keys = [self.cache.key("a", f"SELECT {i}") for i in range(3)]
+        self.cache.put(keys[0], self.df)
+        self.cache.max_bytes = self.cache.size()["bytes"] * 2
+        self.cache.put(keys[1], self.df)
+        self.cache.get(keys[0])
+        self.cache.put(keys[2], self.df)
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+
+    def test_invalidate(self):
+        self.cache.put("1", self.df, alias="a", tables=["gcm.site"])
+        self.cache.put("2", self.df, alias="b", tables=["gcm.site"])
+        self.cache.put("3", self.df, alias="a", tables=["gcm.placement"])
+        self.assertEqual(self.cache.invalidate("Site", alias="a"), 1)
+        self.assertEqual(self.cache.invalidate("[gcm].[site]"), 1)
+        self.assertIsNotNone(self.cache.get("3"))
+        self.assertEqual(self.cache.clear(), 1)
+
+    def test_invalidate_schema_removes_bare_names(self):
+        # A query naming the table without a schema can read the table of any schema
+        self.cache.put("1", self.df, alias="a", tables=query_tables("SELECT * FROM Site"))
+        self.cache.put("2", self.df, alias="a", tables=query_tables("SELECT * FROM db.gcm.site"))
+        self.cache.put("3", self.df, alias="a", tables=query_tables("SELECT * FROM dbo.site"))
+        self.assertEqual(self.cache.invalidate("[gcm].[Site]"), 2)
+        self.assertIsNotNone(self.cache.get("3"))
+
+
+class Recorder(Hook):
+    def __init__(self):
+        self.ended = []
+
+    def on_end(self, event):
+        self.ended.append(event)
+
+
+@unittest.skipIf(PSQL is None, "psycopg2 is not available")
+class TestConnectorCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ps = stand_ins.local_psql(cache=ResultCache(self.directory.name, format="pickle"))
+        self.recorder = self.ps.add_hook(Recorder())
+        self.ps.execute("CREATE TABLE t (k INTEGER, v TEXT)")
+        self.ps.execute("INSERT INTO t VALUES (?, ?)", params=[(i, f"x{i}") for i in range(5)], many=True)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hits_and_invalidation(self):
+        query = "SELECT * FROM t WHERE k < ?"
+        first = self.ps.to_df(query, params=[3])
+        second = self.ps.to_df(query, params=[3])
+        pd.testing.assert_frame_equal(first, second)
+        events = [event for event in self.recorder.ended if event.operation == "to_df"]
+        self.assertEqual([(event.cache_hits, event.cache_misses) for event in events], [(0, 1), (1, 0)])
+
+        # Writing to the table removes its cached results
+        self.ps.execute("DELETE FROM t WHERE k = ?", params=[0])
+        self.assertEqual(len(self.ps.to_df(query, params=[3])), 2)
+
+        # Including writes naming its schema
+        self.ps.to_sql(pd.DataFrame({"k": [0], "v": ["x0"]}), schema="main", table="t", if_exists="append")
+        self.assertEqual(len(self.ps.to_df(query, params=[3])), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+import io
+import unittest
+from unittest import mock
+from benchmarks import stand_ins
+from googleapiclient.errors import HttpError
+import pandas as pd
+from reagan.ratelimit import QuotaExceeded, RateLimiter
+from reagan.ssm import set_parameter_store
+
+
+class TestDCMList(unittest.TestCase):
+    def setUp(self):
+        self.service = stand_ins.DCMService(placements=stand_ins.placements(2500))
+        self.dcm = stand_ins.local_dcm(self.service)
+        self.transports = self.service.placements().transports
+
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def ids(self, data):
+        return [int(item["id"]) for item in data]
+
+    def test_ids_in_batches(self):
+        # Ids in reverse order, with two that do not exist
+        ids = [100000 + i for i in range(2400, 1000, -1)] + [1, 2]
+        sequential = self.dcm.list("placements", arguments={"ids": ids}, ids_per_request=300)
+        self.assertEqual(self.transports, [None] * 5)
+
+        del self.transports[:]
+        parallel = self.dcm.list("placements", arguments={"ids": ids}, workers=3, ids_per_request=300)
+        self.assertEqual(self.ids(parallel), self.ids(sequential))
+        self.assertEqual(sorted(self.ids(parallel)[-2:]), [1, 2])
+        self.assertEqual(sorted(self.ids(parallel)[:-2]), sorted(ids[:-2]))
+        # Each worker uses its own HTTP transport
+        self.assertEqual(len(self.transports), 5)
+        self.assertNotIn(None, self.transports)
+        self.assertLessEqual(len(set(map(id, self.transports))), 3)
+
+    def test_single_request_for_few_ids(self):
+        data = self.dcm.list("placements", arguments={"ids": [100001, 100002, 3]}, workers=4)
+        self.assertEqual(sorted(self.ids(data)), [3, 100001, 100002])
+        self.assertEqual(self.transports, [None])
+
+    def test_prefetch_pages(self):
+        data = self.dcm.list("placements", arguments={}, all=True, workers=2)
+        self.assertEqual(self.ids(data), [100000 + i for i in range(2500)])
+        self.assertEqual(len(self.transports), 3)
+        self.assertNotIn(None, self.transports)
+
+        chunks = self.dcm.to_df_chunks("placements", arguments={}, columns=["id", "name"], all=True, workers=2)
+        self.assertEqual(len(next(chunks)), 1000)
+        chunks.close()
+
+
+@mock.patch("reagan.dcm.sleep")
+class TestDCMBatches(unittest.TestCase):
+    def setUp(self):
+        self.service = stand_ins.DCMService(placements=stand_ins.placements(250))
+        self.dcm = stand_ins.local_dcm(self.service)
+        self.placements = self.service.placements()
+
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def test_get_many(self, sleep):
+        ids = [100200, 5, 100001] + list(range(100010, 100110))
+        self.placements.failures = {"100001": 1, "100050": 2}
+        results = self.dcm.get_many("placements", ids, batch_size=50)
+
+        self.assertEqual(len(results), len(ids))
+        self.assertEqual(results[0]["id"], "100200")
+        self.assertIsInstance(results[1], HttpError)
+        self.assertEqual(results[2]["id"], "100001")
+        self.assertEqual([result["id"] for result in results[3:]], [str(i) for i in ids[3:]])
+        # 3 batches, then the two rate limited calls alone, then the one failing twice
+        self.assertEqual([len(batch) for batch in self.service.batches], [50, 50, 3, 2, 1])
+        self.assertEqual(self.dcm.dcm_api_calls, 106)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_errors(self, sleep):
+        self.placements.failures = {"100001": 5}
+        results = self.dcm.get_many("placements", [100000, 100001], retries=2)
+        self.assertEqual(results[1].resp.status, 403)
+        self.assertEqual(len(self.service.batches), 3)
+        with self.assertRaises(HttpError):
+            self.dcm.get_many("placements", [100000, 1], errors="raise")
+
+    def test_get(self, sleep):
+        self.assertEqual(self.dcm.get("placements", 100001)["id"], "100001")
+        self.assertEqual(self.dcm.get("placements", 1), {"id": "1"})
+        # Quota errors are raised rather than returned as missing items
+        self.placements.failures = {"100002": 10}
+        with mock.patch("reagan.ratelimit.sleep"):
+            with self.assertRaises(HttpError):
+                self.dcm.get("placements", 100002)
+        self.dcm.limiter = RateLimiter(per_day=1, max_wait=1)
+        self.dcm.get("placements", 100003)
+        with self.assertRaises(QuotaExceeded):
+            self.dcm.get("placements", 100004)
+
+    def test_writes(self, sleep):
+        patched = self.dcm.patch_many("placements", [{"id": "100003", "name": "a"}, {"id": "100004", "name": "b"}])
+        self.assertEqual([item["name"] for item in patched], ["a", "b"])
+        self.assertEqual(self.placements.by_id["100004"]["name"], "b")
+
+        updated = self.dcm.update_many("placements", [{"id": "100005", "name": "c"}])
+        self.assertEqual(self.placements.by_id["100005"], {"id": "100005", "name": "c"})
+        self.assertEqual(updated, [{"id": "100005", "name": "c"}])
+
+        inserted = self.dcm.insert_many("placements", [{"name": "d"}, {"name": "e"}])
+        self.assertEqual([item["id"] for item in inserted], ["100250", "100251"])
+        self.assertEqual(self.dcm.dcm_api_calls, 5)
+
+
+class TestDCMReports(unittest.TestCase):
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def report(self, data):
+        self.service = stand_ins.DCMService(report=data)
+        return stand_ins.local_dcm(self.service)
+
+    def expected(self, data):
+        lines = data.decode().splitlines()
+        return pd.read_csv(io.StringIO("\n".join(lines[lines.index("Report Fields") + 1 : -1])))
+
+    @mock.patch("reagan.dcm.SPOOL_SIZE", 5000)
+    @mock.patch("reagan.dcm.DOWNLOAD_CHUNK_SIZE", 1000)
+    def test_report_to_df(self):
+        data = stand_ins.report_csv(250)
+        dcm = self.report(data)
+        df = dcm.report_to_df(reportId="1")
+        pd.testing.assert_frame_equal(df, self.expected(data))
+        # Without the grand total, ids are read as integers
+        self.assertEqual(df["Campaign ID"].dtype, "int64")
+
+        chunks = list(dcm.report_chunks(reportId="1", fileId="1", chunksize=100))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 100, 50])
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+
+    def test_report_formats(self):
+        empty = stand_ins.report_csv(0)
+        df = self.report(empty).report_to_df(reportId="1", fileId="1")
+        self.assertEqual(len(df), 0)
+        self.assertEqual(df.columns[0], "Date")
+
+        data = stand_ins.report_csv(10)
+        df = self.report(data.replace(b"\n", b"\r\n")).report_to_df(reportId="1", fileId="1")
+        pd.testing.assert_frame_equal(df, self.expected(data))
+
+        # Files without the metadata and grand total are read whole
+        df = self.report(b"a,b\n1,2\n3,4\n").report_to_df(reportId="1", fileId="1")
+        self.assertEqual(df["b"].tolist(), [2, 4])
+
+        # Metadata without the fields is not parsed as data
+        with self.assertRaises(ValueError):
+            self.report(data.replace(b"Report Fields\n", b"")).report_to_df(reportId="1", fileId="1")
+
+
+if __name__ == "__main__":
+    unittest.main()
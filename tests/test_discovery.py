@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from benchmarks import stand_ins
+from reagan.discovery import DiscoveryCache, build_service, clear_services, discovery_document, get_credentials, set_discovery_cache
+from reagan.ssm import set_parameter_store
+
+
+def service_account_file(path):
+    # A service account file with a throwaway key, enough to build services offline
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    info = {
+        "type": "service_account",
+        "project_id": "reagan",
+        "private_key_id": "1",
+        "private_key": pem.decode(),
+        "client_email": "reagan@reagan.iam.gserviceaccount.com",
+        "client_id": "1",
+        "token_uri": "https://oauth2.googleapis.com/token",
+    }
+    with open(path, "w") as f:
+        json.dump(info, f)
+    return path
+
+
+class TestDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = DiscoveryCache(os.path.join(self.directory.name, "discovery"))
+        set_discovery_cache(self.cache)
+        clear_services()
+
+    def tearDown(self):
+        set_discovery_cache(None)
+        set_parameter_store(None)
+        clear_services()
+        self.directory.cleanup()
+
+    def test_cache(self):
+        self.assertIsNone(self.cache.get("drive", "v3"))
+        self.cache.put("drive", "v3", '{"name": "drive"}')
+        self.assertEqual(self.cache.get("drive", "v3"), '{"name": "drive"}')
+        self.assertIsNone(self.cache.get("drive", "v2"))
+
+        expiring = DiscoveryCache(self.cache.path, max_age=60)
+        self.assertIsNotNone(expiring.get("drive", "v3"))
+        past = time.time() - 120
+        os.utime(self.cache._file("drive", "v3"), (past, past))
+        self.assertIsNone(expiring.get("drive", "v3"))
+        # Pinned documents never expire
+        self.assertIsNotNone(self.cache.get("drive", "v3"))
+
+    def test_documents(self):
+        document = discovery_document("drive", "v3")
+        self.assertEqual(self.cache.get("drive", "v3"), document)
+
+        # Later builds, including in new processes, read the cache without fetching the document
+        clear_services()
+        with mock.patch("reagan.discovery.fetch_document", side_effect=OSError("offline")):
+            self.assertEqual(discovery_document("drive", "v3"), document)
+            with self.assertRaises(OSError):
+                discovery_document("compute", "v1")
+
+        with mock.patch("reagan.discovery.fetch_document", return_value='{"version": "refreshed"}'):
+            self.cache.refresh("drive", "v3")
+        self.assertEqual(discovery_document("drive", "v3"), '{"version": "refreshed"}')
+
+    def test_unwritable_cache(self):
+        # A cache directory under a file can be neither created nor written
+        blocker = os.path.join(self.directory.name, "file")
+        open(blocker, "w").close()
+        cache = DiscoveryCache(os.path.join(blocker, "discovery"))
+        set_discovery_cache(cache)
+        self.assertIsNone(cache.get("drive", "v3"))
+        with self.assertWarns(UserWarning):
+            document = discovery_document("drive", "v3")
+        self.assertIn('"drive"', document)
+        self.assertEqual(discovery_document("drive", "v3"), document)
+        with mock.patch("reagan.discovery.fetch_document", return_value='{"version": "refreshed"}'):
+            with self.assertWarns(UserWarning):
+                self.assertEqual(cache.refresh("drive", "v3"), '{"version": "refreshed"}')
+        self.assertEqual(discovery_document("drive", "v3"), '{"version": "refreshed"}')
+
+    def test_services(self):
+        filepath = service_account_file(os.path.join(self.directory.name, "service_account.json"))
+        credentials = get_credentials(filepath)
+        self.assertIs(get_credentials(filepath), credentials)
+        self.assertIsNot(get_credentials(filepath, scopes=["https://www.googleapis.com/auth/drive"]), credentials)
+
+        service = build_service("drive", "v3", credentials)
+        self.assertIs(build_service("drive", "v3", credentials), service)
+        self.assertTrue(hasattr(service, "files"))
+
+        # Services are not shared across threads
+        services = []
+        thread = threading.Thread(target=lambda: services.append(build_service("drive", "v3", credentials)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(services[0], service)
+
+    def test_connectors(self):
+        from reagan.drive import Drive
+
+        filepath = service_account_file(os.path.join(self.directory.name, "service_account.json"))
+        stand_ins.use_local_parameters(dict(stand_ins.PARAMETERS, **{"/drive/service_account_path": filepath}))
+        first = Drive()
+        with mock.patch("reagan.discovery.build_from_document") as build:
+            second = Drive()
+        build.assert_not_called()
+        self.assertIs(second.service, first.service)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import sqlite3
+import unittest
+from datetime import datetime, timezone
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from reagan.fetch import column_names, fetch_batches, first_value, flatten_rows, frame_to_dict, frame_to_list, rows_to_columns, rows_to_dict, rows_to_frame
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE t (k INTEGER, v TEXT, x REAL, n INTEGER)")
+        self.conn.executemany(
+            "INSERT INTO t VALUES (?, ?, ?, ?)",
+            [(i, f"v{i}", i / 2, None if i % 2 else i) for i in range(25)],
+        )
+
+    def cursor(self, query="SELECT * FROM t"):
+        return self.conn.execute(query)
+
+    def test_batches(self):
+        batches = list(fetch_batches(self.cursor(), 10))
+        self.assertEqual([len(rows) for rows in batches], [10, 10, 5])
+
+    def test_flatten_rows(self):
+        output = flatten_rows(fetch_batches(self.cursor("SELECT k, v FROM t"), 7))
+        self.assertEqual(output[:4], [0, "v0", 1, "v1"])
+        self.assertEqual(len(output), 50)
+
+    def test_rows_to_dict(self):
+        output = rows_to_dict(fetch_batches(self.cursor("SELECT k, v FROM t"), 7))
+        self.assertEqual(output, {i: f"v{i}" for i in range(25)})
+
+    def test_first_value(self):
+        self.assertEqual(first_value(self.cursor("SELECT MAX(k) FROM t")), 24)
+        self.assertIsNone(first_value(self.cursor("SELECT k FROM t WHERE k > 100")))
+        self.assertEqual(flatten_rows([[(Decimal("1.5"),)]]), [1.5])
+
+    def test_frame_matches_dataframe_methods(self):
+        # The coercions of the dataframe built by to_df: NULLs are NaN and integers are upcast next to floats
+        query = "SELECT k, n, x FROM t WHERE k < 4"
+        cursor = self.cursor(query)
+        df = rows_to_frame(column_names(cursor), fetch_batches(cursor, 3))
+        expected = pd.read_sql(query, self.conn)
+        pd.testing.assert_frame_equal(df, expected)
+        self.assertEqual(frame_to_list(df)[:3], [0.0, 0.0, 0.0])
+        self.assertTrue(np.isnan(frame_to_list(df)[4]))
+        output = frame_to_dict(expected[["k", "x"]])
+        self.assertEqual(output, {row["k"]: row["x"] for index, row in expected[["k", "x"]].iterrows()})
+        self.assertEqual([type(key) for key in output], [float] * 4)
+
+    def test_rows_to_columns(self):
+        cursor = self.cursor()
+        output = rows_to_columns(["k", "v", "x", "n"], fetch_batches(cursor, 10))
+        self.assertEqual(output["k"].dtype, np.int64)
+        self.assertEqual(output["v"].dtype, object)
+        self.assertEqual(output["x"].dtype, np.float64)
+        # NULLs make integer columns floats
+        self.assertEqual(output["n"].dtype, np.float64)
+        self.assertTrue(np.isnan(output["n"][1]))
+        self.assertEqual(output["k"].tolist(), list(range(25)))
+
+    def test_rows_to_columns_timezones(self):
+        aware = [datetime(2020, 1, 1, tzinfo=timezone.utc), None]
+        output = rows_to_columns(["d"], [[(value,) for value in aware]])
+        self.assertEqual(output["d"].dtype, object)
+        self.assertEqual(output["d"].tolist(), aware)
+
+    def test_rows_to_columns_empty(self):
+        output = rows_to_columns(["k"], fetch_batches(self.cursor("SELECT k FROM t WHERE k > 100")))
+        self.assertEqual(len(output["k"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = [
+    "pandas",
+    "boto3",
+    "googleapiclient",
+    "pyodbc",
+    "psycopg2",
+    "sqlalchemy",
+    "smartsheet",
+    "textblob",
+    "bs4",
+]
+
+
+def run_import(statement):
+    """
+    Runs the import statement in a fresh interpreter and returns the heavy
+    modules it loaded.
+    """
+    script = f"""
+import json, sys
+{statement}
+print(json.dumps({{"loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+    output = subprocess.check_output([sys.executable, "-c", script])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+class TestImport(unittest.TestCase):
+    def test_import_loads_no_connectors(self):
+        result = run_import("import reagan")
+        self.assertEqual(result["loaded"], [])
+
+    def test_import_times(self):
+        # As measured by the import reagan benchmark
+        from benchmarks.run import import_times
+
+        times = import_times("import reagan")
+        self.assertIn("reagan", times)
+        self.assertEqual([module for module in HEAVY_MODULES if module in times], [])
+
+    def test_connector_loads_only_its_dependencies(self):
+        result = run_import("from reagan import Fidelity")
+        self.assertNotIn("googleapiclient", result["loaded"])
+        self.assertNotIn("pyodbc", result["loaded"])
+        self.assertNotIn("smartsheet", result["loaded"])
+
+    def test_unknown_attribute(self):
+        import reagan
+
+        with self.assertRaises(AttributeError):
+            reagan.NotAConnector
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+import asyncio
+import gc
+import unittest
+import pandas as pd
+from retrying import retry
+from reagan.instrumentation import (
+    Hook,
+    MetricsAggregator,
+    add_hook,
+    count_retry,
+    current_event,
+    instrumented,
+    remove_hook,
+)
+from reagan.subclass import Subclass
+
+
+class Connector(Subclass):
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+
+    @instrumented()
+    def to_df(self, rows):
+        return pd.DataFrame({"a": range(rows)})
+
+    @instrumented()
+    def pages(self, sizes):
+        for size in sizes:
+            yield list(range(size))
+
+    @instrumented()
+    def chunks(self, sizes):
+        # Returns a generator rather than being one, like to_df(chunksize=...)
+        return self.pages.__wrapped__(self, sizes)
+
+    @instrumented()
+    def download(self):
+        current_event().bytes = 512
+
+    @instrumented("flaky_call")
+    @retry(stop_max_attempt_number=3, retry_on_exception=count_retry)
+    def flaky(self):
+        self.attempts += 1
+        if self.attempts < 3:
+            raise ValueError("try again")
+
+    @instrumented()
+    def fail(self):
+        raise ValueError("failed")
+
+    @instrumented()
+    async def lookup(self, rows, delay):
+        await asyncio.sleep(delay)
+        current_event().bytes = rows
+        return list(range(rows))
+
+
+class Recorder(Hook):
+    def __init__(self):
+        self.started = []
+        self.ended = []
+
+    def on_start(self, event):
+        self.started.append(event.name)
+
+    def on_end(self, event):
+        self.ended.append(event)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.connector = Connector()
+        self.recorder = self.connector.add_hook(Recorder())
+
+    def test_rows_are_counted(self):
+        self.connector.to_df(5)
+        event = self.recorder.ended[0]
+        self.assertEqual(self.recorder.started, ["Connector.to_df"])
+        self.assertEqual(event.rows, 5)
+        self.assertGreaterEqual(event.duration, 0)
+
+    def test_generator_is_one_event(self):
+        chunks = list(self.connector.pages([2, 3]))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(len(self.recorder.ended), 1)
+        self.assertEqual(self.recorder.ended[0].rows, 5)
+
+    def test_abandoned_generator_ends(self):
+        next(self.connector.pages([2, 3]))
+        self.assertEqual(len(self.recorder.ended), 1)
+        self.assertIsNone(self.recorder.ended[0].error)
+
+    def test_returned_generator_is_one_event(self):
+        chunks = self.connector.chunks([2, 3])
+        self.assertEqual(self.recorder.ended, [])
+        self.assertEqual(len(list(chunks)), 2)
+        self.assertEqual(len(self.recorder.ended), 1)
+        self.assertEqual(self.recorder.ended[0].rows, 5)
+
+    def test_dropped_generator_ends(self):
+        chunks = self.connector.chunks([2, 3])
+        del chunks
+        gc.collect()
+        self.assertEqual(len(self.recorder.ended), 1)
+        self.assertIsNone(self.recorder.ended[0].rows)
+
+        # Closed after a chunk, the event ends once
+        chunks = self.connector.chunks([2, 3])
+        next(chunks)
+        chunks.close()
+        del chunks
+        gc.collect()
+        self.assertEqual(len(self.recorder.ended), 2)
+        self.assertEqual(self.recorder.ended[1].rows, 2)
+
+    def test_bytes_and_retries(self):
+        self.connector.download()
+        self.connector.flaky()
+        self.assertEqual(self.recorder.ended[0].bytes, 512)
+        self.assertEqual(self.recorder.ended[1].operation, "flaky_call")
+        self.assertEqual(self.recorder.ended[1].retries, 2)
+
+    def test_coroutines(self):
+        async def run():
+            # Concurrent tasks each have their own current event
+            return await asyncio.gather(self.connector.lookup(3, 0.02), self.connector.lookup(5, 0.01))
+
+        asyncio.run(run())
+        events = sorted(self.recorder.ended, key=lambda event: event.rows)
+        self.assertEqual([(event.rows, event.bytes) for event in events], [(3, 3), (5, 5)])
+        self.assertGreaterEqual(events[0].duration, 0.02)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.connector.fail()
+        self.assertIsInstance(self.recorder.ended[0].error, ValueError)
+
+
+class TestMetricsAggregator(unittest.TestCase):
+    def setUp(self):
+        self.metrics = add_hook(MetricsAggregator())
+
+    def tearDown(self):
+        remove_hook(self.metrics)
+
+    def test_report(self):
+        connector = Connector()
+        for rows in range(10):
+            connector.to_df(rows)
+        with self.assertRaises(ValueError):
+            connector.fail()
+        report = self.metrics.report().set_index("operation")
+        self.assertEqual(report.loc["Connector.to_df", "calls"], 10)
+        self.assertEqual(report.loc["Connector.to_df", "rows"], 45)
+        self.assertEqual(report.loc["Connector.fail", "errors"], 1)
+        self.assertLessEqual(report.loc["Connector.to_df", "p50"], report.loc["Connector.to_df", "p99"])
+
+    def test_memory_is_bounded(self):
+        remove_hook(self.metrics)
+        self.metrics = add_hook(MetricsAggregator(samples=10, max_errors=2))
+        connector = Connector()
+        for rows in range(100):
+            connector.to_df(rows)
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                connector.fail()
+        self.assertEqual(len(self.metrics.operations["Connector.to_df"].durations), 10)
+        self.assertEqual(list(self.metrics.errors), [("Connector.fail", "ValueError('failed')")] * 2)
+        report = self.metrics.report().set_index("operation")
+        self.assertEqual(report.loc["Connector.to_df", "calls"], 100)
+        self.assertEqual(report.loc["Connector.fail", "errors"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import struct
+import unittest
+import numpy as np
+import pandas as pd
+from reagan.pgcopy import BINARY_HEADER, CopyStream, binary_chunks, binary_compatible, binary_fields, copy_records, csv_chunks, pg_type, upsert_statement
+
+
+def read_binary(data):
+    # Decodes a binary COPY file of bigint, double precision, boolean, timestamp and text fields to raw values
+    assert data.startswith(BINARY_HEADER)
+    offset = len(BINARY_HEADER)
+    rows = []
+    while True:
+        (count,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        if count == -1:
+            return rows
+        row = []
+        for _ in range(count):
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[offset : offset + length])
+                offset += length
+        rows.append(row)
+
+
+class TestCopy(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(
+            {
+                "id": [1, 2, 3],
+                "name": ["a", None, 'b,"c"'],
+                "cost": [1.5, np.nan, 2.0],
+                "active": [True, False, True],
+                "date": pd.to_datetime(["2000-01-01", "2000-01-02 00:00:01", None]),
+            }
+        )
+
+    def test_stream(self):
+        stream = CopyStream([b"abc", b"", b"defg"])
+        self.assertEqual(stream.read(2), b"ab")
+        self.assertEqual(stream.read(5), b"c")
+        self.assertEqual(stream.read(), b"defg")
+        self.assertEqual(stream.read(8), b"")
+        self.assertEqual(stream.bytes, 7)
+
+    def test_csv(self):
+        chunks = list(csv_chunks(self.df, 2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(
+            b"".join(chunks).decode().splitlines(),
+            [
+                "1,a,1.5,True,2000-01-01 00:00:00",
+                "2,\\N,\\N,False,2000-01-02 00:00:01",
+                '3,"b,""c""",2.0,True,\\N',
+            ],
+        )
+
+    def test_csv_integer_columns(self):
+        df = pd.DataFrame({"id": [1, None, 3], "cost": [1.5, None, 2.0]})
+        self.assertEqual(b"".join(csv_chunks(df, 2, ["bigint", "double precision"])), b"1,1.5\n\\N,\\N\n3,2.0\n")
+        # Fractional floats are left for the server to reject
+        self.assertEqual(b"".join(csv_chunks(df, 2, ["integer", "integer"])), b"1,1.5\n\\N,\\N\n3,2.0\n")
+        self.assertEqual(b"".join(csv_chunks(df, 2)), b"1.0,1.5\n\\N,\\N\n3.0,2.0\n")
+
+    def test_records(self):
+        records = copy_records(self.df, ["integer", "text", "double precision", "boolean", "timestamp without time zone"])
+        self.assertEqual(records[1][:4], (2, None, None, False))
+        self.assertIsNone(records[2][4])
+        records = copy_records(pd.DataFrame({"id": [1, None], "cost": [1.0, None]}), ["bigint", "real"])
+        self.assertEqual(records, [(1, 1.0), (None, None)])
+        self.assertEqual([type(value) for value in records[0]], [int, float])
+
+    def test_binary(self):
+        data = b"".join(binary_chunks(self.df, 2))
+        rows = read_binary(data)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(struct.unpack(">q", rows[2][0])[0], 3)
+        self.assertEqual(rows[2][1].decode(), 'b,"c"')
+        self.assertIsNone(rows[1][1])
+        self.assertEqual(struct.unpack(">d", rows[0][2])[0], 1.5)
+        self.assertIsNone(rows[1][2])
+        self.assertEqual(rows[1][3], b"\x00")
+        self.assertEqual(struct.unpack(">q", rows[1][4])[0], 86400 * 10 ** 6 + 10 ** 6)
+        self.assertIsNone(rows[2][4])
+
+    def test_binary_column_types(self):
+        # Values have the width of the table column's type
+        ints = pd.Series([1, None, 3])
+        self.assertTrue(binary_compatible(ints, "integer"))
+        self.assertEqual(binary_fields(ints, "integer")[2], struct.pack(">ii", 4, 3))
+        self.assertEqual(binary_fields(ints, "smallint")[1], struct.pack(">i", -1))
+        self.assertEqual(binary_fields(pd.Series([1.5], dtype="float32"))[0], struct.pack(">if", 4, 1.5))
+        self.assertFalse(binary_compatible(pd.Series([1.5]), "integer"))
+        self.assertFalse(binary_compatible(pd.Series([2 ** 40]), "integer"))
+        self.assertFalse(binary_compatible(pd.Series([1.5]), "numeric"))
+        booleans = pd.Series([True, None, False], dtype=object)
+        self.assertTrue(binary_compatible(booleans, "boolean"))
+        self.assertEqual(binary_fields(booleans, "boolean"), [b"\x00\x00\x00\x01\x01", struct.pack(">i", -1), b"\x00\x00\x00\x01\x00"])
+        aware = pd.Series(pd.to_datetime(["2000-01-01 01:00"])).dt.tz_localize("Europe/Paris")
+        self.assertFalse(binary_compatible(aware, "timestamp without time zone"))
+        self.assertEqual(binary_fields(aware)[0], struct.pack(">iq", 8, 0))
+        self.assertEqual(binary_fields(self.df["date"], "date")[1], struct.pack(">ii", 4, 1))
+
+    def test_table_statements(self):
+        self.assertEqual([pg_type(self.df[col]) for col in self.df.columns][:4], ["BIGINT", "TEXT", "DOUBLE PRECISION", "BOOLEAN"])
+        # As pandas.to_sql creates them
+        columns = [pd.Series([1], dtype="int16"), pd.Series([1], dtype="int32"), pd.Series([1.5], dtype="float32"), pd.Series([True, None])]
+        self.assertEqual([pg_type(column) for column in columns], ["SMALLINT", "INTEGER", "REAL", "BOOLEAN"])
+        self.assertEqual(
+            upsert_statement("t", "s", ["id", "name"], ["id"]),
+            'INSERT INTO t ("id", "name") SELECT "id", "name" FROM s ON CONFLICT ("id") DO UPDATE SET "name" = EXCLUDED."name"',
+        )
+        self.assertTrue(upsert_statement("t", "s", ["id"], ["id"]).endswith("DO NOTHING"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import sqlalchemy
+from reagan.instrumentation import Hook, instrumented
+from reagan.pool import dispose_engines, get_engine, max_connections, pool_stats
+from reagan.subclass import Subclass
+
+
+class Connector(Subclass):
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+
+    @instrumented()
+    def query(self):
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+
+class Recorder(Hook):
+    def __init__(self):
+        self.ended = []
+
+    def on_end(self, event):
+        self.ended.append(event)
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.url = "sqlite:///" + os.path.join(self.directory.name, "pool.db")
+
+    def tearDown(self):
+        dispose_engines()
+        self.directory.cleanup()
+
+    def hold(self, engine, seconds):
+        # Checks a connection out in another thread and holds it for [seconds]
+        checked_out = threading.Event()
+
+        def run():
+            conn = engine.raw_connection()
+            checked_out.set()
+            time.sleep(seconds)
+            conn.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        checked_out.wait()
+        return thread
+
+    def test_engine_shared_by_key(self):
+        engine = get_engine("test/a", self.url, pool_size=2)
+        self.assertIs(get_engine("test/a", self.url), engine)
+        self.assertIsNot(get_engine("test/b", self.url), engine)
+        self.assertEqual(max_connections(engine), 2)
+
+    def test_conflicting_pool_size_warns(self):
+        engine = get_engine("test/a", self.url, pool_size=2)
+        with self.assertWarns(UserWarning):
+            self.assertIs(get_engine("test/a", self.url, pool_size=5), engine)
+        self.assertEqual(max_connections(get_engine("test/a", self.url)), 2)
+
+    def test_changed_url_disposes_engine(self):
+        engine = get_engine("test/a", self.url, pool_size=2)
+        engine.raw_connection().close()
+        self.assertEqual(engine.pool.checkedin(), 1)
+        other = get_engine("test/a", self.url.replace("pool.db", "other.db"))
+        self.assertIsNot(other, engine)
+        self.assertEqual(engine.pool.checkedin(), 0)
+
+    def test_stats(self):
+        engine = get_engine("test/a", self.url, pool_size=2)
+        connector = Connector(engine)
+        for _ in range(3):
+            self.assertEqual(connector.query(), 1)
+        stats = pool_stats(engine)
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["checkouts"], 3)
+        self.assertEqual(stats["peak_utilisation"], 0.5)
+
+    def test_wait_is_recorded(self):
+        engine = get_engine("test/a", self.url, pool_size=1)
+        connector = Connector(engine)
+        recorder = connector.add_hook(Recorder())
+        thread = self.hold(engine, 0.2)
+        connector.query()
+        thread.join()
+        stats = pool_stats(engine)
+        self.assertEqual(stats["waits"], 1)
+        self.assertGreater(stats["max_wait_seconds"], 0.1)
+        self.assertGreater(recorder.ended[0].wait, 0.1)
+
+    def test_timeout(self):
+        engine = get_engine("test/a", self.url, pool_size=1, timeout=0.1)
+        thread = self.hold(engine, 0.5)
+        with self.assertRaises(sqlalchemy.exc.TimeoutError):
+            engine.raw_connection()
+        thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,290 @@
+import json
+import os
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+try:
+    from benchmarks import stand_ins
+    from reagan.psql import PSQL
+except ImportError:
+    PSQL = None
+
+# Set REAGAN_TEST_POSTGRES to a json connection dict of a local Postgres to run the TestPSQLPostgres tests
+POSTGRES = json.loads(os.environ.get("REAGAN_TEST_POSTGRES", "null"))
+
+
+@unittest.skipIf(PSQL is None, "psycopg2 is not available")
+class TestPSQLFetch(unittest.TestCase):
+    def setUp(self):
+        self.ps = stand_ins.local_psql()
+        self.df = pd.DataFrame({"k": range(25), "v": [f"x{i}" for i in range(25)]})
+        self.df.to_sql("t", self.ps.conn, index=False)
+
+    def test_to_list(self):
+        self.assertEqual(self.ps.to_list("SELECT k FROM t", chunksize=7), list(range(25)))
+        self.assertEqual(self.ps.to_list("SELECT k, v FROM t WHERE k < 2"), self.df.head(2).values.flatten().tolist())
+        self.assertEqual(self.ps.to_list("SELECT k, v FROM t WHERE k < 2", native=True), [0, "x0", 1, "x1"])
+
+    def test_to_list_coercions(self):
+        # As the values of to_df: NULLs are NaN and integers next to floats are floats
+        query = "SELECT k, CASE WHEN k > 0 THEN k / 2.0 END AS x FROM t WHERE k < 2"
+        output = self.ps.to_list(query)
+        self.assertEqual([type(value) for value in output], [float] * 4)
+        self.assertEqual(output[2:], [1.0, 0.5])
+        self.assertTrue(np.isnan(output[1]))
+        self.assertEqual(self.ps.to_list(query, native=True), [0, None, 1, 0.5])
+
+    def test_to_dict(self):
+        output = self.ps.to_dict(schema="main", table="t", key="k", value="v", chunksize=7)
+        self.assertEqual(output, {i: f"x{i}" for i in range(25)})
+        self.assertEqual(self.ps.to_dict(schema="main", table="t", key="k", value="v", native=True), output)
+
+    def test_get_scalar(self):
+        self.assertEqual(self.ps.get_scalar("SELECT MAX(k) FROM [TABLE]", replacements={"[TABLE]": "t"}), 24)
+
+    def test_to_df_chunks(self):
+        chunks = list(self.ps.to_df_chunks("SELECT * FROM t", chunksize=10, itersize=4))
+        self.assertEqual([len(df) for df in chunks], [10, 10, 5])
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), self.df)
+        chunks = self.ps.to_df("SELECT * FROM t WHERE k < ?", params=[5], chunksize=2)
+        self.assertEqual([len(df) for df in chunks], [2, 2, 1])
+
+    def test_to_columns(self):
+        output = self.ps.to_columns("SELECT * FROM t")
+        np.testing.assert_array_equal(output["k"], self.df["k"].values)
+        np.testing.assert_array_equal(output["v"], self.df["v"].values)
+
+
+@unittest.skipIf(PSQL is None, "psycopg2 is not available")
+class TestPSQLParameters(unittest.TestCase):
+    # The SQLite stand-in takes ? placeholders, Postgres takes %s or %(name)s
+    def setUp(self):
+        self.ps = stand_ins.local_psql()
+        self.ps.execute("CREATE TABLE t (k INTEGER, v TEXT)")
+
+    def test_execute_many(self):
+        self.ps.execute("INSERT INTO t VALUES (?, ?)", params=[(i, f"x{i}") for i in range(10)], many=True)
+        self.assertEqual(self.ps.get_scalar("SELECT COUNT(*) FROM t"), 10)
+        df = self.ps.to_df("SELECT * FROM t WHERE k >= ? ORDER BY k", params=[8])
+        self.assertEqual(df["v"].tolist(), ["x8", "x9"])
+        self.assertEqual(self.ps.get_scalar("SELECT v FROM t WHERE k = ?", params=[3]), "x3")
+
+    def test_execute_error_rolls_back(self):
+        with self.assertRaises(Exception):
+            self.ps.execute("INSERT INTO t VALUES (?, ?)", params=[(1, "a"), (2,)], many=True)
+
+
+@unittest.skipIf(PSQL is None, "psycopg2 is not available")
+class TestPSQLCopy(unittest.TestCase):
+    def setUp(self):
+        self.ps = stand_ins.local_psql()
+
+    def test_upsert_statement(self):
+        statement = self.ps._upsert_statement('"gcm"."site"', '"_stage"', ["site_id", "site"], ["site_id"])
+        self.assertEqual(
+            statement,
+            'INSERT INTO "gcm"."site" ("site_id", "site") SELECT "site_id", "site" FROM "_stage"'
+            ' ON CONFLICT ("site_id") DO UPDATE SET "site" = EXCLUDED."site"',
+        )
+
+    def test_upsert_requires_keys(self):
+        with self.assertRaises(ValueError):
+            self.ps.to_sql(pd.DataFrame({"a": [1]}), schema="gcm", table="t", if_exists="upsert")
+        with self.assertRaises(ValueError):
+            self.ps.copy_to_sql(pd.DataFrame({"a": [1]}), schema="gcm", table="t", format="parquet")
+
+
+COPY_CSV = b"""id,code,cost,active,date,note
+1,007,1.5,t,2020-01-01 10:00:00,a
+2,008,\\N,f,\\N,""
+3,\\N,2,\\N,2020-01-03 00:00:00,\\N
+"""
+
+# name and type OID of each column, as in a psycopg2 cursor description
+COPY_DESCRIPTION = [("id", 23), ("code", 25), ("cost", 1700), ("active", 16), ("date", 1114), ("note", 1043)]
+
+
+class CopyCursor(object):
+    description = COPY_DESCRIPTION
+
+    def execute(self, query):
+        pass
+
+    def copy_expert(self, statement, file):
+        for start in range(0, len(COPY_CSV), 7):
+            file.write(COPY_CSV[start : start + 7])
+
+    def close(self):
+        pass
+
+
+class CopyConnection(object):
+    def cursor(self):
+        return CopyCursor()
+
+
+@unittest.skipIf(PSQL is None, "psycopg2 is not available")
+class TestPSQLCopyOut(unittest.TestCase):
+    def setUp(self):
+        self.ps = stand_ins.local_psql()
+
+        @contextmanager
+        def connection():
+            yield CopyConnection()
+
+        self.ps._connection = connection
+
+    def test_copy_to_df(self):
+        df = self.ps.to_df("SELECT * FROM t", method="copy")
+        self.assertEqual(df["id"].tolist(), [1, 2, 3])
+        self.assertEqual(df["code"].tolist()[:2], ["007", "008"])
+        self.assertTrue(pd.isnull(df["code"][2]))
+        self.assertEqual(df["cost"].dtype, np.float64)
+        self.assertEqual(df["active"].tolist()[:2], [True, False])
+        self.assertEqual(df["date"][0], pd.Timestamp("2020-01-01 10:00:00"))
+        self.assertEqual(df["note"][1], "")
+
+    def test_copy_chunks(self):
+        chunks = list(self.ps.copy_to_df("SELECT * FROM t", chunksize=2, dtype={"id": "float64"}))
+        self.assertEqual([len(df) for df in chunks], [2, 1])
+        self.assertEqual(chunks[1]["id"].dtype, np.float64)
+
+    def test_copy_params(self):
+        with self.assertRaises(ValueError):
+            self.ps.to_df("SELECT * FROM t WHERE id = %s", params=[1], method="copy")
+        with self.assertRaises(ValueError):
+            self.ps.to_df("SELECT * FROM t WHERE id = %s", params=[1], method="copy", chunksize=2)
+
+
+@unittest.skipIf(PSQL is None or POSTGRES is None, "psycopg2 or REAGAN_TEST_POSTGRES is not available")
+class TestPSQLPostgres(unittest.TestCase):
+    def setUp(self):
+        self.ps = stand_ins.local_psql(POSTGRES)
+        self.ps.execute("DROP SCHEMA IF EXISTS reagan_test CASCADE")
+        self.ps.execute("CREATE SCHEMA reagan_test")
+        self.ps.execute("CREATE TABLE reagan_test.t (k INTEGER, v TEXT)")
+        self.ps.execute("INSERT INTO reagan_test.t VALUES (%s, %s)", params=[(i, f"x{i}") for i in range(10)], many=True)
+
+    def tearDown(self):
+        self.ps.execute("DROP SCHEMA reagan_test CASCADE")
+        self.ps.conn.dispose()
+
+    def test_prepared_statements_evicted_across_checkouts(self):
+        # Every call checks the same pooled connection out again, so evictions run on a later checkout
+        with mock.patch("reagan.statements.CACHE_SIZE", 2):
+            self.ps.conn.dispose()
+            for k in range(5):
+                query = f"SELECT v FROM reagan_test.t WHERE k = %s AND {k} = {k}"
+                self.assertEqual(self.ps.get_scalar(query, params=[k]), f"x{k}")
+            self.assertEqual(self.ps.get_scalar("SELECT COUNT(*) FROM pg_prepared_statements"), 2)
+            self.assertEqual(self.ps.get_scalar("SELECT v FROM reagan_test.t WHERE k = %(k)s", params={"k": 7}), "x7")
+
+    def test_unprepared_statements(self):
+        # Tuples for IN and statements that cannot be prepared are executed as they are
+        prepared = self.ps.get_scalar("SELECT COUNT(*) FROM pg_prepared_statements")
+        self.assertEqual(self.ps.to_list("SELECT v FROM reagan_test.t WHERE k IN %s ORDER BY k", params=[(1, 3)]), ["x1", "x3"])
+        self.ps.execute("CREATE TABLE reagan_test.c AS SELECT %s::INTEGER AS k", params=[7])
+        self.assertEqual(self.ps.get_scalar("SELECT k FROM reagan_test.c"), 7)
+        self.assertEqual(self.ps.get_scalar("SELECT COUNT(*) FROM pg_prepared_statements"), prepared)
+
+    def copy_frame(self):
+        return pd.DataFrame(
+            {
+                "small": pd.Series([1, 2, 3], dtype="int16"),
+                "int": pd.Series([1, 2, 3], dtype="int32"),
+                "big": [1, 2, 2 ** 40],
+                "real": pd.Series([1.5, None, 2.5], dtype="float32"),
+                "double": [0.1, None, 2.0],
+                "flag": [True, None, False],
+                "at": pd.to_datetime(["2020-01-01 10:00", None, "2020-01-03"]),
+                "aware": pd.to_datetime(["2020-01-01 10:00", "2020-01-02", None]).tz_localize("Europe/Paris"),
+                "name": ["a", None, 'b,"c"'],
+            }
+        )
+
+    def read_back(self, table):
+        return [
+            list(row)
+            for row in self.ps._fetch(f"SELECT * FROM reagan_test.{table} ORDER BY big", lambda cursor: cursor.fetchall())
+        ]
+
+    def test_copy_round_trip(self):
+        df = self.copy_frame()
+        for format in ("csv", "binary"):
+            self.ps.copy_to_sql(df, schema="reagan_test", table=format, if_exists="replace", format=format)
+        types = self.ps._fetch(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = 'reagan_test.binary'::regclass AND attnum > 0 ORDER BY attnum",
+            lambda cursor: [row[0] for row in cursor.fetchall()],
+        )
+        self.assertEqual(types[:6], ["smallint", "integer", "bigint", "real", "double precision", "boolean"])
+        self.assertEqual(self.read_back("binary"), self.read_back("csv"))
+        rows = self.read_back("binary")
+        self.assertEqual(rows[2][:6], [3, 3, 2 ** 40, 2.5, 2.0, False])
+        self.assertEqual([rows[1][3], rows[1][5], rows[1][6], rows[2][7]], [None, None, None, None])
+        self.assertEqual(rows[0][7], df["aware"][0].to_pydatetime())
+
+    def test_copy_binary_to_other_types(self):
+        # Nullable integers (floats) into integer columns are sent in binary; numeric columns fall back to csv
+        self.ps.execute("CREATE TABLE reagan_test.typed (k INTEGER, v REAL, d DATE)")
+        df = pd.DataFrame({"k": [1, None], "v": [1.5, 2.0], "d": pd.to_datetime(["2020-01-01", None])})
+        self.ps.copy_to_sql(df, schema="reagan_test", table="typed", format="binary")
+        self.ps.execute("CREATE TABLE reagan_test.numeric (k NUMERIC)")
+        with self.assertWarns(UserWarning):
+            self.ps.copy_to_sql(df[["k"]], schema="reagan_test", table="numeric", format="binary")
+        rows = self.ps._fetch("SELECT k, v, d::text FROM reagan_test.typed ORDER BY k", lambda cursor: cursor.fetchall())
+        self.assertEqual(rows, [(1, 1.5, "2020-01-01"), (None, 2.0, None)])
+        self.assertEqual(self.ps.get_scalar("SELECT COUNT(k) FROM reagan_test.numeric"), 1)
+
+    def test_copy_csv_nullable_integers(self):
+        # Integers with NULLs are floats in pandas, written as integers for the integer columns
+        self.ps.execute("ALTER TABLE reagan_test.t ADD PRIMARY KEY (k)")
+        df = pd.DataFrame({"k": [1.0, 20.0], "v": ["a", None]})
+        self.ps.copy_to_sql(df, schema="reagan_test", table="t", if_exists="upsert", keys=["k"])
+        self.ps.execute("CREATE TABLE reagan_test.n (k INTEGER, v TEXT)")
+        self.ps.copy_to_sql(pd.DataFrame({"k": [1, None, 3], "v": ["a", "b", "c"]}), schema="reagan_test", table="n")
+        rows = self.ps._fetch("SELECT k, v FROM reagan_test.t WHERE k IN (1, 2, 20) ORDER BY k", lambda cursor: cursor.fetchall())
+        self.assertEqual(rows, [(1, "a"), (2, "x2"), (20, None)])
+        self.assertEqual(self.ps._fetch("SELECT k FROM reagan_test.n ORDER BY v", lambda cursor: cursor.fetchall()), [(1,), (None,), (3,)])
+
+    def test_failed_replace_keeps_table(self):
+        def failing_chunks(df, chunksize, types=None):
+            yield b"1,x1\n"
+            raise ValueError("encoding failed")
+
+        with mock.patch("reagan.psql.csv_chunks", failing_chunks):
+            with self.assertRaises(Exception):
+                self.ps.copy_to_sql(pd.DataFrame({"k": [1], "v": ["x1"]}), schema="reagan_test", table="t", if_exists="replace")
+        self.assertEqual(self.ps.get_scalar("SELECT COUNT(*) FROM reagan_test.t"), 10)
+
+    def test_copy_out_query_comment(self):
+        df = self.ps.copy_to_df("SELECT k, v FROM reagan_test.t WHERE k < 3 ORDER BY k -- first rows\n; ;")
+        self.assertEqual(df.values.tolist(), [[0, "x0"], [1, "x1"], [2, "x2"]])
+
+    def test_copy_out_closed_early(self):
+        threads = threading.active_count()
+        chunks = self.ps.copy_to_df("SELECT g AS k, md5(g::text) AS v FROM generate_series(1, 2000000) g", chunksize=1000)
+        self.assertEqual(len(next(chunks)), 1000)
+        start = time.time()
+        chunks.close()
+        # The query is cancelled rather than all its results sent
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(self.ps.conn.pool.checkedout(), 0)
+        self.assertEqual(self.ps.get_scalar("SELECT COUNT(*) FROM reagan_test.t"), 10)
+
+    def test_copy_out_error(self):
+        for chunksize in (None, 1000):
+            with self.assertRaises(Exception):
+                df = self.ps.copy_to_df("SELECT 1 / (g - 5000) FROM generate_series(1, 10000) g", chunksize=chunksize)
+                if chunksize:
+                    list(df)
+        self.assertEqual(self.ps.conn.pool.checkedout(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
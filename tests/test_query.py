@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from reagan.query import QueryTemplate, compile_query, read_sql_file
+from reagan.subclass import Subclass
+
+
+class TestQueryTemplate(unittest.TestCase):
+    def test_single_pass(self):
+        template = QueryTemplate("SELECT [A], [B] FROM t")
+        query = template.format({"[A]": "[B]", "[B]": "x"})
+        self.assertEqual(query, "SELECT [B], x FROM t")
+
+    def test_longest_key_wins(self):
+        template = QueryTemplate("WHERE d BETWEEN [DATE] AND [DATE END]")
+        query = template.format({"[DATE]": 1, "[DATE END]": 2})
+        self.assertEqual(query, "WHERE d BETWEEN 1 AND 2")
+
+    def test_no_replacements(self):
+        self.assertEqual(QueryTemplate("SELECT 1").format(), "SELECT 1")
+
+
+class TestReadSqlFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "query.sql")
+        self.write("SELECT * FROM [TABLE]")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, query, mtime=None):
+        with open(self.path, "w") as f:
+            f.write(query)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_file_is_cached(self):
+        self.assertIs(read_sql_file(self.path), compile_query(self.path))
+
+    def test_file_is_read_again_when_modified(self):
+        self.write("SELECT 1", mtime=1000)
+        read_sql_file(self.path)
+        self.write("SELECT 2", mtime=2000)
+        self.assertEqual(read_sql_file(self.path).query, "SELECT 2")
+
+    def test_format_query_accepts_files_and_templates(self):
+        sc = Subclass()
+        replacements = {"[TABLE]": "gcm.Site"}
+        self.assertEqual(sc._format_query(self.path, replacements), "SELECT * FROM gcm.Site")
+        template = compile_query(self.path)
+        self.assertEqual(sc._format_query(template, replacements), "SELECT * FROM gcm.Site")
+
+
+if __name__ == "__main__":
+    unittest.main()
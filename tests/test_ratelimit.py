@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+from unittest import mock
+from benchmarks.stand_ins import http_error
+from googleapiclient.errors import HttpError
+from reagan.instrumentation import instrumented
+from reagan.ratelimit import QuotaExceeded, RateLimiter, backoff, execute, get_limiter, is_rate_limited, retry_wait, set_limiter
+
+
+class Request(object):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"ok": True}
+
+
+class Connector(object):
+    @instrumented()
+    def call(self, request, limiter):
+        return execute(request, limiter, retries=2)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_queries_per_second(self):
+        limiter = RateLimiter(qps=50)
+        start = time.monotonic()
+        threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(25)]) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # A second of queries at once, then 25 more at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(limiter.calls, 75)
+
+    def test_per_day(self):
+        limiter = RateLimiter(per_day=5, max_wait=1)
+        for _ in range(5):
+            self.assertEqual(limiter.acquire(), 0)
+        with self.assertRaises(QuotaExceeded):
+            limiter.acquire()
+
+    def test_pause(self):
+        limiter = RateLimiter()
+        limiter.pause(0.1)
+        self.assertGreater(limiter.acquire(), 0.05)
+        self.assertEqual(limiter.acquire(), 0)
+
+    def test_shared_limiters(self):
+        self.assertIs(get_limiter("dfareporting"), get_limiter("dfareporting"))
+        limiter = RateLimiter(qps=1)
+        set_limiter("drive", limiter)
+        self.assertIs(get_limiter("drive"), limiter)
+        set_limiter("drive", None)
+        self.assertIsNot(get_limiter("drive"), limiter)
+
+
+class TestExecute(unittest.TestCase):
+    def test_rate_limit_errors(self):
+        self.assertTrue(is_rate_limited(http_error(429)))
+        self.assertTrue(is_rate_limited(http_error(403, "userRateLimitExceeded")))
+        self.assertFalse(is_rate_limited(http_error(403, "insufficientPermissions")))
+        self.assertFalse(is_rate_limited(ValueError()))
+        for attempt in range(1, 10):
+            self.assertLessEqual(backoff(attempt, base=0.5), min(64, 0.5 * 2 ** attempt))
+
+    def test_retry_after(self):
+        error = http_error(429)
+        error.resp["retry-after"] = "0.2"
+        limiter = RateLimiter()
+        self.assertEqual(retry_wait([http_error(429), error], 1, limiter), 0.2)
+        # The other callers of the limiter wait too
+        self.assertGreater(limiter.acquire(), 0.1)
+
+    @mock.patch("reagan.ratelimit.backoff", return_value=0.01)
+    def test_retries(self, backoff):
+        limiter = RateLimiter()
+        retry_after = http_error(429)
+        retry_after.resp["retry-after"] = "0.1"
+        request = Request([retry_after, http_error(403, "rateLimitExceeded")])
+        start = time.monotonic()
+        self.assertEqual(Connector().call(request, limiter), {"ok": True})
+        self.assertEqual(request.calls, 3)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+        request = Request([http_error(404, "notFound")])
+        with self.assertRaises(HttpError):
+            execute(request, limiter)
+        self.assertEqual(request.calls, 1)
+
+        request = Request([http_error(429)] * 3)
+        with self.assertRaises(HttpError):
+            execute(request, limiter, retries=1)
+        self.assertEqual(request.calls, 2)
+        self.assertEqual(backoff.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
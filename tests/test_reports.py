@@ -0,0 +1,87 @@
+import unittest
+from itertools import islice
+from unittest import mock
+from benchmarks import stand_ins
+from reagan.reports import ReportFailed, ReportManager, poll_intervals
+from reagan.ssm import set_parameter_store
+
+
+def sa360_fragment(rows):
+    report = stand_ins.report_csv(rows).split(b"Report Fields\n")[1]
+    return report.rsplit(b"\n", 1)[0]
+
+
+class TestReportPolling(unittest.TestCase):
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def test_poll_intervals(self):
+        self.assertEqual(list(islice(poll_intervals(10, 60), 5)), [10, 20, 40, 60, 60])
+
+    @mock.patch("reagan.sa360.sleep")
+    def test_sa360_waits(self, sleep):
+        sa = stand_ins.local_sa360(stand_ins.SA360Service(fragments=[sa360_fragment(5)] * 2, polls=3))
+        dfs = list(sa.reports_to_df(agency_id=1, report_type="campaign", columns=["campaignId"]))
+        self.assertEqual([len(df) for df in dfs], [5, 5])
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [10, 20, 40])
+
+    @mock.patch("reagan.dcm.sleep")
+    def test_dcm_waits(self, sleep):
+        dcm = stand_ins.local_dcm(stand_ins.DCMService(report=stand_ins.report_csv(5), polls=2))
+        self.assertEqual(len(dcm.report_to_df(reportId="1")), 5)
+        self.assertEqual(sleep.call_count, 2)
+
+        dcm = stand_ins.local_dcm(stand_ins.DCMService(report=stand_ins.report_csv(5), status="FAILED"))
+        with self.assertRaises(ReportFailed):
+            dcm.report_to_df(reportId="1")
+
+
+class TestReportManager(unittest.TestCase):
+    def setUp(self):
+        self.dcm_service = stand_ins.DCMService(report=stand_ins.report_csv(20), polls={"1": 0, "2": 4, "3": 1})
+        self.dcm = stand_ins.local_dcm(self.dcm_service)
+        self.sa = stand_ins.local_sa360(stand_ins.SA360Service(fragments=[sa360_fragment(3)] * 3, polls=2))
+        self.completed = []
+        self.manager = ReportManager(workers=2, poll_interval=0.01, max_interval=0.02, callback=lambda name, result: self.completed.append(name))
+
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def test_as_completed(self):
+        for report_id in ("2", "1", "3"):
+            self.manager.add_dcm(self.dcm, reportId=report_id)
+        self.manager.add_sa360(self.sa, agency_id=1, report_type="campaign", columns=["campaignId"], name="campaigns")
+        self.manager.add_dcm(self.dcm, reportId="1", name="chunks", chunksize=15)
+        with mock.patch.object(self.dcm, "run_report") as run_report:
+            with self.assertRaises(ValueError):
+                self.manager.add_dcm(self.dcm, reportId="1")
+        # The duplicate is not run
+        run_report.assert_not_called()
+
+        results = list(self.manager.as_completed())
+        names = [name for name, _ in results]
+        # Reports are returned as they finish, not in the order they were added
+        self.assertEqual(sorted(names), ["campaigns", "chunks", "dcm_1", "dcm_2", "dcm_3"])
+        self.assertLess(names.index("dcm_3"), names.index("dcm_2"))
+        self.assertEqual(names[-1], "dcm_2")
+        self.assertEqual(names, self.completed)
+
+        results = dict(results)
+        self.assertEqual(len(results["dcm_2"]), 20)
+        self.assertEqual(len(results["campaigns"]), 9)
+        self.assertEqual([len(df) for df in results["chunks"]], [15, 5])
+
+    def test_errors(self):
+        failed = stand_ins.local_dcm(stand_ins.DCMService(status="CANCELLED"))
+        self.manager.add_dcm(self.dcm, reportId="3")
+        self.manager.add_dcm(failed, reportId="9")
+        results = self.manager.run(errors="return")
+        self.assertEqual(list(results), ["dcm_3", "dcm_9"])
+        self.assertEqual(len(results["dcm_3"]), 20)
+        self.assertIsInstance(results["dcm_9"], ReportFailed)
+        with self.assertRaises(ReportFailed):
+            self.manager.run()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+
+try:
+    from benchmarks import stand_ins
+    from reagan.sqlserver import SQLServer
+    from reagan.statements import statement_cache
+except ImportError:
+    SQLServer = None
+
+
+@unittest.skipIf(SQLServer is None, "pyodbc is not available")
+class TestSQLServerChunks(unittest.TestCase):
+    def setUp(self):
+        self.ss = stand_ins.local_sqlserver()
+        self.df = pd.DataFrame({"k": range(25), "v": [f"x{i}" for i in range(25)]})
+        self.df.to_sql("t", self.ss.engine, index=False)
+
+    def test_chunks(self):
+        chunks = list(self.ss.to_df_chunks("SELECT * FROM t", chunksize=10))
+        self.assertEqual([len(df) for df in chunks], [10, 10, 5])
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), self.df)
+
+    def test_to_df_chunksize(self):
+        chunks = self.ss.to_df("SELECT * FROM [TABLE]", replacements={"[TABLE]": "t"}, chunksize=20)
+        self.assertEqual([len(df) for df in chunks], [20, 5])
+
+    def test_close_returns_connection(self):
+        conn = self.ss.conn
+        with self.ss:
+            self.ss.cursor.execute("SELECT 1")
+            self.assertEqual(self.ss.cursor.fetchone()[0], 1)
+        self.assertIsNone(conn.dbapi_connection)
+        self.assertIsNot(self.ss.conn, conn)
+
+    def test_cached_cursor_drained(self):
+        query = "SELECT k FROM t WHERE k < ? ORDER BY k"
+        self.assertEqual(self.ss.get_scalar(query, params=[5]), 0)
+        # The cursor cached for the query has no results left on its connection
+        conn = self.ss.engine.raw_connection()
+        try:
+            self.assertIsNone(statement_cache(conn).get(query).fetchone())
+        finally:
+            conn.close()
+        self.assertEqual(self.ss.get_scalar(query, params=[5]), 0)
+
+    def test_to_list_and_to_dict(self):
+        self.assertEqual(self.ss.to_list("SELECT k FROM t", chunksize=7), list(range(25)))
+        output = self.ss.to_dict(schema="main", table="t", key="k", value="v", chunksize=7)
+        self.assertEqual(output, {i: f"x{i}" for i in range(25)})
+
+
+@unittest.skipIf(SQLServer is None, "pyodbc is not available")
+class TestSQLServerExecute(unittest.TestCase):
+    def setUp(self):
+        # A database file, as execute_many runs the statements on connections of other threads
+        self.directory = tempfile.TemporaryDirectory()
+        self.ss = stand_ins.local_sqlserver()
+        self.ss.engine = stand_ins.sqlite_engine(os.path.join(self.directory.name, "ss.db"))
+        self.ss.execute("CREATE TABLE t (k INTEGER, v TEXT)")
+
+    def tearDown(self):
+        self.ss.engine.dispose()
+        self.directory.cleanup()
+
+    def test_execute_many_errors(self):
+        queries = {"insert": "INSERT INTO t VALUES (1, 'x1')", "missing": "INSERT INTO missing VALUES (1)"}
+        results = self.ss.execute_many(queries, errors="return")
+        self.assertIsNone(results["insert"])
+        self.assertIsInstance(results["missing"], Exception)
+        with self.assertRaises(Exception):
+            self.ss.execute_many(queries)
+        self.assertEqual(self.ss.get_scalar("SELECT COUNT(*) FROM t"), 2)
+
+
+@unittest.skipIf(SQLServer is None, "pyodbc is not available")
+class TestSQLServerBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.ss = stand_ins.local_sqlserver()
+
+    def test_sql_types(self):
+        df = pd.DataFrame(
+            {
+                "id": [1, 2],
+                "name": ["a" * 40, None],
+                "cost": [1.5, None],
+                "date": pd.to_datetime(["2020-01-01", None]),
+                "active": [True, False],
+            }
+        )
+        types = [self.ss._sql_type(df[col]) for col in df.columns]
+        self.assertEqual(types, ["BIGINT", "NVARCHAR(64)", "FLOAT", "DATETIME2", "BIT"])
+
+    def test_merge_statement(self):
+        statement = self.ss._merge_statement("[gcm].[Site]", "[gcm].[_stage]", ["Site_Id", "Site"], ["Site_Id"])
+        self.assertEqual(
+            statement,
+            "MERGE [gcm].[Site] WITH (HOLDLOCK) AS t USING [gcm].[_stage] AS s ON t.[Site_Id] = s.[Site_Id]"
+            " WHEN MATCHED THEN UPDATE SET t.[Site] = s.[Site]"
+            " WHEN NOT MATCHED BY TARGET THEN INSERT ([Site_Id], [Site]) VALUES (s.[Site_Id], s.[Site]);",
+        )
+
+    def test_upsert_requires_keys(self):
+        with self.assertRaises(ValueError):
+            self.ss.to_sql(pd.DataFrame({"a": [1]}), name="t", schema="gcm", if_exists="upsert")
+
+
+if __name__ == "__main__":
+    unittest.main()
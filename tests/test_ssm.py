@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+import unittest
+import boto3
+from botocore.stub import Stubber
+from reagan.ssm import LocalParameterStore, ParameterStore, set_parameter_store
+from reagan.subclass import Subclass
+
+
+class TestLocalParameterStore(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalParameterStore(
+            {"/gcp/project": "proj", "/gcp/zone": "us-east1-b", "/sqlserver/102": "DSN=x"}
+        )
+
+    def test_get_is_cached(self):
+        self.assertEqual(self.store.get("/gcp/project"), "proj")
+        self.assertEqual(self.store.get("/gcp/project"), "proj")
+        self.assertEqual(self.store.calls, 1)
+
+    def test_missing_parameter(self):
+        with self.assertRaises(KeyError):
+            self.store.get("/gcp/missing")
+
+    def test_prefetch_by_names_and_path(self):
+        values = self.store.get_parameters(path="/gcp/")
+        self.assertEqual(values, {"/gcp/project": "proj", "/gcp/zone": "us-east1-b"})
+        self.store.get_parameters(["/gcp/project", "/sqlserver/102"])
+        self.store.get("/gcp/zone")
+        self.store.get("/sqlserver/102")
+        self.assertEqual(self.store.calls, 2)
+
+    def test_invalidate(self):
+        self.store.get_parameters(path="/gcp")
+        self.store.parameters["/gcp/project"] = "other"
+        self.store.invalidate(path="/gcp")
+        self.assertEqual(self.store.get("/gcp/project"), "other")
+
+    def test_ttl_expires(self):
+        store = LocalParameterStore({"/a": "1"}, ttl=0)
+        store.get("/a")
+        store.get("/a")
+        self.assertEqual(store.calls, 2)
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filepath = os.path.join(folder, "parameters.json")
+            with open(filepath, "w") as f:
+                json.dump({"/drive/service_account_path": "sa.json"}, f)
+            store = LocalParameterStore(filepath=filepath)
+        self.assertEqual(store.get("/drive/service_account_path"), "sa.json")
+
+
+class TestParameterStore(unittest.TestCase):
+    def setUp(self):
+        client = boto3.client(
+            "ssm", region_name="us-east-2", aws_access_key_id="x", aws_secret_access_key="x"
+        )
+        self.stubber = Stubber(client)
+        self.store = ParameterStore(client=client)
+
+    def test_bulk_fetch_is_batched(self):
+        names = [f"/p/{i}" for i in range(12)]
+        for batch in (names[:10], names[10:]):
+            self.stubber.add_response(
+                "get_parameters",
+                {"Parameters": [{"Name": name, "Value": name[3:]} for name in batch]},
+                {"Names": batch, "WithDecryption": True},
+            )
+        with self.stubber:
+            values = self.store.get_parameters(names)
+            self.assertEqual(self.store.get("/p/11"), "11")
+        self.assertEqual(len(values), 12)
+        self.stubber.assert_no_pending_responses()
+
+
+class TestSubclassParameters(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalParameterStore({"/smartsheets/bearer_token": "token"})
+        set_parameter_store(self.store)
+
+    def tearDown(self):
+        set_parameter_store(None)
+
+    def test_instances_share_the_cache(self):
+        for _ in range(3):
+            self.assertEqual(Subclass().get_parameter_value("/smartsheets/bearer_token"), "token")
+        self.assertEqual(self.store.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
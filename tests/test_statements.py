@@ -0,0 +1,48 @@
+import unittest
+from reagan.statements import StatementCache, ordered, preparable, to_numbered
+
+
+class Connection(object):
+    def __init__(self):
+        self.info = {}
+
+
+class TestStatements(unittest.TestCase):
+    def test_to_numbered(self):
+        query, order = to_numbered("SELECT * FROM t WHERE a = %s AND b LIKE 'x%%' AND c = %s")
+        self.assertEqual(query, "SELECT * FROM t WHERE a = $1 AND b LIKE 'x%' AND c = $2")
+        self.assertEqual(ordered(["a", "c"], order), ["a", "c"])
+
+    def test_to_numbered_names(self):
+        query, order = to_numbered("SELECT * FROM t WHERE a = %(a)s OR b = %(b)s OR c = %(a)s")
+        self.assertEqual(query, "SELECT * FROM t WHERE a = $1 OR b = $2 OR c = $1")
+        self.assertEqual(ordered({"b": 2, "a": 1}, order), [1, 2])
+
+    def test_ordered_count(self):
+        with self.assertRaises(ValueError):
+            ordered([1], to_numbered("SELECT %s, %s")[1])
+
+    def test_preparable(self):
+        self.assertTrue(preparable("-- rows\n/* of t */ (SELECT * FROM t WHERE a = %s)", [1]))
+        self.assertTrue(preparable("with x AS (SELECT %(a)s) SELECT * FROM x", {"a": 1}))
+        self.assertTrue(preparable("INSERT INTO t VALUES (%s, %s)", [(1, "a"), (2, "b")], many=True))
+        self.assertFalse(preparable("SELECT * FROM t WHERE a IN %s", [(1, 2)]))
+        self.assertFalse(preparable("INSERT INTO t VALUES (%s)", [([1],), ([2],)], many=True))
+        self.assertFalse(preparable("SET statement_timeout = %s", [1000]))
+        self.assertFalse(preparable("CREATE TABLE t AS SELECT %s AS a", [1]))
+
+    def test_cache_evicts_least_recent(self):
+        evicted = []
+        cache = StatementCache(size=2, on_evict=lambda statement, conn: evicted.append((statement, conn)))
+        cache.put("a", 1, "conn 1")
+        cache.put("b", 2, "conn 1")
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3, "conn 2")
+        # Released on the connection checked out when evicted
+        self.assertEqual(evicted, [(2, "conn 2")])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import numpy as np
+import pandas as pd
+from reagan.subclass import Subclass
+
+
+class TestJsonToDf(unittest.TestCase):
+    def setUp(self):
+        self.sc = Subclass()
+        self.data = [
+            {"id": "1", "size": {"width": 300, "height": 250}, "tags": ["a", "b"]},
+            {"id": "2", "size": None, "tags": []},
+            {"id": "3", "tags": ["c"], "extra": {"deep": {"value": 7}}},
+        ]
+
+    def test_lists_split_into_rows_in_order(self):
+        df = self.sc._json_to_df(self.data)
+        self.assertEqual(df["id"].tolist(), ["1", "1", "3"])
+        self.assertEqual(df["tags"].tolist(), ["a", "b", "c"])
+
+    def test_dicts_split_into_columns(self):
+        df = self.sc._json_to_df(self.data)
+        self.assertEqual(
+            df.columns.tolist(),
+            ["id", "tags", "size_width", "size_height", "extra_deep_value"],
+        )
+        self.assertTrue(np.isnan(df["extra_deep_value"].iloc[0]))
+        self.assertEqual(df["extra_deep_value"].iloc[2], 7)
+
+    def test_requested_columns_are_kept_in_order(self):
+        df = self.sc._json_to_df(self.data, columns=["size_width", "id", "extra"])
+        self.assertEqual(df.columns.tolist(), ["id", "extra", "size_width"])
+        self.assertEqual(df["extra"].iloc[2], {"deep": {"value": 7}})
+
+    def test_missing_list_becomes_null_row(self):
+        df = pd.DataFrame({"id": ["1", "2"], "tags": [np.nan, ["a"]]})
+        df = self.sc._split_dataframe_list(df, "tags", separator="_")
+        self.assertEqual(df["id"].tolist(), ["1", "2"])
+        self.assertTrue(np.isnan(df["tags"].iloc[0]))
+
+
+class TestFlattenPlan(unittest.TestCase):
+    def setUp(self):
+        self.sc = Subclass()
+        self.data = [
+            {"id": "1", "size": {"width": 300, "height": 250}, "tags": ["a", "b"]},
+            {"id": "2", "size": None, "tags": []},
+            {"id": "3", "tags": ["c"], "extra": {"deep": {"value": 7}}},
+        ]
+
+    def test_compile_columns(self):
+        plan = self.sc._compile_columns(["id", "extra_deep_value"])
+        self.assertEqual(
+            plan, {"id": "leaf", "extra": "branch", "extra_deep": "branch", "extra_deep_value": "leaf"}
+        )
+
+    def test_matches_unnest(self):
+        columns = ["size_width", "id", "extra_deep_value", "tags"]
+        df_unnest = self.sc._json_to_df(self.data, columns)
+        df_plan = self.sc._json_to_df(self.data, columns, flatten="plan")
+        self.assertEqual(df_plan.columns.tolist(), columns)
+        pd.testing.assert_frame_equal(df_unnest[columns], df_plan, check_dtype=False)
+
+    def test_crossed_lists(self):
+        data = [{"id": "1", "tags": ["a", "b"], "schedule": {"periods": [{"cost": 1}, {"cost": 2}]}}]
+        columns = ["id", "schedule_periods_cost", "tags"]
+        df_unnest = self.sc._json_to_df(data, columns)[columns]
+        df_plan = self.sc._json_to_df(data, columns, flatten="plan")
+        # The same rows, with the list of the first requested column varying slowest
+        self.assertEqual(sorted(df_plan.values.tolist()), sorted(df_unnest.values.tolist()))
+        self.assertEqual(df_plan.values.tolist(), [["1", 1, "a"], ["1", 1, "b"], ["1", 2, "a"], ["1", 2, "b"]])
+        self.assertEqual(df_unnest.values.tolist(), [["1", 1, "a"], ["1", 2, "a"], ["1", 1, "b"], ["1", 2, "b"]])
+
+    def test_dict_on_leaf_is_kept(self):
+        df = self.sc._json_to_df(self.data, ["id", "extra"], flatten="plan")
+        self.assertEqual(df["id"].tolist(), ["1", "2", "3"])
+        self.assertEqual(df["extra"].iloc[2], {"deep": {"value": 7}})
+
+
+class TestJsonToDfChunks(unittest.TestCase):
+    def setUp(self):
+        self.sc = Subclass()
+        self.pages = [
+            [{"id": "1", "size": {"width": 300}}],
+            [],
+            [{"id": "2", "name": "b"}, {"id": "3", "size": {"height": 250}}],
+        ]
+
+    def test_one_chunk_per_page(self):
+        chunks = list(self.sc._json_to_df_chunks(iter(self.pages)))
+        self.assertEqual([len(df) for df in chunks], [1, 2])
+
+    def test_chunks_have_requested_columns(self):
+        columns = ["id", "size_height", "name"]
+        for df in self.sc._json_to_df_chunks(iter(self.pages), columns):
+            self.assertEqual(df.columns.tolist(), columns)
+
+    def test_concat_fills_missing_columns(self):
+        df = self.sc._concat_chunks(self.sc._json_to_df_chunks(iter(self.pages)))
+        self.assertEqual(df.columns.tolist(), ["id", "size_width", "name", "size_height"])
+        self.assertEqual(df["id"].tolist(), ["1", "2", "3"])
+        self.assertTrue(pd.isnull(df["name"].iloc[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()